@@ -0,0 +1,358 @@
+"""واجهة HTTP بصيغة JSON لأنظمة التوزيع (dispatch) دون المرور بواجهة Streamlit.
+
+خدمة مستقلة بمحرك واتصالات خاصة بها فوق نفس طبقة البيانات (repository.py)،
+وكل طلب يُنفذ مباشرة دون إعادة تشغيل سكربت الواجهة. عمليات الرصيد المفردة تمر بطابور
+الكتابة (write_queue.py) لتجميعها في commit مشترك عند كثرة الطلبات.
+
+المصادقة: ترويسة "Authorization: Bearer <token>" بالقيمة DELIVERY_API_TOKEN (أو --token).
+
+    GET  /health
+    GET  /drivers/search?q=...&limit=10
+    GET  /drivers/<id>                    الرصيد والحالة والفرع
+    GET  /drivers/<id>/history?limit=50&before_id=...
+    POST /deliveries       {"driver_id", "idempotency_key"?}
+    POST /charges          {"driver_id", "amount" > 0, "idempotency_key"?}
+    POST /deliveries/bulk  {"deliveries": [{"driver_id", "count"?}], "idempotency_key"?}
+    POST /charges/bulk     {"charges": [{"driver_id", "amount" > 0}], "idempotency_key"?}
+    GET  /metrics          القياسات بصيغة Prometheus
+
+idempotency_key نص حتى 200 حرف. إعادة الطلب بنفس المفتاح تعيد نتيجته الأولى دون تسجيله مرة ثانية؛ نفس المفتاح لطلب مختلف يعيد 409.
+
+مثال:
+    DELIVERY_API_TOKEN=secret python api.py --db sqlite:///delivery_app.db --port 8502
+"""
+import argparse
+import hmac
+import json
+import math
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from metrics import Metrics
+from repository import CHARGE_TYPE, DELIVERY_TYPE, DeliveryRepository, IdempotencyKeyConflict
+from search_index import DriverSearchIndex
+from storage import POOL_MAX_OVERFLOW, POOL_SIZE, create_storage
+from write_queue import WriteQueue
+
+DEDUCTION_AMOUNT = None        # None: مبلغ خصم فرع المندوب (جدول branches)، أو مبلغ ثابت لكل التوصيلات
+MAX_BULK_POSTINGS = 500        # أقصى عدد عمليات في طلب bulk واحد
+MAX_BODY_BYTES = 1024 * 1024
+MAX_PAGE_SIZE = 200
+SEARCH_INDEX_MAX_AGE = 300
+REQUEST_QUEUE_SIZE = 256       # طلبات TCP المنتظرة قبل قبولها
+WRITE_TIMEOUT = 30             # ثوانٍ لانتظار commit دفعة طابور الكتابة (بعدها 503)
+MAX_IDEMPOTENCY_KEY_LENGTH = 200
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _driver_id(body):
+    driver_id = body.get("driver_id")
+    if not isinstance(driver_id, (str, int)) or isinstance(driver_id, bool) or not str(driver_id).strip():
+        raise ApiError(400, "driver_id مطلوب.")
+    return str(driver_id).strip()
+
+
+def _amount(value):
+    # الشحن دون شرط كفاية الرصيد، لذلك لا يُقبل مبلغ سالب (ولا صفر يسجل حركة فارغة)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value <= 0:
+        raise ApiError(400, "amount يجب أن يكون رقماً موجباً.")
+    return float(value)
+
+
+def _idempotency_key(body):
+    key = body.get("idempotency_key")
+    if key is None:
+        return None
+    if not isinstance(key, str) or not key.strip() or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise ApiError(400, f"idempotency_key يجب أن يكون نصاً غير فارغ (حتى {MAX_IDEMPOTENCY_KEY_LENGTH} حرف).")
+    return key
+
+
+def _int_param(query, name, default, minimum=1, maximum=None):
+    raw = query.get(name, [None])[0]
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise ApiError(400, f"{name} يجب أن يكون عدداً صحيحاً.")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ApiError(400, f"{name} خارج النطاق المسموح.")
+    return value
+
+
+def _bulk_items(body, key):
+    items = body.get(key)
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, f"{key} يجب أن تكون قائمة غير فارغة.")
+    if not all(isinstance(item, dict) for item in items):
+        raise ApiError(400, f"كل عنصر في {key} يجب أن يكون كائناً.")
+    return items
+
+
+def _batch_response(result):
+    if result is None:
+        return 200, {"duplicate": True}
+    return 200, {
+        "accepted": len(result["accepted"]),
+        "rejected": [{"row": p["row"], "driver_id": str(p["driver_id"]), "reason": p["reason"]} for p in result["rejected"]],
+        "balances": result["balances"],
+    }
+
+
+class DeliveryApi:
+    """منطق الواجهة مستقلاً عن HTTP: handle(method, path, query, body) يعيد (status, payload)."""
+
+    def __init__(self, repo, token, deduction_amount=DEDUCTION_AMOUNT, write_queue=None, metrics=None):
+        self.repo = repo
+        self.token = token
+        self.deduction_amount = deduction_amount
+        self.write_queue = write_queue
+        self.metrics = metrics or Metrics()
+        self.search_index = DriverSearchIndex(repo.load_search_rows, max_age=SEARCH_INDEX_MAX_AGE)
+
+    def authorized(self, header):
+        scheme, _, token = (header or "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+    def handle(self, method, path, query, body):
+        parts = [unquote(p) for p in path.strip("/").split("/") if p]
+        route, action = self._route(method, parts, query, body)
+        started = time.perf_counter()
+        try:
+            return action()
+        except IdempotencyKeyConflict:
+            raise ApiError(409, "idempotency_key مستخدم مسبقاً لعملية مختلفة.")
+        finally:
+            self.metrics.observe(f"api {method} {route}", time.perf_counter() - started)
+
+    def _route(self, method, parts, query, body):
+        """يعيد (قالب المسار للقياسات، الدالة المطلوبة)."""
+        if method == "GET":
+            if parts == ["health"]:
+                return "/health", lambda: (200, {"status": "ok"})
+            if parts == ["metrics"]:
+                return "/metrics", lambda: (200, self.metrics.prometheus())
+            if parts == ["drivers", "search"]:
+                return "/drivers/search", lambda: self.search(query)
+            if len(parts) == 2 and parts[0] == "drivers":
+                return "/drivers/<id>", lambda: self.driver(parts[1])
+            if len(parts) == 3 and parts[0] == "drivers" and parts[2] == "history":
+                return "/drivers/<id>/history", lambda: self.history(parts[1], query)
+        elif method == "POST":
+            actions = {
+                ("deliveries",): self.delivery,
+                ("charges",): self.charge,
+                ("deliveries", "bulk"): self.bulk_deliveries,
+                ("charges", "bulk"): self.bulk_charges,
+            }
+            if tuple(parts) in actions:
+                return "/" + "/".join(parts), lambda: actions[tuple(parts)](body)
+        raise ApiError(404, "المسار غير موجود.")
+
+    # --- القراءة ---
+    def search(self, query):
+        term = query.get("q", [""])[0].strip()
+        if not term:
+            raise ApiError(400, "q مطلوب.")
+        limit = _int_param(query, "limit", 10, maximum=50)
+        return 200, {"results": self.search_index.search(term, limit=limit)}
+
+    def driver(self, driver_id):
+        info = self.repo.load_driver_info(driver_id)
+        if info is None:
+            raise ApiError(404, "المندوب غير موجود.")
+        return 200, {"driver_id": driver_id, **info}
+
+    def history(self, driver_id, query):
+        page_size = _int_param(query, "limit", 50, maximum=MAX_PAGE_SIZE)
+        before_id = _int_param(query, "before_id", None)
+        page = self.repo.get_history_page(driver_id, before_id=before_id, page_size=page_size)
+        rows = page["rows"].rename(columns={"العملية": "type", "المبلغ": "amount", "التوقيت": "timestamp"})
+        rows["timestamp"] = rows["timestamp"].astype(str)
+        return 200, {
+            "driver_id": driver_id,
+            "transactions": rows.to_dict(orient="records"),
+            "next_before_id": page["last_id"] if page["has_older"] else None,
+        }
+
+    # --- الكتابة ---
+    def _post(self, driver_id, amount, trans_type, require_funds, idempotency_key):
+        if self.write_queue is not None:
+            return self.write_queue.post(driver_id, amount, trans_type, require_funds, idempotency_key, timeout=WRITE_TIMEOUT)
+        return self.repo.update_balance(driver_id, amount, trans_type, require_funds, idempotency_key)
+
+    def _delivery_amount(self):
+        # None: يحدده repository من فرع المندوب داخل transaction العملية
+        return -self.deduction_amount if self.deduction_amount is not None else None
+
+    def delivery(self, body):
+        driver_id = _driver_id(body)
+        # شرطا الحساب المفعل وكفاية الرصيد داخل عبارة UPDATE نفسها؛ القراءة بعدها لاختيار رسالة الرفض فقط
+        balance = self._post(driver_id, self._delivery_amount(), DELIVERY_TYPE, True, _idempotency_key(body))
+        if balance is None:
+            info = self.repo.load_driver_info(driver_id)
+            if info is None:
+                raise ApiError(404, "المندوب غير موجود.")
+            if not info["is_active"]:
+                raise ApiError(409, "حساب المندوب معطل.")
+            raise ApiError(409, "الرصيد غير كافٍ.")
+        return 200, {"driver_id": driver_id, "balance": balance}
+
+    def charge(self, body):
+        driver_id = _driver_id(body)
+        amount = _amount(body.get("amount"))
+        balance = self._post(driver_id, amount, CHARGE_TYPE, False, _idempotency_key(body))
+        if balance is None:
+            raise ApiError(404, "المندوب غير موجود.")
+        return 200, {"driver_id": driver_id, "balance": balance}
+
+    def bulk_deliveries(self, body):
+        postings = []
+        for row, item in enumerate(_bulk_items(body, "deliveries"), start=1):
+            count = item.get("count", 1)
+            if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+                raise ApiError(400, "count يجب أن يكون عدداً صحيحاً موجباً.")
+            postings.extend({"row": row, "driver_id": _driver_id(item), "amount": self._delivery_amount(), "type": DELIVERY_TYPE}
+                            for _ in range(count))
+        if len(postings) > MAX_BULK_POSTINGS:
+            raise ApiError(413, f"أقصى عدد عمليات في الطلب {MAX_BULK_POSTINGS}.")
+        return _batch_response(self.repo.record_batch(postings, _idempotency_key(body)))
+
+    def bulk_charges(self, body):
+        items = _bulk_items(body, "charges")
+        if len(items) > MAX_BULK_POSTINGS:
+            raise ApiError(413, f"أقصى عدد عمليات في الطلب {MAX_BULK_POSTINGS}.")
+        postings = [{"row": row, "driver_id": _driver_id(item), "amount": _amount(item.get("amount")), "type": CHARGE_TYPE}
+                    for row, item in enumerate(items, start=1)]
+        return _batch_response(self.repo.record_batch(postings, _idempotency_key(body)))
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive: العميل يعيد استخدام نفس الاتصال
+    disable_nagle_algorithm = True  # الترويسات والجسم يُرسلان منفصلين؛ بدونه ينتظر كل رد ~40ms (delayed ACK)
+    server_version = "captainsjak-api"
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _dispatch(self, method):
+        api = self.server.api
+        url = urlsplit(self.path)
+        try:
+            # نقرأ الجسم دائماً قبل الرد حتى يبقى الاتصال صالحاً للطلب التالي (keep-alive)
+            body = self._read_body() if method == "POST" else {}
+            if url.path.rstrip("/") != "/health" and not api.authorized(self.headers.get("Authorization")):
+                raise ApiError(401, "رمز المصادقة غير صحيح.")
+            status, payload = api.handle(method, url.path, parse_qs(url.query), body)
+        except ApiError as e:
+            status, payload = e.status, {"error": e.message}
+        except TimeoutError:
+            status, payload = 503, {"error": "تأخر تأكيد العملية؛ أعد المحاولة بنفس idempotency_key."}
+        except Exception as e:
+            self.log_error("%s %s failed: %r", method, self.path, e)
+            status, payload = 500, {"error": "خطأ داخلي."}
+        self._send(status, payload)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            # الجسم لم يُقرأ، فلا يمكن استخدام الاتصال لطلب آخر
+            self.close_connection = True
+            raise ApiError(413, "حجم الطلب أكبر من المسموح.")
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            raise ApiError(400, "JSON غير صالح.")
+        if not isinstance(body, dict):
+            raise ApiError(400, "الطلب يجب أن يكون كائن JSON.")
+        return body
+
+    def _send(self, status, payload):
+        if isinstance(payload, str):
+            data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            data, content_type = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"), "application/json; charset=utf-8"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ApiServer(ThreadingHTTPServer):
+    """خادم بخيط لكل اتصال؛ اتصالات قاعدة البيانات من مجمع المحرك (pool) الخاص بالخدمة."""
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, address, api, verbose=False):
+        super().__init__(address, ApiRequestHandler)
+        self.api = api
+        self.verbose = verbose
+
+
+def create_server(url, token, host="127.0.0.1", port=8502, use_write_queue=True, deduction_amount=DEDUCTION_AMOUNT,
+                  verbose=False, **pool):
+    """ينشئ الخدمة (المحرك، الترحيلات، طابور الكتابة) دون تشغيلها؛ port=0 لاختيار منفذ حر.
+
+    pool: معاملات مجمع الاتصالات (انظر storage.engine_options).
+    """
+    storage = create_storage(url, **pool)
+    metrics = Metrics(sample_rate=1.0)
+    metrics.instrument_engine(storage.engine)
+    repo = DeliveryRepository(storage)
+    repo.init_schema()
+    write_queue = WriteQueue(repo, observe=metrics.observe).start() if use_write_queue else None
+    api = DeliveryApi(repo, token, deduction_amount, write_queue, metrics)
+    return ApiServer((host, port), api, verbose)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="واجهة HTTP بصيغة JSON لتسجيل التوصيلات والشحن وقراءة الأرصدة.")
+    parser.add_argument("--db", default=os.environ.get("DELIVERY_DB_URL"), help="رابط SQLAlchemy (الافتراضي DELIVERY_DB_URL)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--token", default=os.environ.get("DELIVERY_API_TOKEN"), help="رمز المصادقة (الافتراضي DELIVERY_API_TOKEN)")
+    parser.add_argument("--deduction", type=float, default=DEDUCTION_AMOUNT, help="مبلغ ثابت لخصم التوصيلة (الافتراضي: مبلغ فرع المندوب)")
+    parser.add_argument("--direct-writes", action="store_true", help="commit لكل عملية بدلاً من طابور الكتابة")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE, help="اتصالات قاعدة البيانات الدائمة")
+    parser.add_argument("--max-overflow", type=int, default=POOL_MAX_OVERFLOW, help="اتصالات إضافية عند الضغط")
+    parser.add_argument("--verbose", action="store_true", help="طباعة سطر لكل طلب")
+    args = parser.parse_args(argv)
+    if not args.db:
+        parser.error("حدد قاعدة البيانات بـ --db أو DELIVERY_DB_URL.")
+    if not args.token:
+        parser.error("حدد رمز المصادقة بـ --token أو DELIVERY_API_TOKEN.")
+
+    server = create_server(args.db, args.token, args.host, args.port, not args.direct_writes, args.deduction, args.verbose,
+                           pool_size=args.pool_size, max_overflow=args.max_overflow)
+    print(f"API: http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.api.write_queue:
+            server.api.write_queue.close(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
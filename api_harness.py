@@ -0,0 +1,194 @@
+"""اختبار تحميل وصحة لواجهة HTTP (api.py) على قاعدة مضمّنة.
+
+يشغل الخدمة داخل نفس العملية على منفذ حر فوق قاعدة SQLite مؤقتة (أو --db) مع أسطول اصطناعي
+(benchmark.generate)، ثم يرسل طلبات متزامنة من عدة عملاء (قراءة الرصيد، توصيلات، شحن، bulk)
+ويطبع عدد الطلبات في الثانية وزمن p50/p95/p99 لكل مسار.
+
+في النهاية يتحقق من:
+- رفض الطلبات دون رمز المصادقة، و 404 للمندوب غير الموجود.
+- مجموع الأرصدة = الرصيد الابتدائي + مجموع العمليات المقبولة، ولا يوجد رصيد سالب بسبب التوصيلات.
+- عدم وجود فروقات في جدول الملخص (rebuild_summary).
+
+    python api_harness.py --clients 16 --requests 200
+يعيد رمز خروج 1 إذا فشل أي تحقق.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import text
+
+from api import create_server
+from benchmark import ensure_data, percentile
+from migrations import DEFAULT_DEDUCTION_AMOUNT
+
+TOKEN = "harness-token"
+INITIAL_BALANCE = 60.0        # 4 توصيلات لكل مندوب، حتى تُختبر حالة الرصيد غير الكافي
+CHARGE_AMOUNT = 30.0
+
+
+class Client:
+    """عميل HTTP باتصال keep-alive واحد."""
+
+    def __init__(self, port, token=TOKEN):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+
+    def request(self, method, path, body=None):
+        self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=self.headers)
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+
+    def close(self):
+        self.conn.close()
+
+
+def run_clients(port, driver_ids, clients, requests, seed):
+    """يعيد (الأزمنة لكل مسار، الحالات لكل مسار، مجموع المبالغ المقبولة، الزمن الكلي)."""
+    timings = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    accepted_total = [0.0]
+    lock = threading.Lock()
+    errors = []
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        client = Client(port)
+        local_amount = 0.0
+        try:
+            for _ in range(requests):
+                driver_id = rng.choice(driver_ids)
+                kind = rng.random()
+                if kind < 0.4:
+                    route, method, path, body = "GET /drivers/<id>", "GET", f"/drivers/{driver_id}", None
+                elif kind < 0.75:
+                    route, method, path, body = "POST /deliveries", "POST", "/deliveries", {
+                        "driver_id": driver_id, "idempotency_key": uuid.uuid4().hex}
+                elif kind < 0.9:
+                    route, method, path, body = "POST /charges", "POST", "/charges", {
+                        "driver_id": driver_id, "amount": CHARGE_AMOUNT, "idempotency_key": uuid.uuid4().hex}
+                else:
+                    route, method, path, body = "POST /deliveries/bulk", "POST", "/deliveries/bulk", {
+                        "deliveries": [{"driver_id": d, "count": 2} for d in rng.sample(driver_ids, 3)],
+                        "idempotency_key": uuid.uuid4().hex}
+                started = time.perf_counter()
+                status, payload = client.request(method, path, body)
+                elapsed = time.perf_counter() - started
+                if status == 200 and route == "POST /deliveries":
+                    local_amount -= DEFAULT_DEDUCTION_AMOUNT  # كل المندوبين في الفرع الرئيسي
+                elif status == 200 and route == "POST /charges":
+                    local_amount += CHARGE_AMOUNT
+                elif status == 200 and route == "POST /deliveries/bulk":
+                    local_amount -= DEFAULT_DEDUCTION_AMOUNT * payload["accepted"]
+                with lock:
+                    timings[route].append(elapsed)
+                    statuses[route][status] += 1
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            client.close()
+            with lock:
+                accepted_total[0] += local_amount
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise SystemExit(f"أخطاء في العملاء: {errors[:3]}")
+    return timings, statuses, accepted_total[0], time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="اختبار تحميل وصحة لواجهة HTTP على قاعدة مضمّنة.")
+    parser.add_argument("--db", help="رابط SQLAlchemy لقاعدة فارغة (الافتراضي: ملف SQLite مؤقت)")
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="عدد الطلبات لكل عميل")
+    parser.add_argument("--direct-writes", action="store_true", help="بدون طابور الكتابة (للمقارنة)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    workdir = None
+    url = args.db
+    if not url:
+        workdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(workdir.name, 'api.db')}"
+    server = create_server(url, TOKEN, port=0, use_write_queue=not args.direct_writes)
+    repo = server.api.repo
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+    failures = []
+    try:
+        ensure_data(repo, args.drivers, 0, args.seed, log)
+        with repo.storage.session as s:
+            s.execute(text("UPDATE drivers SET balance = :b, is_active = :active"), {"b": INITIAL_BALANCE, "active": True})
+            s.commit()
+        driver_ids = [row[0] for row in repo.load_search_rows()]
+
+        anonymous = Client(port, token=None)
+        if anonymous.request("GET", f"/drivers/{driver_ids[0]}")[0] != 401:
+            failures.append("طلب دون رمز المصادقة لم يُرفض")
+        anonymous.close()
+        client = Client(port)
+        if client.request("GET", "/drivers/NO-SUCH-DRIVER")[0] != 404:
+            failures.append("المندوب غير الموجود لم يُعد 404")
+        client.close()
+
+        log(f"{args.clients} عميل × {args.requests} طلب على http://127.0.0.1:{port} ...")
+        timings, statuses, accepted_amount, elapsed = run_clients(port, driver_ids, args.clients, args.requests, args.seed)
+
+        total = sum(len(v) for v in timings.values())
+        report = {"requests": total, "seconds": round(elapsed, 2), "requests_per_second": round(total / elapsed, 1), "routes": {}}
+        for route, values in sorted(timings.items()):
+            values.sort()
+            report["routes"][route] = {
+                "count": len(values),
+                "statuses": dict(statuses[route]),
+                **{f"p{p}_ms": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)},
+            }
+        if server.api.write_queue:
+            report["write_queue"] = server.api.write_queue.stats()
+
+        with repo.storage.session as s:
+            balance_sum, negative = s.execute(text(
+                "SELECT COALESCE(SUM(balance), 0), SUM(CASE WHEN balance < 0 THEN 1 ELSE 0 END) FROM drivers"
+            )).one()
+        expected = INITIAL_BALANCE * len(driver_ids) + accepted_amount
+        if abs(float(balance_sum) - expected) > 1e-6:
+            failures.append(f"مجموع الأرصدة {balance_sum} بدلاً من {expected}")
+        if negative:
+            failures.append(f"{negative} مندوب برصيد سالب")
+        drift = repo.rebuild_summary()["drift"]
+        if drift:
+            failures.append(f"فروقات في جدول الملخص: {drift[:3]}")
+        report["failures"] = failures
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        server.shutdown()
+        server.server_close()
+        if server.api.write_queue:
+            server.api.write_queue.close(timeout=10)
+        repo.storage.engine.dispose()
+        if workdir:
+            workdir.cleanup()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,626 +1,1429 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import io
-from sqlalchemy import text 
+import math
+import uuid
+from sqlalchemy.exc import IntegrityError
+from search_index import DriverSearchIndex
+from cache import VersionedLRUCache
+from export import PARQUET_AVAILABLE
+from storage import Storage, create_storage, engine_options
+from repository import DeliveryRepository, IdempotencyKeyConflict, DELIVERY_TYPE, CHARGE_TYPE
+from metrics import Metrics
+from write_queue import WriteQueue
+from driver_import import EXCEL_AVAILABLE, TEMPLATE_CSV, import_drivers as import_driver_file
+from assets import StaticAssets
+from change_feed import ChangeFeed
+from migrations import DEFAULT_BRANCH, DEFAULT_DEDUCTION_AMOUNT
 
 # --- إعدادات التطبيق ---
-DEDUCTION_AMOUNT = 15.0  
-ADMIN_KEY = "jak2831"    
-IMAGE_PATH = "logo.png"  
+ADMIN_KEY = "jak2831"    
+LOGO_FILE = "logo.png"  # داخل مجلد static/
+# قاعدة البيانات: فارغ = PostgreSQL من secrets (connections.postgresql)،
+# أو رابط SQLAlchemy مثل sqlite:///delivery_app.db لتشغيل فرع محلي دون خادم
+STORAGE_URL = os.environ.get("DELIVERY_DB_URL", "")
+# مجمع اتصالات قاعدة البيانات (مشترك بين كل الجلسات داخل العملية)
+DB_POOL_SIZE = int(os.environ.get("DELIVERY_DB_POOL_SIZE", "10"))          # اتصالات دائمة
+DB_MAX_OVERFLOW = int(os.environ.get("DELIVERY_DB_MAX_OVERFLOW", "20"))    # اتصالات إضافية عند الضغط
+DB_POOL_TIMEOUT = float(os.environ.get("DELIVERY_DB_POOL_TIMEOUT", "30"))  # ثوانٍ لانتظار اتصال حر
+DB_POOL_RECYCLE = int(os.environ.get("DELIVERY_DB_POOL_RECYCLE", "1800"))  # ثوانٍ قبل استبدال الاتصال
+DB_POOL_PRE_PING = os.environ.get("DELIVERY_DB_POOL_PRE_PING", "1") == "1"
+# العبارات المحضّرة في PostgreSQL (0 خلف PgBouncer بنمط transaction)
+DB_PREPARED_STATEMENTS = os.environ.get("DELIVERY_DB_PREPARED_STATEMENTS", "1") == "1"
+# نسخة قراءة (replica) للتقارير والسجل: رابط SQLAlchemy (فارغ = كل القراءات من القاعدة الأساسية)
+DB_REPLICA_URL = os.environ.get("DELIVERY_DB_REPLICA_URL", "")
+DB_REPLICA_MAX_LAG = float(os.environ.get("DELIVERY_DB_REPLICA_MAX_LAG", "5"))  # ثوانٍ قبل الرجوع للأساسية
+SEARCH_RESULTS_LIMIT = 10      # عدد نتائج البحث المعروضة للاختيار
+SEARCH_INDEX_MAX_AGE = 300     # ثوانٍ قبل إعادة تحميل فهرس البحث في الخلفية
+DRIVER_CACHE_SIZE = 5000       # أقصى عدد من المندوبين في ذاكرة التخزين المؤقت
+DRIVER_CACHE_TTL = 30          # ثوانٍ (لالتقاط تعديلات المحطات الأخرى على نفس قاعدة البيانات)
+HISTORY_PAGE_SIZES = [25, 50, 100, 200]  # أحجام صفحات السجل المتاحة (الافتراضي 50)
+HISTORY_COUNT_TTL = 60         # ثوانٍ لتخزين عدد حركات السجل مؤقتاً
+HISTORY_EXACT_COUNT_LIMIT = 100000  # فوق هذا العدد يُعرض تقدير PostgreSQL بدلاً من COUNT(*) الكامل
+DRIVERS_PAGE_SIZES = [25, 50, 100, 200]  # أحجام صفحات "عرض الكل" (الافتراضي 50)
+LOW_BALANCE_THRESHOLD = None  # "رصيد منخفض": None = لا يكفي لتوصيلة واحدة بمبلغ فرع المندوب، أو مبلغ ثابت
+BRANCHES_TTL = 60              # ثوانٍ لتخزين قائمة الفروع ومبالغ الخصم مؤقتاً
+OPS_RECENT_ROWS = 5            # آخر الحركات المعروضة تحت رصيد المندوب في واجهة العمليات
+DRIVER_RECENT_ROWS = 10        # آخر الحركات المعروضة تحت الرصيد في واجهة المندوب
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # أقصى حجم لملف التصدير (يبقى في ذاكرة Streamlit حتى يحمّله المتصفح)
+DRIVER_FEED_INTERVAL = 3       # ثوانٍ بين فحصين لتحديث رصيد المندوب (من ذاكرة ChangeFeed، دون استعلام)
+METRICS_SAMPLE_RATE = float(os.environ.get("DELIVERY_METRICS_SAMPLE_RATE", "0.2"))  # نسبة إعادات التشغيل المقاسة
+METRICS_FILE = os.environ.get("DELIVERY_METRICS_FILE", "")  # ملف Prometheus النصي (فارغ = لا يُكتب)
+METRICS_FILE_INTERVAL = 15     # أقل عدد ثوانٍ بين كتابتين للملف
+# طابور الكتابة (group commit) لعمليات الرصيد في أوقات الذروة: DELIVERY_WRITE_QUEUE=1 لتفعيله
+WRITE_QUEUE_ENABLED = os.environ.get("DELIVERY_WRITE_QUEUE", "") == "1"
+WRITE_QUEUE_TIMEOUT = 30       # ثوانٍ لانتظار commit الدفعة قبل إظهار خطأ للمشغل
 
 # ----------------------------------------------------
 
-# 🆕 دالة الاتصال الموحدة
-def get_connection():
-    """يُنشئ اتصال Streamlit SQL مع إعدادات secrets."""
-    return st.connection("postgresql", type="sql")
+# 🆕 قياس الأداء (metrics.py): زمن دوال البيانات وعدد الاستعلامات في كل إعادة تشغيل
+@st.cache_resource
+def get_metrics():
+    return Metrics(sample_rate=METRICS_SAMPLE_RATE)
+
+timed = get_metrics().timed
+
+# 🆕 طبقة الوصول إلى البيانات (repository.py فوق storage.py) مشتركة بين كل الجلسات
+@st.cache_resource
+def get_repository():
+    """PostgreSQL عبر اتصال Streamlit، أو أي قاعدة يحددها DELIVERY_DB_URL (مثل SQLite محلي)."""
+    pool = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING)
+    if STORAGE_URL:
+        storage = create_storage(STORAGE_URL, DB_PREPARED_STATEMENTS, **pool)
+    else:
+        engine = st.connection("postgresql", type="sql", **engine_options(**pool)).engine
+        storage = Storage(engine, DB_PREPARED_STATEMENTS)
+    get_metrics().instrument_engine(storage.engine)
+    if DB_REPLICA_URL:
+        replica = create_storage(DB_REPLICA_URL, DB_PREPARED_STATEMENTS, **pool)
+        get_metrics().instrument_engine(replica.engine)
+        storage.attach_replica(replica, max_lag=DB_REPLICA_MAX_LAG)
+    repo = DeliveryRepository(storage)
+    # ترحيلات المخطط مرة واحدة لكل عملية (وليس في كل إعادة تشغيل)
+    repo.init_schema()
+    return repo
+
+# 🆕 طابور الكتابة (write_queue.py): خيط واحد لكل عملية يجمع عمليات الرصيد من كل الجلسات في commit واحد
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue(get_repository(), observe=get_metrics().observe).start()
+
+# 🆕 متابعة الحركات الجديدة (change_feed.py): خيط واحد لكل عملية بدلاً من استعلام كل مندوب متصل عن سجله
+# القياسات تقرأ الخيط من started_feeds فقط، فلا تبدأه صفحة المراقبة أو ملف Prometheus في عملية لم يفتح فيها مندوب صفحته
+@st.cache_resource
+def started_feeds():
+    return {}
+
+@st.cache_resource
+def get_change_feed():
+    feed = ChangeFeed(get_repository().storage).start()
+    started_feeds()["change_feed"] = feed
+    return feed
+
+# 🆕 الأصوات والشعار تُقدَّم كملفات ثابتة (assets.py): الصفحة تحمل الرابط فقط ويخزن المتصفح الملف
+@st.cache_resource
+def get_assets():
+    return StaticAssets()
 
 # 🆕 دالة مساعدة لتشغيل صوت تنبيه
 def play_sound(sound_file):
-    """يشغل ملف صوتي باستخدام HTML."""
-    # هذا الجزء يعتمد على وجود ملفات الصوت في مسار معين (مثل static/success.mp3)
-    full_path = os.path.join("static", sound_file)
-    try:
-        if os.path.exists(full_path):
-            import base64
-            with open(full_path, "rb") as f:
-                audio_bytes = f.read()
-            audio_base64 = base64.b64encode(audio_bytes).decode()
-            audio_html = f"""
-            <audio autoplay="true">
-                <source src="data:audio/mp3;base64,{audio_base64}" type="audio/mp3">
-            </audio>
-            """
-            st.markdown(audio_html, unsafe_allow_html=True)
-    except Exception:
-        pass
+    """يشغل ملف صوتي من مجلد static/ باستخدام HTML."""
+    url = get_assets().url(sound_file)
+    if url:
+        st.markdown(f'<audio autoplay="true" src="{url}"></audio>', unsafe_allow_html=True)
+
+def show_logo(container, width="100%"):
+    url = get_assets().url(LOGO_FILE)
+    if url:
+        container.markdown(f'<img src="{url}" style="width:{width}">', unsafe_allow_html=True)
+    return url is not None
 
 # --- دوال التعامل مع قاعدة البيانات (تم تحديثها) ---
-def init_db():
-    conn = get_connection()
-    with conn.session as s:
-        s.execute(text("""
-            CREATE TABLE IF NOT EXISTS drivers (
-                id SERIAL PRIMARY KEY, 
-                driver_id TEXT UNIQUE, 
-                name TEXT, 
-                bike_plate TEXT, 
-                whatsapp TEXT, 
-                notes TEXT, 
-                is_active BOOLEAN, 
-                balance REAL
-            );
-        """))
-        s.execute(text("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id SERIAL PRIMARY KEY, 
-                driver_name TEXT, 
-                amount REAL, 
-                type TEXT, 
-                timestamp TEXT
-            );
-        """))
-        s.commit()
-
-# 🆕 تم تحديثها لاستخدام المعاملات المسماة (:param_name)
-def add_driver(driver_id, name, bike_plate, whatsapp, notes, is_active):
-    conn = get_connection()
-    try:
-        with conn.session as s:
-            sql = text("""
-                INSERT INTO drivers (driver_id, name, bike_plate, whatsapp, notes, is_active, balance) 
-                VALUES (:id, :name, :plate, :wa, :notes, :active, 0.0)
-            """)
-            s.execute(sql, {
-                "id": driver_id, 
-                "name": name, 
-                "plate": bike_plate, 
-                "wa": whatsapp, 
-                "notes": notes, 
-                "active": is_active
-            })
-            s.commit()
-        st.success(f"تمت إضافة المندوب '{name}' بنجاح! 🔔")
-        play_sound("success.mp3") 
-    except Exception as e:
-        if "duplicate key value violates unique constraint" in str(e):
-             st.error("رقم الترقيم (ID) هذا موجود مسبقاً. 🚨")
-        else:
-             st.error(f"حدث خطأ أثناء الإضافة: {e}")
-        play_sound("error.mp3") 
-
-# 🛑 تم تعديل هذه الدالة: 
-# 1. إضافة @st.cache_data(ttl=None) لحل مشكلة UnhashableParamError.
-# 2. تحسين البحث ليشمل الاسم والبحث الجزئي (ILIKE).
-@st.cache_data(ttl=None) 
+# الاستعلامات نفسها في repository.py؛ هنا فقط الذاكرة المؤقتة ورسائل الواجهة
+# 🆕 ترحيل الحركات القديمة: استخراج الترقيم من نص "الاسم (ID:xx)" وتعبئة عمود driver_id
+@timed("backfill_transaction_driver_ids")
+def backfill_transaction_driver_ids(batch_size=1000):
+    """يعبئ driver_id للحركات القديمة على دفعات ويعيد عدد الحركات التي تم ربطها."""
+    return get_repository().backfill_transaction_driver_ids(batch_size)
+
+# 🆕 الفروع (hubs): لكل فرع مندوبوه ومبلغ خصم التوصيلة الخاص به
+@st.cache_data(ttl=BRANCHES_TTL)
+def get_branches():
+    """{code: {code, name, deduction_amount}} لكل الفروع."""
+    return {b["code"]: b for b in get_repository().list_branches()}
+
+def save_branch(code, name, deduction_amount):
+    get_repository().save_branch(code, name, deduction_amount)
+    get_branches.clear()
+
+def current_branch():
+    """الفرع المختار في القائمة الجانبية (None = كل الفروع)."""
+    return st.session_state.get("branch")
+
+def branch_name(code):
+    return "كل الفروع" if code is None else get_branches().get(code, {"name": code})["name"]
+
+def deduction_amount(branch):
+    """مبلغ خصم التوصيلة في الفرع (للعرض فقط؛ الخصم نفسه يقرأ المبلغ داخل transaction العملية)."""
+    return get_branches().get(branch, {"deduction_amount": DEFAULT_DEDUCTION_AMOUNT})["deduction_amount"]
+
+@timed("add_driver")
+def add_driver(driver_id, name, bike_plate, whatsapp, notes, is_active, branch=DEFAULT_BRANCH):
+    try:
+        get_repository().add_driver(driver_id, name, bike_plate, whatsapp, notes, is_active, branch)
+        get_driver_cache().invalidate(str(driver_id))
+        index_driver(driver_id, name, whatsapp, branch)
+        st.success(f"تمت إضافة المندوب '{name}' بنجاح! 🔔")
+        play_sound("success.mp3") 
+    except IntegrityError:
+        st.error("رقم الترقيم (ID) هذا موجود مسبقاً. 🚨")
+        play_sound("error.mp3") 
+    except Exception as e:
+        st.error(f"حدث خطأ أثناء الإضافة: {e}")
+        play_sound("error.mp3") 
+
+# 🆕 استيراد المندوبين من ملف (driver_import.py): فحص الصفوف على دفعات وكتابتها في transaction واحدة
+@timed("import_drivers")
+def import_drivers(file, filename, default_branch=None):
+    """يعيد dict فيه inserted و updated و rejected. يرفع ValueError إذا كان الملف غير صالح.
+
+    المندوبون الجدد دون عمود الفرع يُضافون إلى default_branch (أو الفرع الرئيسي).
+    """
+    report = import_driver_file(get_repository(), file, filename, default_branch=default_branch)
+    if report["inserted"] or report["updated"]:
+        get_driver_cache().clear()
+        for index in list(get_search_indexes().values()):
+            index.refresh()
+    return report
+
+# 🆕 البحث عبر فهرس داخل الذاكرة (search_index.py) بدلاً من ILIKE '%term%' على ثلاثة أعمدة
+def load_search_rows(branch=None):
+    return get_repository().load_search_rows(branch)
+
+@st.cache_resource
+def get_search_indexes():
+    """فهرس بحث لكل فرع (والمفتاح None لكل الفروع)، مشترك بين كل الجلسات داخل نفس العملية.
+
+    فهرس الفرع يحمّل مندوبي الفرع فقط، ويُبنى عند أول بحث فيه.
+    """
+    return {}
+
+def get_search_index(branch=None):
+    indexes = get_search_indexes()
+    index = indexes.get(branch)
+    if index is None:
+        index = indexes.setdefault(branch, DriverSearchIndex(lambda: load_search_rows(branch), max_age=SEARCH_INDEX_MAX_AGE))
+    return index
+
+def index_driver(driver_id, name, whatsapp, branch):
+    """يحدّث المندوب في فهرس كل الفروع وفهرس فرعه، ويحذفه من فهارس الفروع الأخرى (بعد نقله)."""
+    for key, index in list(get_search_indexes().items()):
+        if key is None or key == branch:
+            index.upsert(driver_id, name, whatsapp)
+        else:
+            index.remove(driver_id)
+
+@timed("search_drivers")
+def search_drivers(search_term, limit=SEARCH_RESULTS_LIMIT):
+    """قائمة مرتبة بالمندوبين المطابقين في الفرع المختار: التطابق التام للترقيم أولاً ثم البدايات ثم الاحتواء والتشابه."""
+    return get_search_index(current_branch()).search(search_term, limit=limit)
+
 def search_driver(search_term):
-    """البحث عن مندوب بواسطة driver_id أو whatsapp أو الاسم باستخدام البحث الجزئي"""
-    conn = get_connection()
-    
-    # تحضير مصطلح البحث للبحث الجزئي باستخدام ILIKE
-    search_pattern = f"%{search_term}%"
-    
-    query = text("""
-        SELECT driver_id, name, balance, is_active 
-        FROM drivers 
-        WHERE driver_id ILIKE :pattern 
-           OR whatsapp ILIKE :pattern
-           OR name ILIKE :pattern
-        ORDER BY name
-        LIMIT 1
-    """)
-     
-    # إزالة ttl="0" والاعتماد على @st.cache_data(ttl=None)
-    df = conn.query(query, params={"pattern": search_pattern})
-    
-    if not df.empty:
-        result = df.iloc[0]
-        return {"driver_id": result['driver_id'], "name": result['name'], "balance": result['balance'], "is_active": result['is_active']}
-    return None
-
-# 🛑 تم تعديل هذه الدالة:
-# 1. إضافة @st.cache_data(ttl=None) لحل مشكلة UnhashableParamError.
-@st.cache_data(ttl=None) 
+    """أفضل نتيجة بحث واحدة مع الرصيد والحالة."""
+    matches = search_drivers(search_term, limit=1)
+    if not matches:
+        return None
+    info = get_driver_info(matches[0]['driver_id'])
+    if not info:
+        return None
+    return {"driver_id": matches[0]['driver_id'], "name": info['name'], "balance": info['balance'], "is_active": info['is_active']}
+
+# 🆕 ذاكرة تخزين مؤقت لكل مندوب على حدة (cache.py) بدلاً من @st.cache_data الذي لا يُفرَّغ بعد تغيير الرصيد
+# كل كتابة (رصيد، تعديل، إضافة) تحذف مفتاح المندوب المتأثر فقط.
+@st.cache_resource
+def get_driver_cache():
+    return VersionedLRUCache(max_size=DRIVER_CACHE_SIZE, ttl=DRIVER_CACHE_TTL)
+
+def load_driver_info(driver_id):
+    return get_repository().load_driver_info(driver_id)
+
+@timed("get_driver_info")
 def get_driver_info(driver_id):
-    conn = get_connection()
-    query = text("SELECT name, balance, is_active FROM drivers WHERE driver_id = :id")
-    # إزالة ttl="0" والاعتماد على @st.cache_data(ttl=None)
-    df = conn.query(query, params={"id": driver_id}) 
-    
-    if not df.empty:
-        result = df.iloc[0]
-        return {"name": result['name'], "balance": result['balance'], "is_active": result['is_active']} 
-    return None
-
-# 🆕 تم تحديثها لاستخدام conn.session
-def update_driver_details(driver_id, name, bike_plate, whatsapp, notes, is_active):
-    conn = get_connection()
-    with conn.session as s:
-        sql = text("""
-            UPDATE drivers SET name=:name, bike_plate=:plate, whatsapp=:wa, notes=:notes, is_active=:active 
-            WHERE driver_id=:id
-        """)
-        s.execute(sql, {
-            "name": name, 
-            "plate": bike_plate, 
-            "wa": whatsapp, 
-            "notes": notes, 
-            "active": is_active, 
-            "id": driver_id
-        })
-        s.commit()
-    st.success(f"تم تحديث بيانات المندوب {name} بنجاح.")
-
-# 🆕 تم تحديثها لاستخدام conn.session وتنفيذ عمليتي كتابة متتاليتين
-def update_balance(driver_id, amount, trans_type):
-    conn = get_connection()
-    # يجب إزالة أي caching هنا لضمان الحصول على أحدث رصيد
-    # يتم تجاوز الكاش هنا عن طريق استدعاء get_driver_info بدون وسيط الترقيم
-    info = get_driver_info(driver_id)
-    if not info: return 0.0
-    
-    current_balance = info['balance']
-    name = info['name']
-    new_balance = current_balance + amount
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    with conn.session as s:
-        # 1. تحديث الرصيد
-        update_sql = text("UPDATE drivers SET balance=:new_bal WHERE driver_id=:id")
-        s.execute(update_sql, {"new_bal": new_balance, "id": driver_id})
-        
-        # 2. تسجيل المعاملة
-        trans_sql = text("""
-            INSERT INTO transactions (driver_name, amount, type, timestamp) 
-            VALUES (:driver_name, :amount, :type, :timestamp)
-        """)
-        s.execute(trans_sql, {
-            "driver_name": f"{name} (ID:{driver_id})", 
-            "amount": amount, 
-            "type": trans_type, 
-            "timestamp": timestamp
-        })
-        s.commit()
-    return new_balance
-
-def get_deliveries_count_per_driver():
-    conn = get_connection()
-    query = """
-    SELECT 
-        SUBSTR(driver_name, POSITION(':' IN driver_name)+1, LENGTH(driver_name)-POSITION(':' IN driver_name)-1) AS driver_id, 
-        COUNT(*) AS "عدد التوصيلات"
-    FROM transactions
-    WHERE type='خصم توصيلة'
-    GROUP BY driver_id
-    """
-    df = conn.query(query, ttl="0")
-    return df
-
-def get_totals():
-    conn = get_connection()
-    
-    # استخدام conn.query مع ttl=0 للحصول على أحدث نتيجة كـ DataFrame ثم استخراج القيمة
-    total_balance = conn.query("SELECT COALESCE(SUM(balance), 0.0) FROM drivers", ttl="0").iloc[0, 0]
-    total_charged = conn.query("SELECT COALESCE(SUM(amount), 0.0) FROM transactions WHERE type='شحن رصيد'", ttl="0").iloc[0, 0]
-    total_deducted_negative = conn.query("SELECT COALESCE(SUM(amount), 0.0) FROM transactions WHERE type='خصم توصيلة'", ttl="0").iloc[0, 0]
-    total_deliveries = conn.query("SELECT COUNT(*) FROM transactions WHERE type='خصم توصيلة'", ttl="0").iloc[0, 0]
-    
-    total_deducted = abs(total_deducted_negative)
-    return total_balance, total_charged, total_deducted, total_deliveries
-
-def get_history(driver_id=None):
-    conn = get_connection()
-    if driver_id:
-        # استخدام المعاملات المسماة للاستعلامات المعقدة
-        query = text(f"SELECT type as \"العملية\", amount as \"المبلغ\", timestamp as \"التوقيت\" FROM transactions WHERE driver_name LIKE '%ID:{driver_id}%' ORDER BY id DESC")
-        # يجب إزالة ttl="0" والاعتماد على @st.cache_data(ttl=None) لو أضفنا الـ Decorator على هذه الدالة
-        df = conn.query(query, ttl="0")
-    else:
-        query = "SELECT driver_name as \"المندوب\", type as \"العملية\", amount as \"المبلغ\", timestamp as \"التوقيت\" FROM transactions ORDER BY id DESC"
-        df = conn.query(query, ttl="0")
-    return df
-
-def get_all_drivers_details():
-    conn = get_connection()
-    # الاستعلام الأساسي لجلب كل السائقين
-    query_drivers = "SELECT driver_id, name as \"الاسم\", bike_plate as \"رقم اللوحة\", whatsapp as \"واتساب\", balance as \"الرصيد\", is_active as \"الحالة\", notes as \"ملاحظات\" FROM drivers"
-    df = conn.query(query_drivers, ttl="0")
-    
-    deliveries_count_df = get_deliveries_count_per_driver()
-    
-    if not deliveries_count_df.empty:
-        df['driver_id'] = df['driver_id'].astype(str)
-        deliveries_count_df['driver_id'] = deliveries_count_df['driver_id'].astype(str)
-        df = pd.merge(df, deliveries_count_df, left_on='driver_id', right_on='driver_id', how='left').fillna({'عدد التوصيلات': 0})
-        df['عدد التوصيلات'] = df['عدد التوصيلات'].astype(int)
-    else:
-        df['عدد التوصيلات'] = 0
-        
-    df['الحالة'] = df['الحالة'].apply(lambda x: 'مفعل' if x else 'معطل') # تم التعديل إلى if x ليتناسب مع True/False
-    df.insert(0, 'ت', range(1, 1 + len(df)))
-    df.rename(columns={'driver_id': 'الترقيم'}, inplace=True)
-    cols = ['ت', 'الترقيم', 'الاسم', 'رقم اللوحة', 'واتساب', 'الرصيد', 'عدد التوصيلات', 'الحالة', 'ملاحظات']
-    return df[cols]
+    info = get_driver_cache().get(str(driver_id), load_driver_info)
+    return dict(info) if info else None
+
+@timed("update_driver_details")
+def update_driver_details(driver_id, name, bike_plate, whatsapp, notes, is_active, branch):
+    get_repository().update_driver_details(driver_id, name, bike_plate, whatsapp, notes, is_active, branch)
+    get_driver_cache().invalidate(str(driver_id))
+    index_driver(driver_id, name, whatsapp, branch)
+    st.success(f"تم تحديث بيانات المندوب {name} بنجاح.")
+
+# 🆕 تحديث ذري للرصيد: عبارة UPDATE ... RETURNING شرطية واحدة + تسجيل المعاملة في نفس الـ transaction
+# لا نقرأ الرصيد مسبقاً (ولا من الكاش)، لذلك لا تضيع أي عملية عند التسجيل المتزامن من أكثر من محطة.
+@timed("update_balance")
+def update_balance(driver_id, amount, trans_type, require_funds=False, idempotency_key=None):
+    """يعيد الرصيد الجديد، أو None إذا لم يوجد المندوب أو كان الرصيد غير كافٍ (انظر DeliveryRepository.update_balance).
+
+    amount=None: خصم توصيلة بمبلغ فرع المندوب.
+    """
+    if WRITE_QUEUE_ENABLED:
+        # TimeoutError إذا لم تُؤكد الدفعة خلال المهلة (العملية ما زالت في الطابور)
+        new_balance = get_write_queue().post(driver_id, amount, trans_type, require_funds, idempotency_key,
+                                             timeout=WRITE_QUEUE_TIMEOUT)
+    else:
+        new_balance = get_repository().update_balance(driver_id, amount, trans_type, require_funds, idempotency_key)
+    get_driver_cache().invalidate(str(driver_id))
+    return new_balance
+
+# 🆕 تسجيل دفعة من العمليات في transaction واحدة:
+# قفل صفوف المندوبين المعنيين مرة واحدة، إدراج جماعي في transactions، وتحديث رصيد واحد لكل مندوب.
+@timed("record_batch")
+def record_batch(postings, idempotency_key=None):
+    """يعيد dict فيه accepted و rejected و balances، أو None إذا كانت الدفعة مسجلة مسبقاً."""
+    result = get_repository().record_batch(postings, idempotency_key)
+    if result:
+        cache = get_driver_cache()
+        for driver_id in result["balances"]:
+            cache.invalidate(driver_id)
+    return result
+
+BATCH_MAX_DELIVERIES_PER_ROW = 500  # مثل حد "دفعة توصيلات" في واجهة العمليات
+BATCH_TYPE_ALIASES = {
+    DELIVERY_TYPE: DELIVERY_TYPE, "delivery": DELIVERY_TYPE, "توصيلة": DELIVERY_TYPE,
+    CHARGE_TYPE: CHARGE_TYPE, "charge": CHARGE_TYPE, "شحن": CHARGE_TYPE,
+}
+
+def parse_batch_csv(file):
+    """يقرأ ملف CSV بالأعمدة driver_id, value, type ويحوله إلى عمليات.
+
+    للتوصيلات value هو عدد التوصيلات (كل توصيلة حركة مستقلة بمبلغ خصم فرع المندوب)،
+    وللشحن value هو المبلغ الموجب. يعيد (العمليات، الصفوف غير الصالحة).
+    يرفع ValueError برسالة للمستخدم إذا تعذرت قراءة الملف نفسه.
+    """
+    try:
+        df = pd.read_csv(file, dtype=str, keep_default_na=False)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"تعذرت قراءة الملف كـ CSV: {e}") from e
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    postings, invalid = [], []
+    for line, row in enumerate(df.itertuples(index=False), start=2):
+        record = row._asdict()
+        driver_id = str(record.get("driver_id", "")).strip()
+        trans_type = BATCH_TYPE_ALIASES.get(str(record.get("type", "")).strip().lower())
+        try:
+            value = float(record.get("value", ""))
+        except (TypeError, ValueError):
+            value = None
+        # float يقبل "nan" و "inf"
+        if value is not None and not math.isfinite(value):
+            value = None
+        if not driver_id or trans_type is None or value is None:
+            invalid.append({"row": line, "driver_id": driver_id, "amount": record.get("value"), "type": record.get("type"), "reason": "صف غير صالح"})
+        elif trans_type == DELIVERY_TYPE:
+            if value < 1 or value > BATCH_MAX_DELIVERIES_PER_ROW or value != int(value):
+                invalid.append({"row": line, "driver_id": driver_id, "amount": value, "type": trans_type,
+                                "reason": f"عدد التوصيلات غير صالح (من 1 إلى {BATCH_MAX_DELIVERIES_PER_ROW})"})
+            else:
+                postings.extend({"row": line, "driver_id": driver_id, "amount": None, "type": DELIVERY_TYPE} for _ in range(int(value)))
+        elif value <= 0:
+            invalid.append({"row": line, "driver_id": driver_id, "amount": value, "type": trans_type, "reason": "مبلغ الشحن يجب أن يكون موجباً"})
+        else:
+            postings.append({"row": line, "driver_id": driver_id, "amount": value, "type": CHARGE_TYPE})
+    return postings, invalid
+
+# 🆕 إعادة بناء جدول الملخص من السجل الكامل مع تقرير بالفروقات (drift)
+@timed("rebuild_summary")
+def rebuild_summary():
+    return get_repository().rebuild_summary()
+
+# 🆕 مطابقة الأرصدة مع السجل: تفحص الحركات الجديدة منذ آخر نقطة تحقق فقط
+@timed("reconcile_balances")
+def reconcile_balances():
+    return get_repository().reconcile_balances()
+
+def get_balance_mismatches():
+    return get_repository().get_balance_mismatches()
+
+def accept_balance(driver_id):
+    return get_repository().accept_balance(driver_id)
+
+@timed("get_totals")
+def get_totals(branch=None):
+    return get_repository().get_totals(branch)
+
+# 🆕 تقارير الفترات من الملخص اليومي (daily_driver_stats) بدلاً من مسح سجل الحركات
+@timed("get_period_totals")
+def get_period_totals(date_from, date_to, branch=None):
+    return get_repository().get_period_totals(date_from, date_to, branch)
+
+@timed("get_period_report")
+def get_period_report(date_from, date_to, group_by="driver", branch=None):
+    return get_repository().get_period_report(date_from, date_to, group_by, branch)
+
+def period_range(preset, custom=None):
+    """يحوّل اختيار الفترة إلى (من، إلى) شاملين."""
+    today = datetime.now().date()
+    if preset == "اليوم":
+        return today, today
+    if preset == "أمس":
+        yesterday = today - timedelta(days=1)
+        return yesterday, yesterday
+    if preset == "هذا الأسبوع":
+        return today - timedelta(days=today.weekday()), today
+    if preset == "هذا الشهر":
+        return today.replace(day=1), today
+    if custom and len(custom) == 2:
+        return custom[0], custom[1]
+    return None, None
+
+@timed("get_history")
+def get_history(driver_id=None, branch=None):
+    return get_repository().get_history(driver_id, branch)
+
+# 🆕 ترقيم صفحات السجل بطريقة keyset على id (بدلاً من تحميل السجل كاملاً في DataFrame)
+@timed("get_history_page")
+def get_history_page(driver_id=None, before_id=None, after_id=None, page_size=50, trans_type=None, date_from=None, date_to=None,
+                     branch=None):
+    return get_repository().get_history_page(driver_id, before_id, after_id, page_size, trans_type, date_from, date_to, branch)
+
+@timed("count_history")
+@st.cache_data(ttl=HISTORY_COUNT_TTL)
+def count_history(driver_id=None, trans_type=None, date_from=None, date_to=None, branch=None):
+    """عدد الحركات المطابقة للفلاتر (مخزن مؤقتاً). يعيد (العدد، هل هو تقديري).
+
+    بدون أي فلتر على جدول كبير يُستخدم تقدير قاعدة البيانات بدلاً من مسح الجدول.
+    """
+    return get_repository().count_history(driver_id, trans_type, date_from, date_to, estimate_above=HISTORY_EXACT_COUNT_LIMIT,
+                                          branch=branch)
+
+# 🆕 تصدير السجل على دفعات (export.py) بدلاً من بناء DataFrame ونص CSV كاملين في الذاكرة
+@timed("export_history")
+def export_history(fmt="csv", **filters):
+    return get_repository().export_history(fmt, **filters)
+
+# 🆕 قائمة المندوبين صفحة صفحة: استعلام واحد مع عدد التوصيلات من driver_stats، والترتيب والتصفية في قاعدة البيانات
+@timed("get_drivers_page")
+def get_drivers_page(sort_by="driver_id", descending=False, status=None, page=1, page_size=50, branch=None):
+    return get_repository().get_drivers_page(sort_by, descending, status, LOW_BALANCE_THRESHOLD, page, page_size, branch)
 
 # --- واجهة التطبيق ---
 st.set_page_config(page_title="نظام إدارة التوصيل", layout="wide", page_icon="🚚")
 st.title("🚚 نظام رصيد المندوبين")
+get_metrics().start_rerun()
 
-# التأكد من وجود قاعدة البيانات (إنشاء الجداول في PostgreSQL)
-init_db()
+# الاتصال وترحيلات المخطط تتم مرة واحدة لكل عملية داخل get_repository()
+get_repository()
 
 # تهيئة حالة الجلسة
 if 'logged_in_driver_id' not in st.session_state:
-    st.session_state['logged_in_driver_id'] = None
+    st.session_state['logged_in_driver_id'] = None
 if 'admin_mode' not in st.session_state:
-    st.session_state['admin_mode'] = False
+    st.session_state['admin_mode'] = False
 if 'search_result_id' not in st.session_state:
-    st.session_state['search_result_id'] = None
+    st.session_state['search_result_id'] = None
+# 🆕 مفتاح عدم التكرار للعملية الحالية: يتجدد بعد كل عملية ناجحة وعند تغيير المندوب المحدد.
+# الأزرار تحمل المفتاح كما كان عند رسمها (args)، فالنقرة المزدوجة ترسل نفس المفتاح مرتين.
+def rotate_op_key():
+    st.session_state['op_idempotency_key'] = uuid.uuid4().hex
+
+if 'op_idempotency_key' not in st.session_state:
+    rotate_op_key()
+
+# 🆕 عرض صفحة واحدة من السجل مع الفلاتر وأزرار التنقل
+def show_history_page(key, driver_id=None):
+    """يعرض السجل صفحة صفحة ويعيد الفلاتر المختارة، أو None إذا لم توجد أي حركة مطابقة."""
+    col_type, col_dates, col_size = st.columns([1, 2, 1])
+    with col_type:
+        type_choice = st.selectbox("نوع العملية", ["الكل", CHARGE_TYPE, DELIVERY_TYPE], key=f"{key}_type")
+    with col_dates:
+        dates = st.date_input("الفترة (من - إلى)", value=(), key=f"{key}_dates")
+    with col_size:
+        page_size = st.selectbox("عدد الصفوف", HISTORY_PAGE_SIZES, index=1, key=f"{key}_size")
+
+    filters = {
+        "driver_id": driver_id,
+        "trans_type": None if type_choice == "الكل" else type_choice,
+        "date_from": dates[0] if len(dates) > 0 else None,
+        "date_to": dates[1] if len(dates) > 1 else None,
+        # سجل مندوب محدد يشمل حركاته في فروعه السابقة أيضاً
+        "branch": None if driver_id else current_branch(),
+    }
+    # أي تغيير في الفلاتر أو المندوب يعيدنا إلى الصفحة الأولى
+    cursor_key = f"{key}_cursor"
+    if st.session_state.get(f"{key}_filters") != (filters, page_size):
+        st.session_state[f"{key}_filters"] = (filters, page_size)
+        st.session_state[cursor_key] = (None, None)
+    direction, cursor_id = st.session_state[cursor_key]
+
+    page = get_history_page(
+        before_id=cursor_id if direction == "older" else None,
+        after_id=cursor_id if direction == "newer" else None,
+        page_size=page_size,
+        **filters,
+    )
+    if page["rows"].empty and direction is not None:
+        # الصفحة لم تعد موجودة: نعود إلى الأحدث
+        st.session_state[cursor_key] = (None, None)
+        page = get_history_page(page_size=page_size, **filters)
+    if page["rows"].empty:
+        return None
+
+    st.dataframe(page["rows"].drop(columns="id"), use_container_width=True)
+    total, is_estimate = count_history(**filters)
+    col_newer, col_count, col_older = st.columns([1, 2, 1])
+    with col_newer:
+        st.button("→ الأحدث", key=f"{key}_newer", disabled=not page["has_newer"],
+                  on_click=lambda: st.session_state.update({cursor_key: ("newer", page["first_id"])}))
+    with col_count:
+        st.caption(f"إجمالي الحركات: {'~' if is_estimate else ''}{total}")
+    with col_older:
+        st.button("الأقدم ←", key=f"{key}_older", disabled=not page["has_older"],
+                  on_click=lambda: st.session_state.update({cursor_key: ("older", page["last_id"])}))
+    return filters
+
+# 🆕 زر تحميل السجل المطابق للفلاتر الحالية؛ الملف يُجهز على دفعات عند الضغط فقط.
+# يقدمه st.download_button عبر رابط خاص بالجلسة، ويحتفظ Streamlit بمحتواه في الذاكرة حتى التحميل، لذلك الحد EXPORT_MAX_BYTES.
+def show_export_button(key, filters, file_stem):
+    formats = ["CSV", "Parquet"] if PARQUET_AVAILABLE else ["CSV"]
+    fmt = st.radio("صيغة الملف", formats, horizontal=True, key=f"{key}_format")
+    extension = fmt.lower()
+
+    def build_file():
+        with export_history(extension, **filters) as f:
+            # الحجم يُعرف من الملف المؤقت قبل قراءته؛ الخطأ يظهر للمستخدم بدلاً من التحميل
+            if f.seek(0, io.SEEK_END) > EXPORT_MAX_BYTES:
+                raise ValueError("الملف أكبر من الحد المسموح للتحميل. ضيّق الفلاتر (التاريخ أو المندوب) ثم أعد المحاولة.")
+            f.seek(0)
+            return f.read()
+
+    st.download_button(
+        label=f"تحميل السجل كملف {fmt}",
+        data=build_file,
+        file_name=f"{file_stem}_{datetime.now().strftime('%Y%m%d')}.{extension}",
+        mime="text/csv" if extension == "csv" else "application/vnd.apache.parquet",
+        key=f"{key}_download",
+    )
+
+# 🆕 البحث مع عرض قائمة النتائج ليختار المشغل المندوب الصحيح
+def find_driver(search_term, matches_key):
+    """يبحث ويحفظ النتائج في الجلسة ويحدد أفضل نتيجة تلقائياً."""
+    matches = search_drivers(search_term)
+    st.session_state[matches_key] = matches
+    st.session_state.pop(f"{matches_key}_pick", None)
+    st.session_state['search_result_id'] = matches[0]['driver_id'] if matches else None
+    return matches[0] if matches else None
+
+def show_search_matches(matches_key):
+    """يعرض باقي النتائج في قائمة اختيار عندما يطابق البحث أكثر من مندوب."""
+    matches = st.session_state.get(matches_key) or []
+    ids = [m['driver_id'] for m in matches]
+    if len(ids) < 2 or st.session_state['search_result_id'] not in ids:
+        return
+    labels = {m['driver_id']: f"{m['name']} (ID: {m['driver_id']})" + (f" - {m['whatsapp']}" if m['whatsapp'] else "") for m in matches}
+    pick_key = f"{matches_key}_pick"
+    st.selectbox(
+        f"تم العثور على {len(ids)} نتائج، اختر المندوب",
+        ids,
+        index=ids.index(st.session_state['search_result_id']),
+        format_func=labels.get,
+        key=pick_key,
+        on_change=lambda: st.session_state.update(search_result_id=st.session_state[pick_key]),
+    )
+
+# 🆕 أجزاء الصفحة (st.fragment): أي نقرة داخل الجزء تعيد تشغيل الجزء وحده وليس السكربت كاملاً
+# (القائمة الجانبية والشعار وباقي الصفحة لا يُعاد تنفيذها).
+@st.fragment
+@timed("fragment_history")
+def history_section(key, driver_id=None, file_stem=None, empty_message="لا توجد حركات مسجلة بعد."):
+    """السجل مع الفلاتر والتنقل وزر التحميل (إن وُجد file_stem)."""
+    filters = show_history_page(key, driver_id=driver_id)
+    if not filters:
+        st.info(empty_message)
+    elif file_stem:
+        show_export_button(key, filters, file_stem)
+
+# 🆕 رصيد المندوب وآخر حركاته في واجهة المندوب: الجزء يُعاد تشغيله وحده كل DRIVER_FEED_INTERVAL ثانية،
+# ولا يقرأ من قاعدة البيانات إلا إذا تقدمت علامة المندوب في ChangeFeed، وحينها الحركات الأحدث فقط.
+# بيانات المندوب نفسها من get_driver_info (ذاكرة المندوبين) في كل فحص، فيظهر تعديل المسؤول دون انتظار حركة جديدة.
+def driver_profile(info):
+    """ما تعرضه الصفحة خارج الجزء: تغيّره يحتاج إعادة تشغيل الصفحة كاملة."""
+    return (info['name'], info['is_active'], info['branch']) if info else None
+
+@st.fragment(run_every=DRIVER_FEED_INTERVAL)
+@timed("fragment_driver_live")
+def driver_live_panel(driver_id):
+    state = st.session_state.get("driver_feed")
+    if state is None or state["driver_id"] != driver_id:
+        page = get_history_page(driver_id=driver_id, page_size=DRIVER_RECENT_ROWS)
+        state = {"driver_id": driver_id, "rows": page["rows"], "last_id": page["first_id"] or 0}
+        st.session_state["driver_feed"] = state
+    elif get_change_feed().watermark(driver_id) > state["last_id"]:
+        page = get_history_page(driver_id=driver_id, after_id=state["last_id"], page_size=DRIVER_RECENT_ROWS)
+        if page["has_newer"]:
+            # أكثر من صفحة جديدة: تكفي أحدث الحركات
+            page = get_history_page(driver_id=driver_id, page_size=DRIVER_RECENT_ROWS)
+            rows = page["rows"]
+        else:
+            rows = pd.concat([page["rows"], state["rows"]], ignore_index=True).iloc[:DRIVER_RECENT_ROWS]
+        # لا شيء بعد (نسخة القراءة متأخرة): نعيد المحاولة في الفحص التالي
+        if not page["rows"].empty:
+            get_driver_cache().invalidate(str(driver_id))
+            state.update(rows=rows, last_id=int(rows["id"].iloc[0]))
+
+    info = get_driver_info(driver_id)
+    if info is None or driver_profile(info) != st.session_state.get("driver_profile"):
+        # حُذف المندوب أو تغيّر الاسم أو التفعيل أو الفرع: الصفحة كاملة تعرض الحالة الجديدة
+        st.rerun()
+        return
+    if not info['is_active']:
+        # الحساب المعطل: الجزء يتابع التفعيل فقط (رسالة التعطيل خارجه)
+        return
+    st.markdown("### رصيدك الحالي")
+    st.metric(label="الرصيد المتوفر", value=f"{info['balance']:.2f} أوقية", delta_color="off")
+    st.markdown("### حركاتك الأخيرة")
+    if state["rows"].empty:
+        st.caption("لا توجد حركات مسجلة لك بعد.")
+    else:
+        st.dataframe(state["rows"].drop(columns="id"), use_container_width=True, hide_index=True)
+
+def flash(key, kind, message, sound=None):
+    """رسالة تُعرض مرة واحدة في التشغيل التالي للجزء (العمليات تتم في callbacks قبل العرض)."""
+    st.session_state[key] = (kind, message, sound)
+
+def show_flash(key):
+    item = st.session_state.pop(key, None)
+    if item:
+        kind, message, sound = item
+        getattr(st, kind)(message)
+        if sound:
+            play_sound(sound)
+
+WRITE_TIMEOUT_MESSAGE = "تأخر تأكيد العملية بسبب الضغط على النظام. يرجى إعادة المحاولة (لن تُسجل مرتين). 🚨"
+KEY_CONFLICT_MESSAGE = "لم تُسجل العملية: العملية السابقة لم يُؤكد تسجيلها بعد وهذه عملية مختلفة. راجع آخر الحركات ثم أعد المحاولة. 🚨"
+
+def post_delivery(driver_id, idempotency_key):
+    # التحقق من تفعيل الحساب وكفاية الرصيد يتم ذرياً داخل update_balance (وليس من البيانات المعروضة)
+    try:
+        new_bal = update_balance(driver_id, None, DELIVERY_TYPE, require_funds=True, idempotency_key=idempotency_key)
+    except TimeoutError:
+        flash("op_flash", "error", WRITE_TIMEOUT_MESSAGE, "error.mp3")
+        return
+    except IdempotencyKeyConflict:
+        rotate_op_key()
+        flash("op_flash", "error", KEY_CONFLICT_MESSAGE, "error.mp3")
+        return
+    if new_bal is not None:
+        flash("op_flash", "success", f"تم تسجيل التوصيلة! الرصيد المتبقي: {new_bal:.2f} أوقية 🔔", "success.mp3")
+        rotate_op_key()
+    elif not (get_driver_info(driver_id) or {}).get("is_active"):
+        flash("op_flash", "error", "هذا المندوب معطل ولا يمكن تسجيل توصيلة له. 🚨", "error.mp3")
+    else:
+        flash("op_flash", "error", "عفواً، الرصيد غير كافي لإجراء التوصيلة. يرجى الشحن أولاً. 🚨", "error.mp3")
+
+def post_charge(driver_id, idempotency_key):
+    try:
+        new_bal = update_balance(driver_id, st.session_state["charge_amount"], CHARGE_TYPE, idempotency_key=idempotency_key)
+    except TimeoutError:
+        flash("op_flash", "error", WRITE_TIMEOUT_MESSAGE, "error.mp3")
+        return
+    except IdempotencyKeyConflict:
+        rotate_op_key()
+        flash("op_flash", "error", KEY_CONFLICT_MESSAGE, "error.mp3")
+        return
+    if new_bal is not None:
+        flash("op_flash", "success", f"تم الشحن بنجاح! الرصيد الجديد: {new_bal:.2f} أوقية 🔔", "success.mp3")
+        rotate_op_key()
+    else:
+        flash("op_flash", "error", "لم يتم العثور على بيانات المندوب المحدد.", "error.mp3")
+
+def post_delivery_batch(driver_id, idempotency_key):
+    batch_count = int(st.session_state["batch_count"])
+    postings = [{"row": i, "driver_id": driver_id, "amount": None, "type": DELIVERY_TYPE} for i in range(1, batch_count + 1)]
+    try:
+        result = record_batch(postings, idempotency_key=idempotency_key)
+    except IdempotencyKeyConflict:
+        rotate_op_key()
+        flash("op_flash", "error", KEY_CONFLICT_MESSAGE, "error.mp3")
+        return
+    rotate_op_key()
+    if result is None:
+        flash("op_flash", "info", "تم تسجيل هذه الدفعة مسبقاً.")
+    elif result["rejected"]:
+        accepted = f"تم تسجيل {len(result['accepted'])} توصيلة، و" if result["accepted"] else ""
+        flash("op_flash", "error", f"{accepted}تم رفض {len(result['rejected'])} توصيلة: {result['rejected'][0]['reason']}. 🚨", "error.mp3")
+    else:
+        flash("op_flash", "success", f"تم تسجيل {len(result['accepted'])} توصيلة. الرصيد المتبقي: {result['balances'][driver_id]:.2f} أوقية 🔔", "success.mp3")
+
+def post_file_batch(idempotency_key):
+    try:
+        postings, invalid = parse_batch_csv(st.session_state["batch_file"])
+    except ValueError as e:
+        st.session_state["batch_file_error"] = str(e)
+        return
+    try:
+        result = record_batch(postings, idempotency_key=idempotency_key) if postings else {"accepted": [], "rejected": [], "balances": {}}
+    except IdempotencyKeyConflict:
+        rotate_op_key()
+        st.session_state["batch_file_error"] = KEY_CONFLICT_MESSAGE
+        return
+    rotate_op_key()
+    st.session_state["batch_file_result"] = (result, invalid)
+
+@st.fragment
+@timed("fragment_operations_console")
+def operations_console():
+    """البحث وتحديد المندوب؛ تغيير المندوب يعيد تشغيل هذا الجزء فقط."""
+    st.subheader("1. تحديد المندوب")
+
+    col_search, col_button = st.columns([3, 1])
+    with col_search:
+        search_term_op = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم", key="search_op_input")
+    with col_button:
+        if st.button("بحث وتحديد", key="search_op_btn", type="primary"):
+            driver_data = find_driver(search_term_op, "op_matches")
+            if driver_data:
+                st.success(f"تم تحديد المندوب: {driver_data['name']}")
+            else:
+                st.error("لم يتم العثور على المندوب بالترقيم أو رقم الواتساب أو الاسم المدخل.")
+    show_search_matches("op_matches")
+
+    selected_id = st.session_state['search_result_id']
+    if selected_id:
+        driver_panel(selected_id)
+    else:
+        st.info("يرجى البحث عن المندوب باستخدام ترقيمه أو رقم الواتساب أو الاسم لتسجيل عملية.")
+
+@st.fragment
+@timed("fragment_driver_panel")
+def driver_panel(selected_id):
+    """رصيد المندوب وأزرار العمليات وآخر حركاته؛ تسجيل عملية يعيد تشغيل هذا الجزء فقط."""
+    info = get_driver_info(selected_id)
+    # قد يكون info فارغاً إذا تم حذفه
+    if not info:
+        st.error("لم يتم العثور على بيانات المندوب المحدد.")
+        return
+    st.subheader(f"2. تفاصيل ورصيد المندوب: {info['name']}")
+    # مفتاح جديد عند الانتقال لمندوب آخر: لا يصل مفتاح عملية لم تُؤكد إلى مندوب مختلف
+    if st.session_state.get('op_key_driver') != selected_id:
+        rotate_op_key()
+        st.session_state['op_key_driver'] = selected_id
+    op_key = st.session_state['op_idempotency_key']
+    show_flash("op_flash")
+    balance = info['balance']
+    is_active = info['is_active']
+    amount = deduction_amount(info['branch'])
+
+    status_text = "🟢 مفعل" if is_active else "🔴 معطل"
+    status_color = "green" if is_active else "red"
+
+    st.markdown(f"**الرصيد الحالي:** **<span style='color:green; font-size: 1.5em;'>{balance:.2f} أوقية</span>** | **الحالة:** <span style='color:{status_color}; font-size: 1.2em;'>{status_text}</span> | **الفرع:** {branch_name(info['branch'])}", unsafe_allow_html=True)
+    st.divider()
+
+    if not is_active:
+        st.warning("تنبيه: هذا المندوب **معطل** ولا يمكنه إجراء عمليات توصيل حتى يتم تفعيله من قائمة الإدارة.")
+
+    tab1, tab2, tab3 = st.tabs(["✅ إتمام توصيلة", "💰 شحن رصيد", "📦 دفعة توصيلات"])
+
+    # العمليات في on_click: تُنفذ قبل إعادة رسم الجزء، فيظهر الرصيد الجديد دون st.rerun
+    with tab1:
+        st.markdown(f"سيتم خصم **{amount} أوقية** من الرصيد.")
+        st.button("تسجيل توصيلة ناجحة", key="deduct_button", type="primary", disabled=not is_active,
+                  on_click=post_delivery, args=(selected_id, op_key))
+
+    with tab2:
+        st.number_input("المبلغ المراد شحنه (أوقية)", min_value=-99999.0, step=10.0, key="charge_amount")
+        st.button("تأكيد الشحن", key="charge_button", on_click=post_charge, args=(selected_id, op_key))
+
+    # 🆕 تسجيل عدة توصيلات لنفس المندوب في transaction واحدة (تسوية نهاية الدوام)
+    with tab3:
+        batch_count = st.number_input("عدد التوصيلات", min_value=1, max_value=500, value=1, step=1, key="batch_count")
+        st.markdown(f"سيتم خصم **{batch_count * amount:.2f} أوقية** ({batch_count} × {amount}).")
+        st.button("تسجيل الدفعة", key="batch_button", type="primary", disabled=not is_active,
+                  on_click=post_delivery_batch, args=(selected_id, op_key))
+
+    st.markdown("**آخر الحركات**")
+    recent = get_history_page(driver_id=selected_id, page_size=OPS_RECENT_ROWS)["rows"]
+    if recent.empty:
+        st.caption("لا توجد حركات مسجلة لهذا المندوب.")
+    else:
+        st.dataframe(recent.drop(columns="id"), use_container_width=True, hide_index=True)
+
+# 🆕 "عرض الكل": الترتيب والتصفية والترقيم في قاعدة البيانات، وتُحمّل الصفحة المعروضة فقط
+DRIVER_SORT_LABELS = {"الترقيم": "driver_id", "الاسم": "name", "الرصيد": "balance", "عدد التوصيلات": "deliveries"}
+DRIVER_STATUS_FILTERS = {"الكل": None, "المفعلون": "active", "المعطلون": "inactive", "رصيد منخفض": "low_balance"}
+
+@st.fragment
+@timed("fragment_drivers_table")
+def drivers_table():
+    col_status, col_sort, col_order, col_size = st.columns([2, 2, 1, 1])
+    with col_status:
+        status_label = st.selectbox("التصفية", list(DRIVER_STATUS_FILTERS), key="drivers_status",
+                                    help="رصيد منخفض: لا يكفي لتوصيلة واحدة بمبلغ فرع المندوب" if LOW_BALANCE_THRESHOLD is None
+                                    else f"رصيد منخفض: أقل من {LOW_BALANCE_THRESHOLD:.0f} أوقية")
+    with col_sort:
+        sort_label = st.selectbox("الترتيب حسب", list(DRIVER_SORT_LABELS), key="drivers_sort")
+    with col_order:
+        descending = st.toggle("تنازلي", key="drivers_desc")
+    with col_size:
+        page_size = st.selectbox("عدد الصفوف", DRIVERS_PAGE_SIZES, index=1, key="drivers_size")
+
+    # أي تغيير في التصفية أو الترتيب يعيدنا إلى الصفحة الأولى
+    branch = current_branch()
+    options = (status_label, sort_label, descending, page_size, branch)
+    if st.session_state.get("drivers_options") != options:
+        st.session_state["drivers_options"] = options
+        st.session_state["drivers_page"] = 1
+    page = st.session_state["drivers_page"]
+
+    result = get_drivers_page(DRIVER_SORT_LABELS[sort_label], descending, DRIVER_STATUS_FILTERS[status_label], page, page_size, branch)
+    if result["rows"].empty and page > 1:
+        st.session_state["drivers_page"] = page = 1
+        result = get_drivers_page(DRIVER_SORT_LABELS[sort_label], descending, DRIVER_STATUS_FILTERS[status_label], page, page_size, branch)
+    rows, total = result["rows"], result["total"]
+    if rows.empty:
+        st.info("لا توجد بيانات لعرضها.")
+        return
+
+    rows.insert(0, "ت", range((page - 1) * page_size + 1, (page - 1) * page_size + 1 + len(rows)))
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    pages = -(-total // page_size)
+    col_prev, col_count, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        st.button("→ السابق", key="drivers_prev", disabled=page <= 1,
+                  on_click=lambda: st.session_state.update(drivers_page=page - 1))
+    with col_count:
+        st.caption(f"الصفحة {page} من {pages} — {total} مندوب")
+    with col_next:
+        st.button("التالي ←", key="drivers_next", disabled=page >= pages,
+                  on_click=lambda: st.session_state.update(drivers_page=page + 1))
+
+# 🆕 قيم الذاكرة المؤقتة المضافة إلى قياسات Prometheus
+def cache_gauges():
+    stats = get_driver_cache().stats()
+    return [
+        ("cache_hits", {"cache": "driver"}, stats["hits"], "Cache hits since start."),
+        ("cache_misses", {"cache": "driver"}, stats["misses"], "Cache misses since start."),
+        ("cache_evictions", {"cache": "driver"}, stats["evictions"], "Entries evicted since start."),
+        ("cache_hit_ratio", {"cache": "driver"}, stats["hit_rate"], "Cache hit ratio since start."),
+        ("cache_entries", {"cache": "driver"}, stats["size"], "Entries currently cached."),
+    ]
+
+def pool_gauges():
+    stats = get_repository().storage.pool_stats()
+    if stats is None:
+        return []
+    return [
+        ("db_pool_size", {}, stats["size"], "Persistent connections in the pool."),
+        ("db_pool_checked_out", {}, stats["checked_out"], "Connections currently in use."),
+        ("db_pool_overflow", {}, stats["overflow"], "Overflow connections currently open."),
+        ("db_pool_checkouts", {}, stats["checkouts"], "Connection checkouts since start."),
+        ("db_pool_wait_mean_seconds", {}, stats["wait_mean_ms"] / 1000, "Mean time to obtain a connection."),
+        ("db_pool_wait_max_seconds", {}, stats["wait_max_ms"] / 1000, "Longest time to obtain a connection."),
+        ("db_pool_timeouts", {}, stats["timeouts"], "Checkouts that gave up after pool_timeout."),
+    ]
+
+def replica_gauges():
+    router = get_repository().storage.router
+    if router is None:
+        return []
+    stats = router.stats()
+    return [
+        ("db_replica_available", {}, int(stats["available"]), "1 while the read replica is in use, 0 after a connection error."),
+        ("db_replica_lag_seconds", {}, stats["lag_seconds"] or 0.0, "Last measured replica lag."),
+        ("db_reads", {"target": "replica"}, stats["replica_reads"], "Routed report/history reads by target."),
+        ("db_reads", {"target": "primary"}, stats["primary_reads"], "Routed report/history reads by target."),
+        ("db_replica_fallbacks", {}, stats["fallbacks"], "Reads sent back to the primary after a replica error."),
+    ]
+
+def change_feed_gauges():
+    feed = started_feeds().get("change_feed")
+    if feed is None:
+        return []
+    stats = feed.stats()
+    return [
+        ("change_feed_scans", {}, stats["scans"], "Ledger scans by the change feed since start."),
+        ("change_feed_notifications", {}, stats["notifications"], "NOTIFY messages received since start."),
+        ("change_feed_errors", {}, stats["errors"], "Change feed errors (listener reconnects) since start."),
+        ("change_feed_drivers", {}, stats["drivers"], "Drivers with a tracked watermark."),
+    ]
+
+def write_queue_gauges():
+    if not WRITE_QUEUE_ENABLED:
+        return []
+    stats = get_write_queue().stats()
+    return [
+        ("write_queue_pending", {}, stats["pending"], "Postings waiting in the write queue."),
+        ("write_queue_batches", {}, stats["batches"], "Group commits since start."),
+        ("write_queue_postings", {}, stats["postings"], "Postings applied through the write queue since start."),
+        ("write_queue_fallbacks", {}, stats["fallbacks"], "Batches retried one posting at a time after an error."),
+    ]
+
+def metrics_table(rows, label, unit=1000):
+    """جدول قياسات بالمللي ثانية (unit=1 للقيم التي ليست أزماناً)."""
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return df
+    for col in ("mean", "p50", "p95", "p99"):
+        df[col] = (df[col] * unit).round(2)
+    return df.rename(columns={df.columns[0]: label, "count": "العدد", "mean": "المتوسط"})
 
 # ----------------------------------------------------------------------------------
 # 1. منطق القائمة الجانبية (لم يتغير)
 # ----------------------------------------------------------------------------------
 
-if os.path.exists(IMAGE_PATH):
-    st.sidebar.image(IMAGE_PATH, use_column_width=True)
+show_logo(st.sidebar)
 
 st.sidebar.header("لوحة التحكم")
 
 if st.session_state['admin_mode']:
-    st.sidebar.markdown("**وضع المسؤول (ADMIN)**")
-    menu_options = ["واجهة العمليات (الإدارة)", "إدارة المندوبين (إضافة/تعديل)", "التقارير وسجل العمليات", "إعدادات التطبيق (الشعار)", "الخروج من وضع المسؤول"]
-    current_menu = st.sidebar.radio("القائمة", menu_options)
-    if current_menu == "الخروج من وضع المسؤول":
-        st.session_state['admin_mode'] = False
-        st.session_state['search_result_id'] = None
-        st.rerun()
+    st.sidebar.markdown("**وضع المسؤول (ADMIN)**")
+    # 🆕 الفرع: البحث وقوائم المندوبين والتقارير والسجل لمندوبي هذا الفرع فقط
+    st.sidebar.selectbox("الفرع", [None, *get_branches()], format_func=branch_name, key="branch",
+                         on_change=lambda: st.session_state.update(search_result_id=None))
+    menu_options = ["واجهة العمليات (الإدارة)", "إدارة المندوبين (إضافة/تعديل)", "التقارير وسجل العمليات", "إعدادات التطبيق (الشعار)", "مراقبة الأداء", "الخروج من وضع المسؤول"]
+    current_menu = st.sidebar.radio("القائمة", menu_options)
+    if current_menu == "الخروج من وضع المسؤول":
+        st.session_state['admin_mode'] = False
+        st.session_state['search_result_id'] = None
+        st.rerun()
 
 elif st.session_state['logged_in_driver_id']:
-    driver_id = st.session_state['logged_in_driver_id']
-    # استدعاء get_driver_info يعمل بشكل صحيح الآن
-    driver_info = get_driver_info(driver_id) 
-    if driver_info:
-        st.sidebar.markdown(f"**مرحباً، {driver_info['name']}**")
-        st.sidebar.button("خروج (Logout)", on_click=lambda: st.session_state.update(logged_in_driver_id=None, admin_mode=False, search_result_id=None))
-        current_menu = "واجهة المندوب"
-    else:
-        st.session_state.logged_in_driver_id = None
-        current_menu = "واجهة المندوب"
+    driver_id = st.session_state['logged_in_driver_id']
+    # استدعاء get_driver_info يعمل بشكل صحيح الآن
+    driver_info = get_driver_info(driver_id) 
+    if driver_info:
+        st.sidebar.markdown(f"**مرحباً، {driver_info['name']}**")
+        st.sidebar.button("خروج (Logout)", on_click=lambda: st.session_state.update(logged_in_driver_id=None, admin_mode=False, search_result_id=None,
+                                                                                driver_feed=None, driver_profile=None))
+        current_menu = "واجهة المندوب"
+    else:
+        st.session_state.logged_in_driver_id = None
+        current_menu = "واجهة المندوب"
 
 else:
-    current_menu = "واجهة المندوب"
-    
-    st.sidebar.divider()
-    with st.sidebar.expander("مدخل المسؤول الإداري"):
-        admin_key_input = st.text_input("أدخل المفتاح السري", type="password")
-        if st.button("دخول المسؤول"):
-            if admin_key_input == ADMIN_KEY:
-                st.session_state['admin_mode'] = True
-                st.rerun()
-            else:
-                st.error("المفتاح السري غير صحيح.")
+    current_menu = "واجهة المندوب"
+    
+    st.sidebar.divider()
+    with st.sidebar.expander("مدخل المسؤول الإداري"):
+        admin_key_input = st.text_input("أدخل المفتاح السري", type="password")
+        if st.button("دخول المسؤول"):
+            if admin_key_input == ADMIN_KEY:
+                st.session_state['admin_mode'] = True
+                st.rerun()
+            else:
+                st.error("المفتاح السري غير صحيح.")
+
+get_metrics().set_page(current_menu)
 
 # ----------------------------------------------------------------------------------
 # 2. واجهة المندوب (لم تتغير)
 # ----------------------------------------------------------------------------------
 if current_menu == "واجهة المندوب":
-    if st.session_state['logged_in_driver_id']:
-        driver_id = st.session_state['logged_in_driver_id']
-        driver_data = get_driver_info(driver_id)
-        
-        if driver_data:
-            st.header(f"أهلاً بك يا {driver_data['name']}!")
-            
-            is_active = driver_data['is_active']
-            status_text = "🟢 مفعل" if is_active else "🔴 معطل"
-            status_color = "green" if is_active else "red"
-            st.markdown(f"**حالة حسابك:** <span style='color:{status_color}; font-size: 1.5em;'>{status_text}</span>", unsafe_allow_html=True)
-            
-            if is_active:
-                st.markdown("### رصيدك الحالي")
-                st.metric(label="الرصيد المتوفر", value=f"{driver_data['balance']:.2f} أوقية", delta_color="off")
-                st.divider()
-                st.markdown("### سجل حركاتك الأخيرة")
-                history_df = get_history(driver_id)
-                if not history_df.empty:
-                    st.dataframe(history_df, use_container_width=True)
-                else:
-                    st.info("لا توجد حركات مسجلة لك بعد.")
-            else:
-                st.error("عفواً، حسابك معطل. لا يمكنك إجراء أي عمليات. يرجى مراجعة الإدارة.")
-                
-        else:
-            st.error("حدث خطأ في جلب البيانات.")
-            st.session_state['logged_in_driver_id'] = None
-            st.rerun()
-    
-    else:
-        st.header("تسجيل الدخول للمندوبين")
-        driver_id_input = st.text_input("أدخل ترقيمك (Driver ID)")
-        
-        def attempt_login():
-            if not driver_id_input:
-                st.error("الرجاء إدخال ترقيمك.")
-                return
-            
-            info = get_driver_info(driver_id_input)
-            if info:
-                st.session_state['logged_in_driver_id'] = driver_id_input
-                st.success(f"تم تسجيل الدخول بنجاح! مرحباً بك يا {info['name']}.")
-                st.rerun()
-            else:
-                st.error("ترقيم المندوب غير صحيح.")
-
-        st.button("تسجيل الدخول", on_click=attempt_login, type="primary")
+    if st.session_state['logged_in_driver_id']:
+        driver_id = st.session_state['logged_in_driver_id']
+        driver_data = get_driver_info(driver_id)
+        
+        if driver_data:
+            st.header(f"أهلاً بك يا {driver_data['name']}!")
+            
+            is_active = driver_data['is_active']
+            status_text = "🟢 مفعل" if is_active else "🔴 معطل"
+            status_color = "green" if is_active else "red"
+            st.markdown(f"**حالة حسابك:** <span style='color:{status_color}; font-size: 1.5em;'>{status_text}</span> | **الفرع:** {branch_name(driver_data['branch'])}", unsafe_allow_html=True)
+            
+            # 🆕 الرصيد وآخر الحركات (وتعديلات المسؤول على الحساب) تتحدث تلقائياً (انظر driver_live_panel)
+            st.session_state['driver_profile'] = driver_profile(driver_data)
+            driver_live_panel(driver_id)
+            if is_active:
+                st.divider()
+                st.markdown("### سجل حركاتك")
+                history_section("driver_history", driver_id=driver_id, empty_message="لا توجد حركات مسجلة لك بعد.")
+            else:
+                st.error("عفواً، حسابك معطل. لا يمكنك إجراء أي عمليات. يرجى مراجعة الإدارة.")
+                
+        else:
+            st.error("حدث خطأ في جلب البيانات.")
+            st.session_state.update(logged_in_driver_id=None, driver_feed=None, driver_profile=None)
+            st.rerun()
+    
+    else:
+        st.header("تسجيل الدخول للمندوبين")
+        driver_id_input = st.text_input("أدخل ترقيمك (Driver ID)")
+        
+        def attempt_login():
+            if not driver_id_input:
+                st.error("الرجاء إدخال ترقيمك.")
+                return
+            
+            info = get_driver_info(driver_id_input)
+            if info:
+                st.session_state['logged_in_driver_id'] = driver_id_input
+                st.success(f"تم تسجيل الدخول بنجاح! مرحباً بك يا {info['name']}.")
+                st.rerun()
+            else:
+                st.error("ترقيم المندوب غير صحيح.")
+
+        st.button("تسجيل الدخول", on_click=attempt_login, type="primary")
 
 # ----------------------------------------------------------------------------------
 # 3. واجهة العمليات (الإدارة) (لم تتغير)
 # ----------------------------------------------------------------------------------
 elif current_menu == "واجهة العمليات (الإدارة)":
-    st.header("تسجيل العمليات (شحن/خصم)")
-    
-    st.subheader("1. تحديد المندوب")
-    
-    col_search, col_button = st.columns([3, 1])
-    with col_search:
-        search_term_op = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم", key="search_op_input")
-    with col_button:
-        if st.button("بحث وتحديد", key="search_op_btn", type="primary"):
-            # search_driver يعمل الآن بالبحث الشامل
-            driver_data = search_driver(search_term_op)
-            if driver_data:
-                st.session_state['search_result_id'] = driver_data['driver_id']
-                st.success(f"تم تحديد المندوب: {driver_data['name']}")
-            else:
-                st.error("لم يتم العثور على المندوب بالترقيم أو رقم الواتساب أو الاسم المدخل.")
-                st.session_state['search_result_id'] = None
-    
-    selected_id = st.session_state['search_result_id']
-    
-    if selected_id:
-        info = get_driver_info(selected_id)
-        # قد يكون info فارغاً إذا تم حذفه
-        if info:
-            st.subheader(f"2. تفاصيل ورصيد المندوب: {info['name']}")
-            balance = info['balance']
-            is_active = info['is_active']
-            
-            status_text = "🟢 مفعل" if is_active else "🔴 معطل"
-            status_color = "green" if is_active else "red"
-            
-            st.markdown(f"**الرصيد الحالي:** **<span style='color:green; font-size: 1.5em;'>{balance:.2f} أوقية</span>** | **الحالة:** <span style='color:{status_color}; font-size: 1.2em;'>{status_text}</span>", unsafe_allow_html=True)
-            st.divider()
-            
-            if not is_active:
-                 st.warning("تنبيه: هذا المندوب **معطل** ولا يمكنه إجراء عمليات توصيل حتى يتم تفعيله من قائمة الإدارة.")
-  
-            tab1, tab2 = st.tabs(["✅ إتمام توصيلة", "💰 شحن رصيد"])
-            
-            with tab1:
-                st.markdown(f"سيتم خصم **{DEDUCTION_AMOUNT} أوقية** من الرصيد.")
-                if st.button("تسجيل توصيلة ناجحة", key="deduct_button", type="primary", disabled=not is_active):
-                    if balance >= DEDUCTION_AMOUNT:
-                        new_bal = update_balance(selected_id, -DEDUCTION_AMOUNT, "خصم توصيلة")
-                        st.success(f"تم تسجيل التوصيلة! الرصيد المتبقي: {new_bal:.2f} أوقية 🔔")
-                        play_sound("success.mp3") 
-                        st.session_state['search_result_id'] = None 
-                        st.rerun()
-                    else:
-                        st.error("عفواً، الرصيد غير كافي لإجراء التوصيلة. يرجى الشحن أولاً. 🚨")
-                        play_sound("error.mp3") 
-            
-            with tab2:
-                amount_to_add = st.number_input("المبلغ المراد شحنه (أوقية)", min_value=-99999.0, step=10.0, key="charge_amount")
-                if st.button("تأكيد الشحن", key="charge_button"):
-                    new_bal = update_balance(selected_id, amount_to_add, "شحن رصيد")
-                    st.success(f"تم الشحن بنجاح! الرصيد الجديد: {new_bal:.2f} أوقية 🔔")
-                    play_sound("success.mp3") 
-                    st.session_state['search_result_id'] = None 
-                    st.rerun()
-        else:
-            st.error("لم يتم العثور على بيانات المندوب المحدد.")
-    else:
-        st.info("يرجى البحث عن المندوب باستخدام ترقيمه أو رقم الواتساب أو الاسم لتسجيل عملية.")
+    st.header("تسجيل العمليات (شحن/خصم)")
+    # 🆕 البحث ورصيد المندوب والعمليات في أجزاء مستقلة (انظر operations_console)
+    operations_console()
+
+    # 🆕 رفع ملف دفعة لعدة مندوبين
+    st.divider()
+    with st.expander("📦 رفع دفعة عمليات من ملف CSV"):
+        st.markdown(
+            "الأعمدة المطلوبة: `driver_id, value, type`. "
+            f"النوع `{DELIVERY_TYPE}` (أو delivery) والقيمة عدد التوصيلات (حتى {BATCH_MAX_DELIVERIES_PER_ROW} في الصف)، "
+            f"أو `{CHARGE_TYPE}` (أو charge) والقيمة مبلغ الشحن (موجب). تُسجل الدفعة كاملة في عملية واحدة."
+        )
+        batch_file = st.file_uploader("ملف الدفعة (CSV)", type=["csv"], key="batch_file")
+        if batch_file is not None:
+            st.button("تسجيل الدفعة من الملف", key="batch_file_button", type="primary",
+                      on_click=post_file_batch, args=(st.session_state['op_idempotency_key'],))
+        if "batch_file_error" in st.session_state:
+            st.error(st.session_state.pop("batch_file_error"))
+        if "batch_file_result" in st.session_state:
+            result, invalid = st.session_state.pop("batch_file_result")
+            if result is None:
+                st.info("تم تسجيل هذه الدفعة مسبقاً.")
+            else:
+                rejected = invalid + result["rejected"]
+                st.success(f"تم تسجيل {len(result['accepted'])} عملية لـ {len(result['balances'])} مندوب.")
+                if rejected:
+                    st.error(f"تم رفض {len(rejected)} عملية:")
+                    st.dataframe(
+                        pd.DataFrame(rejected).rename(columns={"row": "السطر", "driver_id": "الترقيم", "amount": "المبلغ", "type": "العملية", "reason": "السبب"}),
+                        use_container_width=True,
+                    )
+                    play_sound("error.mp3")
+                else:
+                    play_sound("success.mp3")
 
 # ----------------------------------------------------------------------------------
 # 4. إدارة المندوبين (إضافة/تعديل) 
 # ----------------------------------------------------------------------------------
 elif current_menu == "إدارة المندوبين (إضافة/تعديل)":
-    st.header("إدارة بيانات المندوبين")
-    tab_add, tab_edit, tab_view = st.tabs(["إضافة مندوب", "تعديل بيانات", "عرض الكل"])
-    
-    with tab_add:
-        st.subheader("تسجيل مندوب جديد")
-        with st.form("new_driver_form"):
-            col1_add, col2_add = st.columns(2)
-            with col1_add:
-                new_driver_id = st.text_input("ترقيم المندوب (ID)", help="يجب أن يكون رقماً فريداً أو كوداً مميزاً")
-                new_name = st.text_input("اسم المندوب الكامل")
-                new_bike_plate = st.text_input("رقم لوحة الدراجة")
-            with col2_add:
-                new_whatsapp = st.text_input("رقم الواتساب (للتواصل)")
-                new_notes = st.text_area("ملاحظات إضافية")
-                new_is_active = st.checkbox("حساب مفعل؟", value=True, help="عطّل هذا الخيار لمنع المندوب من إجراء عمليات توصيل أو شحن.")
-            
-            submitted = st.form_submit_button("إضافة المندوب", type="primary")
-            if submitted:
-                if new_driver_id and new_name:
-                    add_driver(new_driver_id, new_name, new_bike_plate, new_whatsapp, new_notes, new_is_active) 
-                    st.rerun()
-                else:
-                    st.error("يرجى إدخال ترقيم المندوب والاسم على الأقل.")
-
-    with tab_edit:
-        st.subheader("تعديل بيانات مندوب حالي")
-        
-        col_search_edit, col_button_edit = st.columns([3, 1])
-        with col_search_edit:
-            search_term_edit = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم للتعديل", key="search_edit_input")
-        with col_button_edit:
-            if st.button("بحث وتحديد", key="search_edit_btn", type="primary"):
-                # search_driver يعمل الآن بشكل صحيح مع Caching والبحث الشامل
-                driver_data = search_driver(search_term_edit) 
-                if driver_data:
-                    st.session_state['search_result_id'] = driver_data['driver_id']
-                    st.success(f"تم تحديد المندوب: {driver_data['name']}. يمكنك الآن التعديل.")
-                else:
-                    st.error("لم يتم العثور على المندوب.")
-                    st.session_state['search_result_id'] = None
-        
-        selected_id = st.session_state['search_result_id']
-        
-        if selected_id:
-            conn = get_connection()
-            # استخدام query لجلب البيانات (مع تعديل get_driver_info لتجنب الخطأ)
-            query = text("SELECT name, bike_plate, whatsapp, notes, is_active FROM drivers WHERE driver_id=:id")
-            # استخدام query مباشرة هنا لا يسبب خطأ Unhashable لأن params هو قاموس بسيط
-            info_df = conn.query(query, params={"id": selected_id}, ttl="0") 
-            
-            if not info_df.empty:
-                info_db = info_df.iloc[0].tolist()
-                current_name = info_db[0]
-                st.markdown(f"**بيانات المندوب الحالي: {current_name}**")
-                
-                with st.form("edit_driver_form"):
-                    col1_edit, col2_edit = st.columns(2)
-                    with col1_edit:
-                        edit_name = st.text_input("الاسم", value=current_name if current_name is not None else "")
-                        edit_bike_plate = st.text_input("رقم لوحة الدراجة", value=info_db[1] if info_db[1] else "")
-                        edit_whatsapp = st.text_input("رقم الواتساب", value=info_db[2] if info_db[2] else "")
-                    with col2_edit:
-                        edit_notes = st.text_area("ملاحظات إضافية", value=info_db[3] if info_db[3] else "")
-                        edit_is_active = st.checkbox("حساب مفعل؟", value=info_db[4] if info_db[4] is not None else False, help="عطّل لمنع إجراء أي عمليات.")
-                    
-                    submitted_edit = st.form_submit_button("حفظ التعديلات", type="primary")
-                    if submitted_edit:
-                        update_driver_details(selected_id, edit_name, edit_bike_plate, edit_whatsapp, edit_notes, edit_is_active)
-                        # clear cache for driver info to fetch updated data immediately
-                        get_driver_info.clear() 
-                        st.session_state['search_result_id'] = None 
-                        st.rerun()
-            else:
-                st.error("حدث خطأ في جلب بيانات المندوب للتعديل.")
-        else:
-            st.info("يرجى استخدام شريط البحث أعلاه لتحديد المندوب المراد تعديله.")
-
-    with tab_view:
-        st.subheader("عرض بيانات جميع المندوبين")
-        all_details = get_all_drivers_details()
-        if not all_details.empty:
-            st.dataframe(all_details, use_container_width=True)
-        else:
-            st.info("لا توجد بيانات لعرضها.")
+    st.header("إدارة بيانات المندوبين")
+    tab_add, tab_import, tab_edit, tab_view = st.tabs(["إضافة مندوب", "استيراد من ملف", "تعديل بيانات", "عرض الكل"])
+    
+    with tab_add:
+        st.subheader("تسجيل مندوب جديد")
+        with st.form("new_driver_form"):
+            col1_add, col2_add = st.columns(2)
+            with col1_add:
+                new_driver_id = st.text_input("ترقيم المندوب (ID)", help="يجب أن يكون رقماً فريداً أو كوداً مميزاً")
+                new_name = st.text_input("اسم المندوب الكامل")
+                new_bike_plate = st.text_input("رقم لوحة الدراجة")
+            with col2_add:
+                new_whatsapp = st.text_input("رقم الواتساب (للتواصل)")
+                new_notes = st.text_area("ملاحظات إضافية")
+                new_is_active = st.checkbox("حساب مفعل؟", value=True, help="عطّل هذا الخيار لمنع المندوب من إجراء عمليات توصيل أو شحن.")
+                branch_codes = list(get_branches())
+                default_branch = current_branch() or DEFAULT_BRANCH
+                new_branch = st.selectbox("الفرع", branch_codes, format_func=branch_name,
+                                          index=branch_codes.index(default_branch) if default_branch in branch_codes else 0)
+            
+            submitted = st.form_submit_button("إضافة المندوب", type="primary")
+            if submitted:
+                if new_driver_id and new_name:
+                    add_driver(new_driver_id, new_name, new_bike_plate, new_whatsapp, new_notes, new_is_active, new_branch)
+                    st.rerun()
+                else:
+                    st.error("يرجى إدخال ترقيم المندوب والاسم على الأقل.")
+
+    # 🆕 استيراد عدد كبير من المندوبين دفعة واحدة
+    with tab_import:
+        st.subheader("استيراد المندوبين من ملف")
+        st.markdown(
+            "الأعمدة: `driver_id, name` (مطلوبة) و `bike_plate, whatsapp, notes, is_active, branch` (اختيارية)، "
+            "ويمكن استخدام العناوين العربية (الترقيم، الاسم، رقم اللوحة، واتساب، ملاحظات، الحالة، الفرع). "
+            f"المندوب الجديد دون فرع يُضاف إلى: {branch_name(current_branch() or DEFAULT_BRANCH)}. "
+            "المندوب الموجود بنفس الترقيم تُحدّث بياناته (الخلية الفارغة تُبقي القيمة الحالية) ولا يتغير رصيده."
+        )
+        st.download_button("⬇️ تحميل قالب CSV", data=TEMPLATE_CSV.encode("utf-8-sig"),
+                           file_name="قالب_المندوبين.csv", mime="text/csv", key="import_template")
+        import_types = ["csv", "xlsx"] if EXCEL_AVAILABLE else ["csv"]
+        import_file = st.file_uploader("ملف المندوبين (CSV بترميز UTF-8 أو Excel)", type=import_types, key="import_file")
+        if import_file is not None and st.button("استيراد المندوبين", key="import_button", type="primary"):
+            try:
+                with st.spinner("جاري الاستيراد..."):
+                    report = import_drivers(import_file, import_file.name, default_branch=current_branch())
+            except ValueError as e:
+                st.error(str(e))
+                play_sound("error.mp3")
+            else:
+                st.success(f"تمت إضافة {report['inserted']} مندوب وتحديث {report['updated']} مندوب.")
+                if report["rejected"]:
+                    st.error(f"تم رفض {len(report['rejected'])} صف:")
+                    st.dataframe(
+                        pd.DataFrame(report["rejected"]).rename(columns={"row": "السطر", "driver_id": "الترقيم", "reason": "السبب"}),
+                        use_container_width=True, hide_index=True,
+                    )
+                    play_sound("error.mp3")
+                else:
+                    play_sound("success.mp3")
+
+    with tab_edit:
+        st.subheader("تعديل بيانات مندوب حالي")
+        
+        col_search_edit, col_button_edit = st.columns([3, 1])
+        with col_search_edit:
+            search_term_edit = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم للتعديل", key="search_edit_input")
+        with col_button_edit:
+            if st.button("بحث وتحديد", key="search_edit_btn", type="primary"):
+                driver_data = find_driver(search_term_edit, "edit_matches")
+                if driver_data:
+                    st.success(f"تم تحديد المندوب: {driver_data['name']}. يمكنك الآن التعديل.")
+                else:
+                    st.error("لم يتم العثور على المندوب.")
+        show_search_matches("edit_matches")
+        
+        selected_id = st.session_state['search_result_id']
+        
+        if selected_id:
+            details = get_repository().get_driver_details(selected_id)
+            
+            if details:
+                current_name = details['name']
+                st.markdown(f"**بيانات المندوب الحالي: {current_name}**")
+                
+                with st.form("edit_driver_form"):
+                    col1_edit, col2_edit = st.columns(2)
+                    with col1_edit:
+                        edit_name = st.text_input("الاسم", value=current_name if current_name is not None else "")
+                        edit_bike_plate = st.text_input("رقم لوحة الدراجة", value=details['bike_plate'] or "")
+                        edit_whatsapp = st.text_input("رقم الواتساب", value=details['whatsapp'] or "")
+                    with col2_edit:
+                        edit_notes = st.text_area("ملاحظات إضافية", value=details['notes'] or "")
+                        edit_is_active = st.checkbox("حساب مفعل؟", value=details['is_active'], help="عطّل لمنع إجراء أي عمليات.")
+                        branch_codes = list(get_branches())
+                        edit_branch = st.selectbox("الفرع", branch_codes, format_func=branch_name,
+                                                   index=branch_codes.index(details['branch']) if details['branch'] in branch_codes else 0,
+                                                   help="الحركات السابقة تبقى في تقارير الفرع الذي سُجلت فيه.")
+                    
+                    submitted_edit = st.form_submit_button("حفظ التعديلات", type="primary")
+                    if submitted_edit:
+                        # update_driver_details تحذف هذا المندوب فقط من ذاكرة التخزين المؤقت
+                        update_driver_details(selected_id, edit_name, edit_bike_plate, edit_whatsapp, edit_notes, edit_is_active, edit_branch)
+                        st.session_state['search_result_id'] = None 
+                        st.rerun()
+            else:
+                st.error("حدث خطأ في جلب بيانات المندوب للتعديل.")
+        else:
+            st.info("يرجى استخدام شريط البحث أعلاه لتحديد المندوب المراد تعديله.")
+
+    with tab_view:
+        st.subheader("عرض بيانات جميع المندوبين")
+        drivers_table()
 
 # ----------------------------------------------------------------------------------
 # 5. التقارير وسجل العمليات (لم يتغير)
 # ----------------------------------------------------------------------------------
 elif current_menu == "التقارير وسجل العمليات":
-    st.header("سجل الحركات المالية والتقارير")
-    
-    report_type = st.radio("نوع التقرير", ["التقارير الإجمالية", "سجل جميع العمليات", "سجل مندوب معين"], horizontal=True)
-    
-    if report_type == "التقارير الإجمالية":
-        st.subheader("ملخص إجمالي للنظام")
-        total_balance, total_charged, total_deducted, total_deliveries = get_totals()
-        
-        col_total_bal, col_total_charged, col_total_deducted, col_total_deliveries = st.columns(4)
-        
-        with col_total_bal:
-            st.metric(label="مجموع الأرصدة الحالية للمندوبين", value=f"{total_balance:.2f} أوقية", delta_color="off")
-            st.caption("مجموع الرصيد الحالي الموجود في حسابات جميع المندوبين.")
-        
-        with col_total_charged:
-            st.metric(label="إجمالي المبالغ المشحونة", value=f"{total_charged:.2f} أوقية", delta_color="off")
-            st.caption("مجموع كل عمليات الشحن التي تمت منذ بدء النظام.")
-        
-        with col_total_deducted:
-            st.metric(label="إجمالي المبالغ المخصومة", value=f"{total_deducted:.2f} أوقية", delta_color="off")
-            st.caption("مجموع الخصومات التي تمت لتسجيل التوصيلات.")
-
-        with col_total_deliveries:
-            st.metric(label="عدد التوصيلات الإجمالي", value=f"{total_deliveries}", delta_color="off")
-            st.caption("مجموع عدد التوصيلات الناجحة المسجلة في النظام.")
-        
-    elif report_type == "سجل جميع العمليات":
-        st.subheader("جميع حركات الشحن والخصم")
-        df = get_history(driver_id=None)
-        if not df.empty:
-            st.dataframe(df, use_container_width=True)
-            csv = df.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="تحميل السجل كملف CSV",
-                data=csv,
-                file_name=f"سجل_العمليات_الكامل_{datetime.now().strftime('%Y%m%d')}.csv",
-                mime="text/csv",
-            )
-        else:
-            st.info("لا توجد حركات مسجلة بعد.")
-            
-    elif report_type == "سجل مندوب معين":
-        st.subheader("البحث وعرض سجل مندوب محدد")
-        
-        col_search_hist, col_button_hist = st.columns([3, 1])
-        with col_search_hist:
-            search_term_hist = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم", key="search_hist_input")
-        with col_button_hist:
-            if st.button("بحث وعرض السجل", key="search_hist_btn", type="primary"):
-                # search_driver يعمل الآن بالبحث الشامل
-                driver_data = search_driver(search_term_hist)
-                if driver_data:
-                    st.session_state['search_result_id'] = driver_data['driver_id']
-                    st.success(f"تم تحديد المندوب: {driver_data['name']}")
-                else:
-                    st.error("لم يتم العثور على المندوب.")
-                    st.session_state['search_result_id'] = None
-        
-        selected_id = st.session_state['search_result_id']
-        
-        if selected_id:
-            # استخدام search_driver للحصول على الاسم (يعمل الآن بشكل صحيح)
-            driver_name = search_driver(selected_id)['name'] 
-            st.markdown(f"**سجل حركات المندوب: {driver_name} (ID: {selected_id})**")
-            df = get_history(driver_id=selected_id)
-            
-            if not df.empty:
-                st.dataframe(df, use_container_width=True)
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="تحميل السجل كملف CSV",
-                    data=csv,
-                    file_name=f"سجل_المندوب_{selected_id}_{datetime.now().strftime('%Y%m%d')}.csv",
-                    mime="text/csv",
-                )
-            else:
-                st.info("لا توجد حركات مسجلة لهذا المندوب.")
-        else:
-            st.info("يرجى استخدام شريط البحث أعلاه لتحديد المندوب المطلوب.")
+    st.header("سجل الحركات المالية والتقارير")
+    if current_branch():
+        st.caption(f"الفرع: {branch_name(current_branch())}")
+    
+    report_type = st.radio("نوع التقرير", ["التقارير الإجمالية", "تقرير حسب الفترة", "سجل جميع العمليات", "سجل مندوب معين", "مطابقة الأرصدة"], horizontal=True)
+    
+    if report_type == "التقارير الإجمالية":
+        st.subheader("ملخص إجمالي للنظام")
+        total_balance, total_charged, total_deducted, total_deliveries = get_totals(current_branch())
+        
+        col_total_bal, col_total_charged, col_total_deducted, col_total_deliveries = st.columns(4)
+        
+        with col_total_bal:
+            st.metric(label="مجموع الأرصدة الحالية للمندوبين", value=f"{total_balance:.2f} أوقية", delta_color="off")
+            st.caption("مجموع الرصيد الحالي الموجود في حسابات جميع المندوبين.")
+        
+        with col_total_charged:
+            st.metric(label="إجمالي المبالغ المشحونة", value=f"{total_charged:.2f} أوقية", delta_color="off")
+            st.caption("مجموع كل عمليات الشحن التي تمت منذ بدء النظام.")
+        
+        with col_total_deducted:
+            st.metric(label="إجمالي المبالغ المخصومة", value=f"{total_deducted:.2f} أوقية", delta_color="off")
+            st.caption("مجموع الخصومات التي تمت لتسجيل التوصيلات.")
+
+        with col_total_deliveries:
+            st.metric(label="عدد التوصيلات الإجمالي", value=f"{total_deliveries}", delta_color="off")
+            st.caption("مجموع عدد التوصيلات الناجحة المسجلة في النظام.")
+        
+    # 🆕 تقرير فترة (يومي/أسبوعي/مخصص) من الملخص اليومي
+    elif report_type == "تقرير حسب الفترة":
+        st.subheader("تقرير التوصيلات والمبالغ خلال فترة")
+
+        col_period, col_group = st.columns(2)
+        with col_period:
+            preset = st.selectbox("الفترة", ["اليوم", "أمس", "هذا الأسبوع", "هذا الشهر", "فترة مخصصة"], key="period_preset")
+        with col_group:
+            group_by = st.selectbox("التجميع", ["حسب المندوب", "حسب اليوم", "حسب الأسبوع"], key="period_group")
+
+        custom = None
+        if preset == "فترة مخصصة":
+            today = datetime.now().date()
+            custom = st.date_input("من - إلى", value=(today - timedelta(days=6), today), key="period_custom")
+        date_from, date_to = period_range(preset, custom)
+
+        if date_from is None:
+            st.info("يرجى اختيار تاريخ البداية والنهاية.")
+        else:
+            deliveries, charged, deducted, active_drivers = get_period_totals(date_from, date_to, current_branch())
+            col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+            col_p1.metric("عدد التوصيلات", f"{deliveries}")
+            col_p2.metric("المبالغ المخصومة", f"{deducted:.2f} أوقية")
+            col_p3.metric("المبالغ المشحونة", f"{charged:.2f} أوقية")
+            col_p4.metric("مندوبون نشطون", f"{active_drivers}")
+            st.caption(f"من {date_from} إلى {date_to}")
+
+            report_df = get_period_report(date_from, date_to, {"حسب المندوب": "driver", "حسب اليوم": "day", "حسب الأسبوع": "week"}[group_by],
+                                          current_branch())
+            if report_df.empty:
+                st.info("لا توجد حركات في هذه الفترة.")
+            else:
+                st.dataframe(report_df, use_container_width=True, hide_index=True)
+                st.download_button(
+                    "⬇️ تحميل التقرير (CSV)",
+                    data=report_df.to_csv(index=False).encode("utf-8-sig"),
+                    file_name=f"تقرير_الفترة_{date_from}_{date_to}.csv",
+                    mime="text/csv",
+                    key="period_download",
+                )
+
+    elif report_type == "سجل جميع العمليات":
+        st.subheader("جميع حركات الشحن والخصم")
+        history_section("all_history", file_stem="سجل_العمليات_الكامل")
+            
+    elif report_type == "سجل مندوب معين":
+        st.subheader("البحث وعرض سجل مندوب محدد")
+        
+        col_search_hist, col_button_hist = st.columns([3, 1])
+        with col_search_hist:
+            search_term_hist = st.text_input("ابحث بالترقيم (ID) أو رقم الواتساب أو الاسم", key="search_hist_input")
+        with col_button_hist:
+            if st.button("بحث وعرض السجل", key="search_hist_btn", type="primary"):
+                driver_data = find_driver(search_term_hist, "hist_matches")
+                if driver_data:
+                    st.success(f"تم تحديد المندوب: {driver_data['name']}")
+                else:
+                    st.error("لم يتم العثور على المندوب.")
+        show_search_matches("hist_matches")
+        
+        selected_id = st.session_state['search_result_id']
+        
+        if selected_id:
+            # جلب الاسم بالترقيم المحدد مباشرة (وليس ببحث جديد قد يطابق مندوباً آخر)
+            driver_name = get_driver_info(selected_id)['name']
+            st.markdown(f"**سجل حركات المندوب: {driver_name} (ID: {selected_id})**")
+            history_section("driver_report_history", driver_id=selected_id, file_stem=f"سجل_المندوب_{selected_id}",
+                            empty_message="لا توجد حركات مسجلة لهذا المندوب.")
+        else:
+            st.info("يرجى استخدام شريط البحث أعلاه لتحديد المندوب المطلوب.")
+
+    # 🆕 مطابقة الأرصدة: رصيد آخر نقطة تحقق + الحركات بعدها = الرصيد الحالي
+    elif report_type == "مطابقة الأرصدة":
+        st.subheader("مطابقة أرصدة المندوبين مع السجل")
+        st.caption("كل تشغيل يفحص الحركات المضافة منذ المطابقة السابقة فقط. للتشغيل الليلي: python reconcile.py")
+        show_flash("reconcile_flash")
+        if st.button("تشغيل المطابقة الآن", key="reconcile_btn", type="primary"):
+            with st.spinner("جاري المطابقة..."):
+                result = reconcile_balances()
+            if result["mismatches"]:
+                st.error(f"{len(result['mismatches'])} مندوب رصيده لا يطابق السجل.")
+            else:
+                st.success(f"جميع الأرصدة مطابقة ({result['drivers']} مندوب، {result['transactions']} حركة جديدة).")
+            if result["resolved"]:
+                st.info(f"تم إغلاق {len(result['resolved'])} فرقاً سابقاً بعد تصحيح الرصيد.")
+
+        mismatches = get_balance_mismatches()
+        if mismatches.empty:
+            st.info("لا توجد فروقات مفتوحة.")
+        else:
+            st.markdown(f"**الفروقات المفتوحة ({len(mismatches)})**")
+            st.dataframe(mismatches, use_container_width=True, hide_index=True)
+            col_accept, col_accept_btn = st.columns([3, 1])
+            with col_accept:
+                accept_id = st.selectbox("المندوب", mismatches["الترقيم"].tolist(), key="accept_balance_id")
+            with col_accept_btn:
+                # بعد مراجعة الفرق: الرصيد الحالي يصبح نقطة التحقق الجديدة
+                if st.button("اعتماد الرصيد الحالي", key="accept_balance_btn"):
+                    balance = accept_balance(accept_id)
+                    flash("reconcile_flash", "success", f"تم اعتماد رصيد {accept_id}: {balance:.2f} أوقية")
+                    st.rerun()
 
 
 # ----------------------------------------------------------------------------------
 # 6. إعدادات التطبيق (الشعار) (لم يتغير)
 # ----------------------------------------------------------------------------------
 elif current_menu == "إعدادات التطبيق (الشعار)":
-    st.header("تغيير شعار الشركة")
-    st.markdown("يمكنك رفع ملف صورة جديد (PNG أو JPG) ليحل محل الشعار الحالي في الواجهة الجانبية.")
-    
-    if os.path.exists(IMAGE_PATH):
-        st.image(IMAGE_PATH, caption='الشعار الحالي', width=200)
-    else:
-        st.info("لا يوجد شعار حالي. يرجى رفع شعار جديد.")
-        
-    uploaded_file = st.file_uploader("اختر صورة الشعار (PNG أو JPG)", type=["png", "jpg", "jpeg"])
-    
-    if uploaded_file is not None:
-        image_bytes = uploaded_file.read()
-        
-        try:
-            with open(IMAGE_PATH, "wb") as f:
-                f.write(image_bytes)
-            
-            st.success("✅ تم رفع وحفظ الشعار الجديد بنجاح!")
-            st.rerun() 
-
-        except Exception as e:
-            st.error(f"حدث خطأ أثناء حفظ الملف: {e}")
\ No newline at end of file
+    st.header("تغيير شعار الشركة")
+    st.markdown("يمكنك رفع ملف صورة جديد (PNG أو JPG) ليحل محل الشعار الحالي في الواجهة الجانبية.")
+    
+    show_flash("logo_flash")
+    if show_logo(st, width="200px"):
+        st.caption("الشعار الحالي")
+    else:
+        st.info("لا يوجد شعار حالي. يرجى رفع شعار جديد.")
+        
+    uploaded_file = st.file_uploader("اختر صورة الشعار (PNG أو JPG)", type=["png", "jpg", "jpeg"])
+    
+    # الملف يبقى في أداة الرفع بعد إعادة التشغيل، فنحفظه مرة واحدة فقط
+    if uploaded_file is not None and st.session_state.get("saved_logo_id") != uploaded_file.file_id:
+        image_bytes = uploaded_file.read()
+        
+        try:
+            # الرابط الجديد (بصمة مختلفة) يجعل كل المتصفحات تحمّل الشعار الجديد
+            get_assets().save(LOGO_FILE, image_bytes)
+            st.session_state["saved_logo_id"] = uploaded_file.file_id
+            flash("logo_flash", "success", "✅ تم رفع وحفظ الشعار الجديد بنجاح!")
+            st.rerun() 
+
+        except Exception as e:
+            st.error(f"حدث خطأ أثناء حفظ الملف: {e}")
+
+    # 🆕 صيانة قاعدة البيانات
+    st.divider()
+    st.header("صيانة قاعدة البيانات")
+    st.markdown("ربط الحركات المسجلة قبل إضافة عمود الترقيم (driver_id) بالمندوبين. يتم ذلك تلقائياً عند ترقية قاعدة البيانات؛ "
+                "الزر لإعادة التشغيل يدوياً (مثلاً بعد إضافة مندوب قديم) ويمكن تكراره بأمان.")
+    if st.button("ربط الحركات القديمة بالمندوبين", key="backfill_btn"):
+        with st.spinner("جاري ربط الحركات..."):
+            linked = backfill_transaction_driver_ids()
+            # الحركات المربوطة حديثاً لم تكن محسوبة في الملخص
+            if linked:
+                rebuild_summary()
+        st.success(f"تم ربط {linked} حركة بالمندوبين.")
+
+    st.markdown("إعادة بناء جداول الملخص (التقارير الإجمالية والتقارير اليومية وعدد التوصيلات) من السجل الكامل والتحقق من الفروقات.")
+    if st.button("إعادة بناء الملخص", key="rebuild_summary_btn"):
+        with st.spinner("جاري إعادة الحساب..."):
+            report = rebuild_summary()
+        if report["drift"]:
+            st.warning(f"تم تصحيح {len(report['drift'])} فرقاً في الملخص.")
+            st.dataframe(pd.DataFrame(report["drift"]), use_container_width=True)
+        else:
+            st.success(f"الملخص مطابق للسجل ({report['drivers']} مندوب).")
+        if report["unlinked_transactions"]:
+            st.info(f"{report['unlinked_transactions']} حركة غير مرتبطة بمندوب لا تدخل في الملخص.")
+
+    # 🆕 الفروع ومبلغ خصم التوصيلة في كل فرع
+    st.divider()
+    st.header("الفروع")
+    st.markdown("مبلغ الخصم الجديد يسري على التوصيلات التالية فقط. لإضافة فرع أدخل رمزاً جديداً، ولتعديل فرع أدخل رمزه الحالي.")
+    show_flash("branch_flash")
+    st.dataframe(
+        pd.DataFrame(list(get_branches().values())).rename(columns={"code": "الرمز", "name": "الاسم", "deduction_amount": "مبلغ خصم التوصيلة"}),
+        use_container_width=True, hide_index=True,
+    )
+    with st.form("branch_form"):
+        col_code, col_name, col_amount = st.columns(3)
+        with col_code:
+            branch_code = st.text_input("رمز الفرع", help="حروف لاتينية وأرقام، مثل north")
+        with col_name:
+            new_branch_name = st.text_input("اسم الفرع")
+        with col_amount:
+            branch_amount = st.number_input("مبلغ خصم التوصيلة (أوقية)", min_value=0.0, value=DEFAULT_DEDUCTION_AMOUNT, step=1.0)
+        if st.form_submit_button("حفظ الفرع", type="primary"):
+            if branch_code.strip() and new_branch_name.strip():
+                save_branch(branch_code.strip(), new_branch_name.strip(), branch_amount)
+                flash("branch_flash", "success", f"تم حفظ الفرع {new_branch_name.strip()} (خصم التوصيلة {branch_amount:.2f} أوقية).")
+                st.rerun()
+            else:
+                st.error("يرجى إدخال رمز الفرع واسمه.")
+
+    with st.expander("إصدارات مخطط قاعدة البيانات (الترحيلات المطبقة)"):
+        st.dataframe(
+            pd.DataFrame(get_repository().applied_migrations(), columns=["الإصدار", "الوصف", "تاريخ التطبيق"]),
+            use_container_width=True, hide_index=True,
+        )
+
+# ----------------------------------------------------------------------------------
+# 7. مراقبة الأداء
+# ----------------------------------------------------------------------------------
+elif current_menu == "مراقبة الأداء":
+    st.header("مراقبة الأداء")
+    snapshot = get_metrics().snapshot()
+    st.caption(
+        f"يتم قياس {snapshot['sample_rate']:.0%} من عمليات إعادة تشغيل الصفحات "
+        f"منذ {timedelta(seconds=int(snapshot['uptime_seconds']))}. الأزمنة بالمللي ثانية."
+    )
+
+    cache_stats = get_driver_cache().stats()
+    recent = snapshot["recent"]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("إعادات التشغيل المقاسة", sum(r["count"] for r in snapshot["reruns"]))
+    col2.metric("متوسط الاستعلامات لكل إعادة تشغيل", f"{sum(r['queries'] for r in recent) / len(recent):.1f}" if recent else "-")
+    col3.metric("نسبة الإصابة في ذاكرة المندوبين", f"{cache_stats['hit_rate']:.0%}")
+
+    st.subheader("زمن الصفحات")
+    pages = metrics_table(snapshot["reruns"], "الصفحة")
+    if not pages.empty:
+        queries = metrics_table(snapshot["rerun_queries"], "الصفحة", unit=1)
+        pages["استعلامات (متوسط)"] = queries["المتوسط"].values
+        pages["استعلامات (p99)"] = queries["p99"].values
+        st.dataframe(pages, use_container_width=True, hide_index=True)
+    else:
+        st.info("لا توجد قياسات بعد.")
+
+    st.subheader("دوال البيانات")
+    st.dataframe(metrics_table(snapshot["operations"], "الدالة"), use_container_width=True, hide_index=True)
+
+    st.subheader("استعلامات SQL حسب النوع")
+    st.dataframe(metrics_table(snapshot["queries"], "العبارة"), use_container_width=True, hide_index=True)
+
+    if recent:
+        st.subheader("آخر عمليات إعادة التشغيل")
+        recent_df = pd.DataFrame(recent[::-1])
+        recent_df["seconds"] = (recent_df["seconds"] * 1000).round(1)
+        recent_df["at"] = pd.to_datetime(recent_df["at"], unit="s").dt.strftime("%H:%M:%S")
+        st.dataframe(
+            recent_df.rename(columns={"page": "الصفحة", "seconds": "الزمن", "queries": "الاستعلامات", "at": "التوقيت"}),
+            use_container_width=True, hide_index=True,
+        )
+
+    st.subheader("الذاكرة المؤقتة")
+    st.dataframe(pd.DataFrame([{"الذاكرة": "المندوبون", **cache_stats}]), use_container_width=True, hide_index=True)
+
+    pool_stats = get_repository().storage.pool_stats()
+    if pool_stats:
+        st.subheader("مجمع اتصالات قاعدة البيانات")
+        col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+        col_p1.metric("اتصالات مستخدمة", f"{pool_stats['checked_out']} / {pool_stats['size'] + pool_stats['max_overflow']}")
+        col_p2.metric("اتصالات إضافية (overflow)", pool_stats["overflow"])
+        col_p3.metric("زمن الانتظار (متوسط / أقصى)", f"{pool_stats['wait_mean_ms']:.2f} / {pool_stats['wait_max_ms']:.0f} ms")
+        col_p4.metric("انتهاء مهلة الانتظار", pool_stats["timeouts"])
+
+    router = get_repository().storage.router
+    if router is not None:
+        st.subheader("نسخة القراءة (replica)")
+        replica_stats = router.stats()
+        col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+        col_r1.metric("الحالة", "متاحة" if replica_stats["available"] else "غير متاحة")
+        col_r2.metric("التأخر", f"{replica_stats['lag_seconds']:.1f} ث" if replica_stats["lag_seconds"] is not None else "-")
+        col_r3.metric("قراءات النسخة / الأساسية", f"{replica_stats['replica_reads']} / {replica_stats['primary_reads']}")
+        col_r4.metric("الرجوع للأساسية بعد خطأ", replica_stats["fallbacks"])
+        if replica_stats["last_error"]:
+            st.caption(f"آخر خطأ: {replica_stats['last_error']}")
+
+    st.subheader("متابعة الحركات (واجهة المندوب)")
+    feed = started_feeds().get("change_feed")
+    if feed is None:
+        st.caption("لم تبدأ المتابعة بعد في هذه العملية (تبدأ عند أول دخول لمندوب).")
+    else:
+        feed_stats = feed.stats()
+        col_f1, col_f2, col_f3, col_f4 = st.columns(4)
+        col_f1.metric("الطريقة", "LISTEN/NOTIFY" if feed_stats["listening"] else "فحص دوري")
+        col_f2.metric("فحوص السجل", feed_stats["scans"])
+        col_f3.metric("الإشعارات", feed_stats["notifications"])
+        col_f4.metric("الأخطاء", feed_stats["errors"])
+        if feed_stats["last_error"]:
+            st.caption(f"آخر خطأ: {feed_stats['last_error']}")
+
+    if WRITE_QUEUE_ENABLED:
+        st.subheader("طابور الكتابة")
+        queue_stats = get_write_queue().stats()
+        col_q1, col_q2, col_q3 = st.columns(3)
+        col_q1.metric("في الانتظار", queue_stats["pending"])
+        col_q2.metric("عدد الدفعات (commit)", queue_stats["batches"])
+        col_q3.metric("متوسط العمليات في الدفعة", f"{queue_stats['avg_batch']:.1f}")
+
+    with st.expander("القياسات بصيغة Prometheus"):
+        prometheus_text = get_metrics().prometheus(cache_gauges() + pool_gauges() + replica_gauges() + change_feed_gauges() + write_queue_gauges())
+        st.code(prometheus_text, language="text")
+        st.download_button("تحميل metrics.prom", prometheus_text, file_name="metrics.prom", mime="text/plain")
+        if METRICS_FILE:
+            st.caption(f"يُكتب الملف تلقائياً كل {METRICS_FILE_INTERVAL} ثانية على الأقل في: {METRICS_FILE}")
+
+# 🆕 نهاية إعادة التشغيل: تسجيل زمن الصفحة وعدد استعلاماتها
+get_metrics().end_rerun()
+if METRICS_FILE:
+    get_metrics().write_prometheus(METRICS_FILE, cache_gauges() + pool_gauges() + replica_gauges() + change_feed_gauges() + write_queue_gauges(),
+                                   min_interval=METRICS_FILE_INTERVAL)
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""ملفات الواجهة الثابتة (الأصوات والشعار) في مجلد static/.
+
+يقدمها Streamlit نفسه على الرابط app/static/<الملف> (server.enableStaticServing في .streamlit/config.toml)،
+فيحمّلها المتصفح مرة ويعيد استخدامها بدلاً من إرسالها داخل الصفحة (data URI) مع كل عملية.
+كل رابط يحمل بصمة المحتوى (?v=...) تُحسب مرة واحدة لكل عملية، وتتغير عند استبدال الملف (save).
+"""
+import hashlib
+import os
+import threading
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_URL = "app/static"
+
+
+class StaticAssets:
+    """روابط ملفات static/ مع بصماتها؛ مشترك بين كل الجلسات داخل العملية."""
+
+    def __init__(self, directory=STATIC_DIR, base_url=STATIC_URL):
+        self.directory = directory
+        self.base_url = base_url
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        return self._version(name) is not None
+
+    def url(self, name):
+        """رابط الملف مع بصمته، أو None إذا لم يوجد."""
+        version = self._version(name)
+        return f"{self.base_url}/{name}?v={version}" if version else None
+
+    def save(self, name, data):
+        """يستبدل الملف (ملف مؤقت ثم os.replace، فلا يُقدَّم نصف ملف) ويحدّث بصمته."""
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path(name) + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path(name))
+        self.invalidate(name)
+
+    def invalidate(self, name=None):
+        """يعيد حساب بصمة الملف (أو كل الملفات) عند الطلب التالي."""
+        with self._lock:
+            if name is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(name, None)
+
+    def _version(self, name):
+        with self._lock:
+            if name not in self._versions:
+                self._versions[name] = self._fingerprint(name)
+            return self._versions[name]
+
+    def _fingerprint(self, name):
+        try:
+            with open(self.path(name), "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()[:12]
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,86 @@
+"""ذاكرة تخزين مؤقت محدودة الحجم (LRU) تعرف متى تتغير البيانات.
+
+كل كتابة تحذف المفتاح المتأثر فقط، و clear() ترفع رقم الحقبة (epoch) فتبطل كل ما خُزن قبلها.
+أي قراءة بدأت قبل الكتابة (أو قبل clear) لا تُخزن نتيجتها القديمة.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionedLRUCache:
+    """max_size: أقصى عدد من المفاتيح. ttl: عمر القيمة بالثواني (None = بلا انتهاء)،
+    مفيد عند وجود أكثر من عملية تكتب على نفس قاعدة البيانات."""
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (epoch, stored_at, value)
+        self._epoch = 0                # يرتفع مع كل clear()
+        self._clock = 0                # يرتفع مع كل invalidate()
+        # key -> قيمة _clock عند آخر invalidate، فقط أثناء وجود تحميل جارٍ (تُفرغ حين لا يبقى تحميل)
+        self._invalidated = {}
+        self._loading = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """يعيد القيمة من الذاكرة أو يحمّلها بـ loader(key) ويخزنها."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self._epoch and not self._expired(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            epoch, started = self._epoch, self._clock
+            self._loading += 1
+
+        loaded = False
+        try:
+            value = loader(key)
+            loaded = True
+        finally:
+            with self._lock:
+                # لا نخزن النتيجة إذا حدثت كتابة على نفس المفتاح أو clear() أثناء التحميل
+                if loaded and self._epoch == epoch and self._invalidated.get(key, 0) <= started:
+                    self._entries[key] = (epoch, time.monotonic(), value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+                self._loading -= 1
+                if not self._loading:
+                    self._invalidated.clear()
+        return value
+
+    def invalidate(self, key):
+        """يُستدعى بعد كل كتابة: يحذف المفتاح من الذاكرة ويمنع تخزين تحميل جارٍ له."""
+        with self._lock:
+            self._clock += 1
+            if self._loading:
+                self._invalidated[key] = self._clock
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """يحذف كل المفاتيح، ويمنع تخزين أي تحميل بدأ قبله (مثلاً بعد استيراد المندوبين)."""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[1] > self.ttl
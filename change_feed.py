@@ -0,0 +1,139 @@
+"""متابعة الحركات الجديدة لكل مندوب (change feed) دون أن تستعلم كل جلسة عن السجل.
+
+خيط واحد لكل عملية (process) يحفظ لكل مندوب علامة (watermark): أعلى id في transactions سُجل له.
+الجلسات تقارن العلامة بآخر id عرضته، ولا تقرأ من قاعدة البيانات إلا عند تقدمها،
+وتقرأ حينها الحركات الأحدث من ذلك id فقط (انظر driver_live_panel في app.py).
+
+- PostgreSQL: كل commit فيه حركات يرسل NOTIFY (Storage.notify_change)، والخيط ينتظر بـ LISTEN على اتصال خاص به
+  ثم يقرأ الحركات الجديدة. الفحص الدوري كل fallback_interval يبقى احتياطاً (مثلاً خلف PgBouncer حيث لا يصل LISTEN).
+- SQLite: الخيط يفحص السجل كل poll_interval.
+
+في الحالتين الفحص استعلام واحد على المفتاح الأساسي لكل العملية مهما كان عدد الجلسات المفتوحة.
+id الحركة نفسه هو العلامة، فلا يحتاج ذلك جدولاً إضافياً يُحدَّث مع كل عملية.
+"""
+import select
+import threading
+
+from sqlalchemy import text
+
+from storage import CHANGE_CHANNEL
+
+POLL_INTERVAL = 2.0         # ثوانٍ بين فحصين للسجل (SQLite)
+FALLBACK_INTERVAL = 15.0    # ثوانٍ: أقصى انتظار لإشعار قبل فحص السجل (PostgreSQL)
+MIN_INTERVAL = 0.5          # ثوانٍ: أقل فاصل بين فحصين عند تتابع الإشعارات
+# حركة بـ id أصغر قد تُكمل commit بعد حركة أحدث منها لمندوب آخر، فيُعاد فحص آخر OVERLAP_IDS حركة.
+# حركات المندوب الواحد تأخذ أرقامها بترتيب commit لأن قفل صفه يسبق الإدراج.
+OVERLAP_IDS = 1000
+
+CHANGES_SQL = text("""
+    SELECT driver_id, MAX(id) FROM transactions
+    WHERE id > :after AND driver_id IS NOT NULL
+    GROUP BY driver_id
+""")
+
+
+class ChangeFeed:
+    """storage: Storage الأساسية (وليس نسخة القراءة)."""
+
+    def __init__(self, storage, poll_interval=POLL_INTERVAL, fallback_interval=FALLBACK_INTERVAL,
+                 min_interval=MIN_INTERVAL, overlap=OVERLAP_IDS):
+        self.storage = storage
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        self.min_interval = min_interval
+        self.overlap = overlap
+        self._watermarks = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listener = None
+        self.scans = 0
+        self.notifications = 0
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                with self.storage.session as s:
+                    self._cursor = s.execute(text("SELECT COALESCE(MAX(id), 0) FROM transactions")).scalar()
+                self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                self._thread.start()
+        return self
+
+    def close(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def watermark(self, driver_id):
+        """أعلى id حركة للمندوب منذ بدء الخيط (0 إذا لم تُسجل له حركة بعدها)."""
+        return self._watermarks.get(str(driver_id), 0)
+
+    def stats(self):
+        return {
+            "cursor": self._cursor,
+            "drivers": len(self._watermarks),
+            "scans": self.scans,
+            "notifications": self.notifications,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "listening": self._listener is not None,
+        }
+
+    # --- الخيط ---
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.storage.is_sqlite:
+                    self._stop.wait(self.poll_interval)
+                else:
+                    self._wait_for_notify()
+                self._scan()
+                self._stop.wait(self.min_interval)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = repr(e)[:200]
+                self._close_listener()
+                self._stop.wait(self.poll_interval)
+        self._close_listener()
+
+    def _scan(self):
+        with self.storage.session as s:
+            rows = s.execute(CHANGES_SQL, {"after": max(self._cursor - self.overlap, 0)}).fetchall()
+        self.scans += 1
+        if not rows:
+            return
+        with self._lock:
+            for driver_id, last_id in rows:
+                if last_id > self._watermarks.get(driver_id, 0):
+                    self._watermarks[driver_id] = last_id
+            self._cursor = max(self._cursor, max(row[1] for row in rows))
+
+    def _wait_for_notify(self):
+        """ينتظر إشعاراً على قناة CHANGE_CHANNEL أو انتهاء fallback_interval."""
+        if self._listener is None:
+            conn = self.storage.engine.raw_connection()
+            dbapi_conn = conn.driver_connection
+            # اتصال دائم خارج المجمع حتى لا ينقص عدد اتصالات الجلسات
+            conn.detach()
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANGE_CHANNEL}")
+            self._listener = dbapi_conn
+        dbapi_conn = self._listener
+        if not dbapi_conn.notifies:
+            select.select([dbapi_conn], [], [], self.fallback_interval)
+            dbapi_conn.poll()
+        self.notifications += len(dbapi_conn.notifies)
+        dbapi_conn.notifies.clear()
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
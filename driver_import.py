@@ -0,0 +1,155 @@
+"""استيراد المندوبين من ملف CSV أو Excel دفعة واحدة.
+
+يُقرأ الملف صفاً صفاً دون تحميله كاملاً، وتُفحص الصفوف ثم تُرسل الصالحة منها على دفعات
+إلى DeliveryRepository.upsert_drivers. تُكتب كل الدفعات في transaction واحدة (COPY في PostgreSQL).
+المندوب الموجود بنفس الترقيم تُحدّث بياناته ولا يتغير رصيده؛ الخلية الفارغة تُبقي القيمة الحالية.
+عمود الفرع اختياري: المندوب الجديد دونه يُضاف إلى فرع المستورد (default_branch).
+الصفوف المرفوضة تعود في تقرير بسطرها وسبب رفضها.
+"""
+import csv
+import io
+import re
+
+from search_index import ARABIC_DIGITS
+
+try:
+    import openpyxl
+except ImportError:  # Excel اختياري
+    openpyxl = None
+
+EXCEL_AVAILABLE = openpyxl is not None
+IMPORT_BATCH_SIZE = 1000
+
+# أسماء الأعمدة المقبولة في الملف (بعد الحذف من الطرفين والتحويل لحروف صغيرة) -> الحقل
+HEADER_ALIASES = {
+    "driver_id": "driver_id", "id": "driver_id", "الترقيم": "driver_id",
+    "name": "name", "الاسم": "name",
+    "bike_plate": "bike_plate", "plate": "bike_plate", "رقم اللوحة": "bike_plate",
+    "whatsapp": "whatsapp", "phone": "whatsapp", "واتساب": "whatsapp",
+    "notes": "notes", "ملاحظات": "notes",
+    "is_active": "is_active", "active": "is_active", "الحالة": "is_active",
+    "branch": "branch", "hub": "branch", "الفرع": "branch",
+}
+REQUIRED_FIELDS = ("driver_id", "name")
+ACTIVE_VALUES = {"1", "true", "yes", "نعم", "مفعل", "active"}
+INACTIVE_VALUES = {"0", "false", "no", "لا", "معطل", "inactive"}
+PHONE_SEPARATORS = re.compile(r"[\s\-+()]")
+
+# قالب الملف المعروض للتحميل في الواجهة
+TEMPLATE_CSV = "driver_id,name,bike_plate,whatsapp,notes,is_active,branch\r\n"
+
+
+def _cell_text(value):
+    # Excel يعيد الأرقام int أو float (الترقيم ورقم الهاتف)، و CSV يعيد نصاً
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _csv_rows(file):
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        yield from csv.reader(text)
+    finally:
+        text.detach()
+
+
+def _excel_rows(file):
+    if not EXCEL_AVAILABLE:
+        raise ValueError("استيراد ملفات Excel يتطلب تثبيت مكتبة openpyxl.")
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_records(file, filename):
+    """يعيد (الحقول الموجودة في الملف، مولّد صفوف (رقم السطر، dict)).
+
+    يرفع ValueError إذا نقص عمود مطلوب أو كان نوع الملف غير مدعوم.
+    """
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        rows = _excel_rows(file)
+    elif filename.lower().endswith(".csv"):
+        rows = _csv_rows(file)
+    else:
+        raise ValueError("نوع الملف غير مدعوم (CSV أو xlsx فقط).")
+    header = next(rows, None) or []
+    positions = {}
+    for i, title in enumerate(header):
+        field = HEADER_ALIASES.get(_cell_text(title).lower())
+        if field and field not in positions:
+            positions[field] = i
+    missing = [field for field in REQUIRED_FIELDS if field not in positions]
+    if missing:
+        raise ValueError(f"أعمدة مطلوبة غير موجودة في الملف: {', '.join(missing)}")
+
+    def records():
+        for line, row in enumerate(rows, start=2):
+            values = {field: _cell_text(row[i]) if i < len(row) else "" for field, i in positions.items()}
+            if any(values.values()):
+                yield line, values
+
+    return list(positions), records()
+
+
+def validate(values, branches=None):
+    """يعيد (الصف بعد التطبيع، سبب الرفض أو None). الحقل الفارغ أو الغائب يصبح None.
+
+    branches: رموز الفروع المعروفة (None = دون فحص الفرع).
+    """
+    if not values["driver_id"]:
+        return None, "الترقيم مفقود"
+    if not values["name"]:
+        return None, "الاسم مفقود"
+    row = {field: value or None for field, value in values.items()}
+    if row.get("whatsapp"):
+        row["whatsapp"] = PHONE_SEPARATORS.sub("", row["whatsapp"].translate(ARABIC_DIGITS))
+        if not row["whatsapp"].isdigit():
+            return None, "رقم الواتساب غير صالح"
+    if row.get("is_active"):
+        status = row["is_active"].lower()
+        if status in ACTIVE_VALUES:
+            row["is_active"] = True
+        elif status in INACTIVE_VALUES:
+            row["is_active"] = False
+        else:
+            return None, "قيمة الحالة غير معروفة"
+    if row.get("branch") and branches is not None and row["branch"] not in branches:
+        return None, "الفرع غير معروف"
+    return row, None
+
+
+def import_drivers(repo, file, filename, batch_size=IMPORT_BATCH_SIZE, default_branch=None):
+    """يستورد ملف المندوبين ويعيد dict فيه inserted و updated و rejected [{row, driver_id, reason}].
+
+    default_branch: فرع المندوبين الجدد الذين ليس لهم فرع في الملف (None = الفرع الرئيسي).
+    يرفع ValueError إذا كان الملف نفسه غير صالح (نوعه أو أعمدته).
+    """
+    fields, records = read_records(file, filename)
+    branches = {branch["code"] for branch in repo.list_branches()} if "branch" in fields else None
+    rejected = []
+    seen = {}
+
+    def batches():
+        batch = []
+        for line, values in records:
+            row, reason = validate(values, branches)
+            if row and row["driver_id"] in seen:
+                reason = f"الترقيم مكرر في الملف (السطر {seen[row['driver_id']]})"
+            if reason:
+                rejected.append({"row": line, "driver_id": values["driver_id"], "reason": reason})
+                continue
+            seen[row["driver_id"]] = line
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    inserted, updated = repo.upsert_drivers(batches(), default_branch)
+    return {"inserted": inserted, "updated": updated, "rejected": rejected}
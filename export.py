@@ -0,0 +1,82 @@
+"""تصدير السجل على دفعات دون تحميله كاملاً في الذاكرة.
+
+القراءة بمؤشر من جهة الخادم (stream_results) والكتابة التدريجية إلى ملف مؤقت،
+لذلك يبقى استهلاك الذاكرة ثابتاً مهما كان عدد الصفوف.
+"""
+import csv
+import io
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import text
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet اختياري
+    pa = None
+    pq = None
+
+PARQUET_AVAILABLE = pa is not None
+EXPORT_CHUNK_SIZE = 5000
+SPOOL_MAX_SIZE = 8 * 1024 * 1024  # الملفات الأكبر تُكتب على القرص بدلاً من الذاكرة
+UTF8_BOM = b"\xef\xbb\xbf"        # يحتاجه Excel لعرض العربية بشكل صحيح
+
+
+def stream_rows(engine, sql, params=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """يعيد الصفوف على دفعات (قوائم) بمؤشر من جهة الخادم."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(text(sql), params or {})
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+
+
+def write_csv(chunks, headers):
+    """يكتب الدفعات في ملف CSV مؤقت (UTF-8 مع BOM) ويعيده جاهزاً للقراءة من البداية."""
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    out.write(UTF8_BOM)
+    wrapper = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    writer = csv.writer(wrapper)
+    writer.writerow(headers)
+    for chunk in chunks:
+        writer.writerows(chunk)
+    wrapper.flush()
+    wrapper.detach()
+    out.seek(0)
+    return out
+
+
+def _as_datetime(value):
+    # SQLite يعيد التوقيت نصاً و PostgreSQL يعيده datetime
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _as_decimal(value):
+    # PostgreSQL يعيد المبالغ Decimal و SQLite يعيدها float
+    return value if value is None or isinstance(value, Decimal) else Decimal(str(round(value, 2)))
+
+
+def write_parquet(chunks, columns, compression="zstd"):
+    """يكتب الدفعات في ملف Parquet مضغوط.
+
+    columns: قائمة (الاسم، النوع) والنوع "text" أو "number" أو "money" (عشري بمنزلتين) أو "timestamp".
+    """
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError("تصدير Parquet يتطلب تثبيت مكتبة pyarrow.")
+    types = {"text": pa.string(), "number": pa.float64(), "money": pa.decimal128(14, 2), "timestamp": pa.timestamp("s")}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with pq.ParquetWriter(out, schema, compression=compression) as writer:
+        for chunk in chunks:
+            arrays = []
+            for i, (_, kind) in enumerate(columns):
+                values = [row[i] for row in chunk]
+                if kind == "timestamp":
+                    values = [_as_datetime(v) for v in values]
+                elif kind == "money":
+                    values = [_as_decimal(v) for v in values]
+                arrays.append(pa.array(values, type=schema.field(i).type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    out.seek(0)
+    return out
@@ -0,0 +1,369 @@
+"""اختبار تحميل لواجهة Streamlit (app.py) بعدة جلسات متزامنة على قاعدة محلية.
+
+يشغل app.py دون متصفح عبر streamlit.testing (AppTest)، كل جلسة بحالة session_state خاصة بها:
+- مشغل (operator): يبحث عن مندوب ثم يسجل توصيلة أو شحناً أو دفعة توصيلات.
+- مندوب (driver): يسجل الدخول ثم يتصفح رصيده وسجل حركاته.
+- مسؤول (admin): يفتح التقارير الإجمالية وتقرير الفترة والسجل الكامل ومطابقة الأرصدة.
+
+AppTest يستخدم كائن Runtime عاماً واحداً لكل عملية، فلا يمكن تشغيل نسختين منه معاً في خيطين.
+لذلك التزامن عبر عمليات (--processes): كل عملية خادم مستقل بذاكرته المؤقتة وطابور كتابته،
+وجلساتها (--sessions) تتناوب عليها كما تتناوب جلسات حقيقية على نفس الخادم.
+
+لكل إجراء: توزيع الزمن (p50/p95/p99، ويشمل كلفة AppTest نفسه في بناء الصفحة)، وعدد إعادات التشغيل (reruns) وعدد استعلامات SQL.
+في النهاية يتحقق من:
+- عدم ظهور أي استثناء في الصفحة.
+- مجموع الأرصدة = الرصيد الابتدائي + مجموع العمليات التي أكدتها الواجهة (لا تحديثات ضائعة).
+- عدم وجود رصيد سالب، ولا فروقات في جدول الملخص (rebuild_summary) ولا في مطابقة الأرصدة (reconcile_balances).
+
+    python load_harness.py --processes 4 --sessions 5 --actions 20 --mix operator=6,driver=3,admin=1
+يعيد رمز خروج 1 إذا فشل أي تحقق.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from sqlalchemy import text
+
+from benchmark import ensure_data, percentile
+from migrations import DEFAULT_DEDUCTION_AMOUNT
+from repository import DeliveryRepository, CHARGE_TYPE
+from storage import create_storage
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+ADMIN_KEY = "jak2831"
+DEDUCTION_AMOUNT = DEFAULT_DEDUCTION_AMOUNT  # كل مندوبي الاختبار في الفرع الرئيسي
+INITIAL_BALANCE = 60.0        # 4 توصيلات لكل مندوب، حتى تُختبر حالة الرصيد غير الكافي
+CHARGE_AMOUNT = 30.0
+BATCH_SIZE = 3
+RUN_TIMEOUT = 120             # ثوانٍ لكل تشغيل للسكربت
+DEFAULT_MIX = "operator=6,driver=3,admin=1"
+ROLES = ("operator", "driver", "admin")
+
+OPS_MENU = "واجهة العمليات (الإدارة)"
+REPORTS_MENU = "التقارير وسجل العمليات"
+REPORT_TYPES = {
+    "admin_totals": "التقارير الإجمالية",
+    "admin_period": "تقرير حسب الفترة",
+    "admin_all_history": "سجل جميع العمليات",
+    "admin_reconcile": "مطابقة الأرصدة",
+}
+BATCH_ACCEPTED = re.compile(r"تم تسجيل (\d+) توصيلة")
+
+
+def parse_mix(value):
+    """"operator=6,driver=3,admin=1" -> {"operator": 6.0, ...}"""
+    mix = {}
+    for part in value.split(","):
+        role, _, weight = part.partition("=")
+        role = role.strip()
+        if role not in ROLES:
+            raise argparse.ArgumentTypeError(f"دور غير معروف: {role} (المتاح: {', '.join(ROLES)})")
+        mix[role] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("يجب أن يكون لدور واحد على الأقل وزن أكبر من صفر")
+    return mix
+
+
+def by_label(elements, label):
+    return next(e for e in elements if e.label == label)
+
+
+class Counters:
+    """عدد إعادات التشغيل واستعلامات SQL داخل العملية (الجلسات تتناوب، فالفرق قبل/بعد كل إجراء يخصه وحده)."""
+
+    def __init__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        from metrics import Metrics
+
+        self.reruns = 0
+        self.queries = 0
+        event.listen(Engine, "after_cursor_execute", self._count_query)
+        start_rerun = Metrics.start_rerun
+
+        def counting_start_rerun(metrics, page=None):
+            self.reruns += 1
+            return start_rerun(metrics, page)
+        Metrics.start_rerun = counting_start_rerun
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def read(self):
+        return self.reruns, self.queries
+
+
+class Session:
+    """جلسة واحدة (متصفح واحد) بدور ثابت."""
+
+    def __init__(self, role, driver_ids, rng, counters):
+        from streamlit.testing.v1 import AppTest
+
+        self.role = role
+        self.driver_ids = driver_ids
+        self.rng = rng
+        self.counters = counters
+        self.at = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+        self.samples = []
+        self.errors = []
+        self.accepted_amount = 0.0
+
+    def run(self, action):
+        """تشغيل واحد للسكربت (بعد تغيير عناصر الإدخال) مع تسجيل الزمن والقياسات."""
+        reruns, queries = self.counters.read()
+        started = time.perf_counter()
+        try:
+            self.at.run()
+        except Exception as e:
+            self.errors.append(f"{action}: {e!r}"[:300])
+            return False
+        elapsed = time.perf_counter() - started
+        reruns_after, queries_after = self.counters.read()
+        self.samples.append((action, elapsed, reruns_after - reruns, queries_after - queries))
+        if self.at.exception:
+            self.errors.extend(f"{action}: {e.message}"[:300] for e in self.at.exception)
+            return False
+        return True
+
+    # --- الدخول ---
+    def open(self):
+        if self.role == "driver":
+            self.run("driver_open")
+            # زر الدخول يقرأ قيمة الحقل من التشغيل السابق (في المتصفح يعيد الخروج من الحقل التشغيل قبل النقر)
+            by_label(self.at.text_input, "أدخل ترقيمك (Driver ID)").input(self.rng.choice(self.driver_ids))
+            self.run("driver_input")
+            by_label(self.at.button, "تسجيل الدخول").click()
+            self.run("driver_login")
+            return
+        self.run(f"{self.role}_open")
+        self.at.sidebar.text_input[0].input(ADMIN_KEY)
+        by_label(self.at.sidebar.button, "دخول المسؤول").click()
+        self.run("admin_login")
+        self.at.sidebar.radio[0].set_value(OPS_MENU if self.role == "operator" else REPORTS_MENU)
+        self.run(f"{self.role}_page")
+
+    # --- الإجراءات ---
+    def step(self):
+        getattr(self, f"{self.role}_step")()
+
+    def operator_step(self):
+        self.at.text_input(key="search_op_input").input(self.rng.choice(self.driver_ids))
+        self.at.button(key="search_op_btn").click()
+        if not self.run("operator_search"):
+            return
+        kind = self.rng.random()
+        if kind < 0.6:
+            self.at.button(key="deduct_button").click()
+            action = "operator_delivery"
+        elif kind < 0.85:
+            self.at.number_input(key="charge_amount").set_value(CHARGE_AMOUNT)
+            self.at.button(key="charge_button").click()
+            action = "operator_charge"
+        else:
+            self.at.number_input(key="batch_count").set_value(BATCH_SIZE)
+            self.at.button(key="batch_button").click()
+            action = "operator_batch"
+        if self.run(action):
+            self.accepted_amount += self.confirmed_amount(action)
+
+    def confirmed_amount(self, action):
+        """المبلغ الذي أكدته رسالة الواجهة بعد العملية (0 إذا رُفضت)."""
+        messages = [m.value for m in self.at.success] + [m.value for m in self.at.error]
+        for message in messages:
+            if action == "operator_delivery" and message.startswith("تم تسجيل التوصيلة"):
+                return -DEDUCTION_AMOUNT
+            if action == "operator_charge" and message.startswith("تم الشحن بنجاح"):
+                return CHARGE_AMOUNT
+            if action == "operator_batch":
+                match = BATCH_ACCEPTED.search(message)
+                if match:
+                    return -DEDUCTION_AMOUNT * int(match.group(1))
+        return 0.0
+
+    def driver_step(self):
+        older = self.at.button(key="driver_history_older")
+        if self.rng.random() < 0.3 and not older.disabled:
+            older.click()
+            self.run("driver_history_older")
+        else:
+            self.run("driver_refresh")
+
+    def admin_step(self):
+        action = self.rng.choice(list(REPORT_TYPES))
+        by_label(self.at.radio, "نوع التقرير").set_value(REPORT_TYPES[action])
+        if not self.run(action):
+            return
+        if action == "admin_reconcile":
+            self.at.button(key="reconcile_btn").click()
+            self.run("admin_reconcile_run")
+
+
+def run_worker(n, url, driver_ids, roles, actions, seed, write_queue, barrier, results):
+    """عملية واحدة: تفتح جلساتها، تنتظر باقي العمليات، ثم تنفذ الإجراءات بالتناوب بين جلساتها."""
+    os.environ["DELIVERY_DB_URL"] = url
+    os.environ["DELIVERY_METRICS_SAMPLE_RATE"] = "1"
+    os.environ["DELIVERY_WRITE_QUEUE"] = "1" if write_queue else ""
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    rng = random.Random(seed + n)
+    sessions = []
+    try:
+        counters = Counters()
+        sessions = [Session(role, driver_ids, random.Random(rng.random()), counters) for role in roles]
+        for session in sessions:
+            session.open()
+            # أول تشغيل في العملية ينشئ المحرك والفهرس: خارج القياس
+            session.samples.clear()
+        barrier.wait()
+        started = time.time()
+        for _ in range(actions):
+            for session in sessions:
+                session.step()
+        finished = time.time()
+    except Exception as e:
+        # عملية متوقفة لا تترك الباقي في انتظار الحاجز
+        barrier.abort()
+        results.put({"errors": [f"process {n}: {e!r}"[:300]], "samples": [], "accepted_amount": 0.0})
+        return
+    results.put({
+        "started": started,
+        "finished": finished,
+        "samples": [sample for s in sessions for sample in s.samples],
+        "errors": [e for s in sessions for e in s.errors],
+        "accepted_amount": sum(s.accepted_amount for s in sessions),
+    })
+
+
+def run_sessions(url, driver_ids, processes, sessions, actions, mix, seed, write_queue):
+    """يعيد نتائج كل العمليات بعد انتهائها."""
+    rng = random.Random(seed)
+    roles = list(mix)
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(processes)
+    results = ctx.Queue()
+    workers = []
+    for n in range(processes):
+        worker_roles = rng.choices(roles, weights=[mix[r] for r in roles], k=sessions)
+        workers.append(ctx.Process(target=run_worker, args=(
+            n, url, driver_ids, worker_roles, actions, seed, write_queue, barrier, results)))
+    for w in workers:
+        w.start()
+    outputs = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+    failed = [w.exitcode for w in workers if w.exitcode]
+    if failed:
+        raise SystemExit(f"توقفت {len(failed)} عملية برمز خروج {failed}")
+    return outputs
+
+
+def prepare(repo, drivers, seed, log):
+    """أسطول بلا حركات ثم شحن ابتدائي لكل مندوب (حركة في السجل، حتى تبقى المطابقة صحيحة)."""
+    ensure_data(repo, drivers, 0, seed, log)
+    with repo.storage.session as s:
+        s.execute(text("UPDATE drivers SET is_active = :active"), {"active": True})
+        s.commit()
+    driver_ids = [row[0] for row in repo.load_search_rows()]
+    repo.apply_postings([{"driver_id": d, "amount": INITIAL_BALANCE, "type": CHARGE_TYPE} for d in driver_ids])
+    repo.reconcile_balances()
+    return driver_ids
+
+
+def summarize(outputs):
+    """الإحصاءات لكل إجراء من عينات كل العمليات."""
+    samples = defaultdict(list)
+    for output in outputs:
+        for action, seconds, reruns, queries in output["samples"]:
+            samples[action].append((seconds, reruns, queries))
+    actions = {}
+    for action, values in sorted(samples.items()):
+        timings = sorted(v[0] for v in values)
+        actions[action] = {
+            "count": len(values),
+            **{f"p{p}_ms": round(percentile(timings, p) * 1000, 2) for p in (50, 95, 99)},
+            "reruns_mean": round(sum(v[1] for v in values) / len(values), 2),
+            "queries_mean": round(sum(v[2] for v in values) / len(values), 2),
+            "queries_max": max(v[2] for v in values),
+        }
+    return actions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="اختبار تحميل لواجهة Streamlit بعدة جلسات متزامنة.")
+    parser.add_argument("--db", help="رابط SQLAlchemy لقاعدة فارغة (الافتراضي: ملف SQLite مؤقت)")
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=4, help="عمليات متزامنة (خوادم)")
+    parser.add_argument("--sessions", type=int, default=5, help="جلسات لكل عملية")
+    parser.add_argument("--actions", type=int, default=20, help="عدد الإجراءات لكل جلسة")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"أوزان الأدوار (الافتراضي: {DEFAULT_MIX})")
+    parser.add_argument("--write-queue", action="store_true", help="عمليات الرصيد عبر طابور الكتابة")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    workdir = None
+    url = args.db
+    if not url:
+        workdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(workdir.name, 'load.db')}"
+    repo = DeliveryRepository(create_storage(url))
+    failures = []
+    try:
+        driver_ids = prepare(repo, args.drivers, args.seed, log)
+        log(f"{args.processes} عملية × {args.sessions} جلسة × {args.actions} إجراء ({args.mix}) ...")
+        outputs = run_sessions(url, driver_ids, args.processes, args.sessions, args.actions,
+                               args.mix, args.seed, args.write_queue)
+
+        errors = [e for output in outputs for e in output["errors"]]
+        if errors:
+            failures.append(f"{len(errors)} خطأ في الجلسات: {errors[:3]}")
+        actions = summarize(outputs)
+        total = sum(a["count"] for a in actions.values())
+        finished = [o for o in outputs if "started" in o]
+        elapsed = max(o["finished"] for o in finished) - min(o["started"] for o in finished) if finished else 0.0
+        report = {
+            "processes": args.processes,
+            "sessions": args.processes * args.sessions,
+            "runs": total,
+            "seconds": round(elapsed, 2),
+            "runs_per_second": round(total / elapsed, 1) if elapsed else None,
+            "actions": actions,
+        }
+
+        accepted_amount = sum(o["accepted_amount"] for o in outputs)
+        with repo.storage.session as s:
+            balance_sum, negative = s.execute(text(
+                "SELECT COALESCE(SUM(balance), 0), SUM(CASE WHEN balance < 0 THEN 1 ELSE 0 END) FROM drivers"
+            )).one()
+        expected = INITIAL_BALANCE * len(driver_ids) + accepted_amount
+        report["balances"] = {"expected_sum": round(expected, 2), "actual_sum": round(float(balance_sum), 2)}
+        if abs(float(balance_sum) - expected) > 1e-6:
+            failures.append(f"مجموع الأرصدة {balance_sum} بدلاً من {expected} (عمليات ضائعة أو غير مؤكدة)")
+        if negative:
+            failures.append(f"{negative} مندوب برصيد سالب")
+        drift = repo.rebuild_summary()["drift"]
+        if drift:
+            failures.append(f"فروقات في جدول الملخص: {drift[:3]}")
+        mismatches = repo.reconcile_balances()["mismatches"]
+        if mismatches:
+            failures.append(f"{len(mismatches)} مندوب لا يطابق رصيده السجل: {mismatches[:3]}")
+        report["failures"] = failures
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        repo.storage.engine.dispose()
+        if workdir:
+            workdir.cleanup()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
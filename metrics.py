@@ -0,0 +1,217 @@
+"""قياس زمن دوال البيانات وعدد الاستعلامات في كل إعادة تشغيل (rerun) لواجهة Streamlit.
+
+- timed(name): مزخرف يقيس زمن الدالة.
+- instrument_engine(engine): يعد كل استعلام SQL ويقيس زمنه عبر أحداث SQLAlchemy.
+- start_rerun / end_rerun: زمن تنفيذ الصفحة كاملة وعدد الاستعلامات فيها.
+
+القياس بالعينة (sample_rate): إعادة التشغيل غير المختارة لا تسجل شيئاً، لذلك تبقى الكلفة مهملة.
+النتائج متاحة كـ dict (snapshot) أو بصيغة Prometheus النصية (prometheus / write_prometheus).
+"""
+import functools
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+from sqlalchemy import event
+
+METRIC_PREFIX = "captainsjak"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _Series:
+    """عداد ومجموع للأزمنة مع نافذة لآخر القيم لحساب النسب المئوية."""
+
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantiles(self):
+        values = sorted(self.samples)
+        if not values:
+            return {q: None for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class Metrics:
+    """مجمع القياسات؛ نسخة واحدة مشتركة بين كل الجلسات (st.cache_resource)."""
+
+    def __init__(self, sample_rate=1.0, window=1000, recent_reruns=50):
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operations = defaultdict(lambda: _Series(window))
+        self._queries = defaultdict(lambda: _Series(window))
+        self._reruns = defaultdict(lambda: _Series(window))
+        self._rerun_queries = defaultdict(lambda: _Series(window))
+        self.recent = deque(maxlen=recent_reruns)
+        self.started_at = time.time()
+        self._last_export = 0.0
+
+    # --- العينة ---
+    def _sampled(self):
+        rerun = getattr(self._local, "rerun", None)
+        if rerun is not None:
+            return rerun["sampled"]
+        # خارج إعادة التشغيل (مثل خيوط الخلفية): عينة لكل استدعاء
+        return random.random() < self.sample_rate
+
+    # --- إعادة التشغيل ---
+    def start_rerun(self, page=None):
+        """يُستدعى في بداية السكربت. إعادة التشغيل التي تتوقف بـ st.rerun أو st.stop لا تُسجل."""
+        self._local.rerun = {
+            "sampled": random.random() < self.sample_rate,
+            "page": page,
+            "started": time.perf_counter(),
+            "queries": 0,
+        }
+
+    def set_page(self, page):
+        rerun = getattr(self._local, "rerun", None)
+        if rerun is not None:
+            rerun["page"] = page
+
+    def end_rerun(self):
+        """يُستدعى في نهاية السكربت ويعيد (الزمن بالثواني، عدد الاستعلامات) أو None."""
+        rerun = getattr(self._local, "rerun", None)
+        self._local.rerun = None
+        if rerun is None or not rerun["sampled"]:
+            return None
+        elapsed = time.perf_counter() - rerun["started"]
+        page = rerun["page"] or "-"
+        with self._lock:
+            self._reruns[page].add(elapsed)
+            self._rerun_queries[page].add(rerun["queries"])
+            self.recent.append({"page": page, "seconds": elapsed, "queries": rerun["queries"], "at": time.time()})
+        return elapsed, rerun["queries"]
+
+    # --- دوال البيانات ---
+    def observe(self, name, seconds):
+        with self._lock:
+            self._operations[name].add(seconds)
+
+    def timed(self, name):
+        """مزخرف يقيس زمن الدالة تحت الاسم name (فقط في العينة المختارة)."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self._sampled():
+                    return fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    # --- الاستعلامات ---
+    def instrument_engine(self, engine):
+        """يسجل أحداث تنفيذ SQL على المحرك: العدد والزمن حسب نوع العبارة، والعدد لكل إعادة تشغيل."""
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before(conn, cursor, statement, parameters, context, executemany):
+            if self._sampled():
+                conn.info["metrics_started"] = time.perf_counter()
+            else:
+                conn.info.pop("metrics_started", None)
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info.pop("metrics_started", None)
+            if started is None:
+                return
+            elapsed = time.perf_counter() - started
+            kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+            with self._lock:
+                self._queries[kind].add(elapsed)
+            rerun = getattr(self._local, "rerun", None)
+            if rerun is not None:
+                rerun["queries"] += 1
+
+    # --- العرض ---
+    def snapshot(self):
+        """القياسات الحالية كقوائم من dict (للجداول في لوحة المسؤول)."""
+        def rows(series_map, key):
+            result = []
+            for name, series in sorted(series_map.items()):
+                q = series.quantiles()
+                result.append({
+                    key: name,
+                    "count": series.count,
+                    "mean": series.total / series.count if series.count else None,
+                    "p50": q[0.5], "p95": q[0.95], "p99": q[0.99],
+                })
+            return result
+
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "uptime_seconds": time.time() - self.started_at,
+                "operations": rows(self._operations, "operation"),
+                "queries": rows(self._queries, "statement"),
+                "reruns": rows(self._reruns, "page"),
+                "rerun_queries": rows(self._rerun_queries, "page"),
+                "recent": list(self.recent),
+            }
+
+    def prometheus(self, gauges=None):
+        """النص بصيغة Prometheus. gauges: قائمة (الاسم، التسميات dict، القيمة، الوصف) لقيم إضافية مثل نسب الذاكرة المؤقتة."""
+        lines = []
+
+        def summary(metric, help_text, series_map, label):
+            lines.append(f"# HELP {METRIC_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} summary")
+            for name, series in sorted(series_map.items()):
+                labels = f'{label}="{_escape(name)}"'
+                for q, value in series.quantiles().items():
+                    if value is not None:
+                        lines.append(f'{METRIC_PREFIX}_{metric}{{{labels},quantile="{q}"}} {value:.6g}')
+                lines.append(f"{METRIC_PREFIX}_{metric}_sum{{{labels}}} {series.total:.6g}")
+                lines.append(f"{METRIC_PREFIX}_{metric}_count{{{labels}}} {series.count}")
+
+        with self._lock:
+            summary("operation_seconds", "Data-access call latency.", self._operations, "operation")
+            summary("query_seconds", "SQL statement latency by statement kind.", self._queries, "statement")
+            summary("rerun_seconds", "Whole-script render time per page.", self._reruns, "page")
+            summary("rerun_queries", "SQL statements issued per rerun.", self._rerun_queries, "page")
+
+        lines.append(f"# HELP {METRIC_PREFIX}_metrics_sample_rate Fraction of reruns that are instrumented.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_metrics_sample_rate gauge")
+        lines.append(f"{METRIC_PREFIX}_metrics_sample_rate {self.sample_rate}")
+        declared = set()
+        for name, labels, value, help_text in gauges or []:
+            metric = f"{METRIC_PREFIX}_{name}"
+            if metric not in declared:
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} gauge")
+                declared.add(metric)
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{metric}{{{label_text}}} {value:.6g}" if label_text else f"{metric} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, gauges=None, min_interval=0.0):
+        """يكتب الملف بشكل ذري (لمجمّع node_exporter textfile مثلاً). يعيد False إذا لم يحن موعد الكتابة."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_export < min_interval:
+                return False
+            self._last_export = now
+        content = self.prometheus(gauges)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,253 @@
+"""ترحيلات مخطط قاعدة البيانات بأرقام إصدارات.
+
+كل ترحيل يُنفذ مرة واحدة في transaction مستقلة ويُسجل رقمه في جدول schema_migrations.
+لإضافة عمود أو فهرس أو جدول جديد: أضف دالة في آخر القائمة MIGRATIONS برقم أكبر، ولا تعدّل ترحيلاً سبق تطبيقه.
+الترحيلات الأولى مكتوبة بـ IF NOT EXISTS لأن قواعد البيانات القديمة أنشأت هذه الجداول قبل وجود هذا الجدول.
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+
+# الفرع الذي يُنشأ مع الترحيل 9 ويُنقل إليه كل المندوبين والحركات الموجودين
+DEFAULT_BRANCH = "main"
+DEFAULT_BRANCH_NAME = "الفرع الرئيسي"
+DEFAULT_DEDUCTION_AMOUNT = 15.0
+
+
+def create_base_tables(storage, s):
+    s.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS drivers (
+            id {storage.autoincrement_pk},
+            driver_id TEXT UNIQUE,
+            name TEXT,
+            bike_plate TEXT,
+            whatsapp TEXT,
+            notes TEXT,
+            is_active BOOLEAN,
+            balance REAL
+        )
+    """))
+    s.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id {storage.autoincrement_pk},
+            driver_name TEXT,
+            amount REAL,
+            type TEXT,
+            timestamp TEXT
+        )
+    """))
+
+
+def create_idempotency_keys(storage, s):
+    # مفاتيح عدم التكرار لعمليات الرصيد (تمنع تسجيل نفس العملية مرتين)
+    s.execute(text("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            driver_id TEXT,
+            new_balance REAL,
+            created_at TEXT
+        )
+    """))
+
+
+def add_transaction_driver_id(storage, s):
+    # ربط الحركات بالمندوب عبر عمود driver_id حقيقي (بدلاً من تحليل نص driver_name)
+    if not storage.has_column(s, "transactions", "driver_id"):
+        s.execute(text("ALTER TABLE transactions ADD COLUMN driver_id TEXT REFERENCES drivers(driver_id)"))
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_transactions_driver ON transactions (driver_id, id DESC)"))
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_transactions_type_driver ON transactions (type, driver_id)"))
+
+
+def create_driver_stats(storage, s):
+    # جدول الملخص: عدادات لكل مندوب تُحدَّث في نفس transaction الكتابة
+    s.execute(text("""
+        CREATE TABLE IF NOT EXISTS driver_stats (
+            driver_id TEXT PRIMARY KEY REFERENCES drivers(driver_id),
+            deliveries INTEGER NOT NULL DEFAULT 0,
+            charged REAL NOT NULL DEFAULT 0,
+            deducted REAL NOT NULL DEFAULT 0
+        )
+    """))
+
+
+def convert_transaction_timestamp(storage, s):
+    # التوقيت كنوع زمني حقيقي مع فهرس للاستعلام بالفترات.
+    # SQLite لا يملك نوعاً زمنياً: النص بصيغة "YYYY-MM-DD HH:MM:SS" يُقارن ويُفهرس بالترتيب الزمني نفسه.
+    if not storage.is_sqlite:
+        # قيمة لا تبدأ بتاريخ (نص تالف) تصبح NULL بدلاً من إيقاف الترحيل
+        s.execute(text(r"""
+            ALTER TABLE transactions ALTER COLUMN timestamp TYPE TIMESTAMP
+            USING CASE WHEN timestamp ~ '^\d{4}-\d{2}-\d{2}' THEN timestamp::timestamp END
+        """))
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions (timestamp)"))
+
+
+def create_daily_driver_stats(storage, s):
+    # ملخص يومي لكل مندوب (يُحدَّث مع كل عملية، ويُملأ من السجل عند أول تشغيل عبر rebuild_summary)
+    s.execute(text("""
+        CREATE TABLE IF NOT EXISTS daily_driver_stats (
+            day DATE NOT NULL,
+            driver_id TEXT NOT NULL REFERENCES drivers(driver_id),
+            deliveries INTEGER NOT NULL DEFAULT 0,
+            charged REAL NOT NULL DEFAULT 0,
+            deducted REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, driver_id)
+        )
+    """))
+
+
+# أعمدة المبالغ والأرصدة (الجدول، العمود)
+MONEY_COLUMNS = [
+    ("drivers", "balance"),
+    ("transactions", "amount"),
+    ("driver_stats", "charged"),
+    ("driver_stats", "deducted"),
+    ("daily_driver_stats", "charged"),
+    ("daily_driver_stats", "deducted"),
+    ("idempotency_keys", "new_balance"),
+]
+
+
+def convert_money_columns(storage, s):
+    # المبالغ بنوع عشري دقيق بدلاً من REAL حتى لا يتراكم خطأ التقريب مع ملايين العمليات.
+    # في SQLite تبقى REAL، وكل مبلغ يُقرب لمنزلتين قبل الكتابة (Storage.money).
+    if storage.is_sqlite:
+        return
+    for table, column in MONEY_COLUMNS:
+        s.execute(text(f"""
+            ALTER TABLE {table} ALTER COLUMN {column} TYPE {storage.money_type}
+            USING round({column}::numeric, 2)
+        """))
+
+
+def create_reconciliation_tables(storage, s):
+    # نقطة تحقق لكل مندوب: الرصيد المطابق للسجل حتى الحركة last_transaction_id (انظر reconcile_balances)
+    s.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS balance_checkpoints (
+            driver_id TEXT PRIMARY KEY REFERENCES drivers(driver_id),
+            last_transaction_id INTEGER NOT NULL,
+            balance {storage.money_type} NOT NULL,
+            checked_at TEXT NOT NULL
+        )
+    """))
+    # الفروقات المفتوحة (صف واحد لكل مندوب حتى يُصحح رصيده أو يُعتمد)
+    s.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS balance_mismatches (
+            driver_id TEXT PRIMARY KEY REFERENCES drivers(driver_id),
+            checkpoint_transaction_id INTEGER NOT NULL,
+            last_transaction_id INTEGER NOT NULL,
+            expected {storage.money_type} NOT NULL,
+            actual {storage.money_type} NOT NULL,
+            first_detected_at TEXT NOT NULL,
+            detected_at TEXT NOT NULL
+        )
+    """))
+
+
+def add_branches(storage, s):
+    # الفروع (hubs): لكل فرع مبلغ خصم التوصيلة الخاص به
+    s.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS branches (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            deduction_amount {storage.money_type} NOT NULL
+        )
+    """))
+    s.execute(text("INSERT INTO branches (code, name, deduction_amount) VALUES (:code, :name, :amount) ON CONFLICT (code) DO NOTHING"),
+              {"code": DEFAULT_BRANCH, "name": DEFAULT_BRANCH_NAME, "amount": DEFAULT_DEDUCTION_AMOUNT})
+    # كل مندوب وحركة وصف يومي في فرع؛ الموجود منها في الفرع الرئيسي.
+    # الحركة تحتفظ بفرعها عند نقل المندوب. SQLite لا يقبل REFERENCES مع قيمة افتراضية في ADD COLUMN.
+    references = "" if storage.is_sqlite else " REFERENCES branches(code)"
+    for table in ("drivers", "transactions", "daily_driver_stats"):
+        if not storage.has_column(s, table, "branch"):
+            s.execute(text(f"ALTER TABLE {table} ADD COLUMN branch TEXT NOT NULL DEFAULT '{DEFAULT_BRANCH}'{references}"))
+    # فهارس تبدأ بالفرع: استعلامات الفرع تقرأ صفوفه فقط مهما كبر عدد المندوبين في الفروع الأخرى
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_drivers_branch ON drivers (branch, driver_id)"))
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_transactions_branch ON transactions (branch, id DESC)"))
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_daily_driver_stats_branch ON daily_driver_stats (branch, day)"))
+
+
+def create_maintenance_jobs(storage, s):
+    # مهام الصيانة التي تعمل على دفعات خارج transaction الترحيل (مثل ربط الحركات القديمة): تُسجل هنا عند انتهائها
+    s.execute(text("""
+        CREATE TABLE IF NOT EXISTS maintenance_jobs (
+            name TEXT PRIMARY KEY,
+            finished_at TEXT NOT NULL
+        )
+    """))
+
+
+def index_idempotency_keys_created_at(storage, s):
+    # حذف المفاتيح القديمة (prune_idempotency_keys) يقرأ المنتهية فقط بدلاً من الجدول كاملاً
+    s.execute(text("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)"))
+
+
+def add_idempotency_key_request(storage, s):
+    # الطلب الذي حُجز له المفتاح: إعادة استخدام المفتاح لطلب مختلف تُرفض بدلاً من إعادة نتيجة الطلب الأول.
+    # request: بصمة عمليات الدفعة (record_batch)؛ المفاتيح المحجوزة قبل هذا الترحيل تبقى بلا type ولا تُقارن.
+    for column, column_type in (("amount", storage.money_type), ("type", "TEXT"), ("request", "TEXT")):
+        if not storage.has_column(s, "idempotency_keys", column):
+            s.execute(text(f"ALTER TABLE idempotency_keys ADD COLUMN {column} {column_type}"))
+
+
+# (الإصدار، الوصف، الدالة) بترتيب التطبيق
+MIGRATIONS = [
+    (1, "drivers and transactions tables", create_base_tables),
+    (2, "idempotency keys", create_idempotency_keys),
+    (3, "transactions.driver_id with indexes", add_transaction_driver_id),
+    (4, "driver_stats summary table", create_driver_stats),
+    (5, "native transactions.timestamp with index", convert_transaction_timestamp),
+    (6, "daily_driver_stats rollup table", create_daily_driver_stats),
+    (7, "exact NUMERIC money columns", convert_money_columns),
+    (8, "balance reconciliation checkpoints", create_reconciliation_tables),
+    (9, "branches with per-branch deduction amount", add_branches),
+    (10, "maintenance jobs log", create_maintenance_jobs),
+    (11, "idempotency_keys.created_at index", index_idempotency_keys_created_at),
+    (12, "idempotency key request columns", add_idempotency_key_request),
+]
+
+CREATE_MIGRATIONS_TABLE_SQL = text("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+""")
+
+
+def applied_versions(storage):
+    """الترحيلات المطبقة: [(version, name, applied_at)]."""
+    with storage.session as s:
+        rows = s.execute(text("SELECT version, name, applied_at FROM schema_migrations ORDER BY version")).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def migrate(storage, migrations=MIGRATIONS):
+    """يطبق الترحيلات الناقصة بالترتيب ويعيد أرقام ما تم تطبيقه الآن.
+
+    قفل الترحيل يمنع عمليتين (مثلاً نسختين من التطبيق تبدآن معاً) من تطبيق نفس الترحيل مرتين.
+    """
+    with storage.write_session as s:
+        # CREATE TABLE IF NOT EXISTS ليس آمناً عند التنفيذ المتزامن في PostgreSQL، لذلك تحت القفل أيضاً
+        storage.migration_lock(s)
+        s.execute(CREATE_MIGRATIONS_TABLE_SQL)
+        s.commit()
+    done = {row[0] for row in applied_versions(storage)}
+    pending = [m for m in migrations if m[0] not in done]
+    applied = []
+    for version, name, migration in pending:
+        with storage.write_session as s:
+            storage.migration_lock(s)
+            already = s.execute(text("SELECT 1 FROM schema_migrations WHERE version = :v"), {"v": version}).fetchone()
+            if already:
+                s.rollback()
+                continue
+            migration(storage, s)
+            s.execute(text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :name, :at)"), {
+                "v": version,
+                "name": name,
+                "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            })
+            s.commit()
+        applied.append(version)
+    return applied
@@ -0,0 +1,48 @@
+"""مطابقة أرصدة المندوبين مع السجل (للتشغيل الليلي عبر cron).
+
+كل تشغيل يفحص الحركات المضافة منذ التشغيل السابق فقط (DeliveryRepository.reconcile_balances)،
+ويطبع النتيجة بصيغة JSON. يعيد رمز خروج 1 إذا وُجد فرق مفتوح.
+ويحذف معها مفاتيح عدم التكرار الأقدم من --key-retention-days يوماً (الافتراضي 30).
+
+    DELIVERY_DB_URL=postgresql://... python reconcile.py
+    python reconcile.py --db sqlite:///delivery_app.db --accept J0002
+"""
+import argparse
+import json
+import os
+import sys
+
+from repository import IDEMPOTENCY_KEY_RETENTION_DAYS, DeliveryRepository
+from storage import create_storage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="مطابقة تزايدية لأرصدة المندوبين مع سجل الحركات.")
+    parser.add_argument("--db", default=os.environ.get("DELIVERY_DB_URL"), help="رابط SQLAlchemy (الافتراضي DELIVERY_DB_URL)")
+    parser.add_argument("--accept", nargs="+", metavar="DRIVER_ID",
+                        help="اعتماد الرصيد الحالي لهؤلاء المندوبين كنقطة تحقق جديدة (بعد مراجعة الفرق)")
+    parser.add_argument("--key-retention-days", type=int, default=IDEMPOTENCY_KEY_RETENTION_DAYS,
+                        help="حذف مفاتيح عدم التكرار الأقدم من هذا العدد من الأيام")
+    args = parser.parse_args(argv)
+    if not args.db:
+        parser.error("حدد قاعدة البيانات بـ --db أو DELIVERY_DB_URL.")
+
+    storage = create_storage(args.db)
+    repo = DeliveryRepository(storage)
+    repo.init_schema()
+    try:
+        if args.accept:
+            report = {"accepted": {driver_id: repo.accept_balance(driver_id) for driver_id in args.accept}}
+        else:
+            report = repo.reconcile_balances()
+            report["pruned_idempotency_keys"] = repo.prune_idempotency_keys(args.key_retention_days)
+        report["open_mismatches"] = len(repo.get_balance_mismatches())
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        storage.engine.dispose()
+    if report["open_mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,934 @@
+"""طبقة الوصول إلى البيانات: كل استعلامات المندوبين والحركات في مكان واحد.
+
+لا تعتمد على Streamlit، لذلك يمكن استخدامها من التطبيق أو من السكربتات وقياس الأداء.
+الفروقات بين PostgreSQL و SQLite تمر عبر storage.Storage.
+التقارير والسجل تُقرأ عبر Storage.read_query (نسخة القراءة إن وُجدت)، وكل كتابة لمندوب تُبلغ بـ note_write.
+"""
+import hashlib
+import json
+import math
+import re
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import bindparam, text
+
+from export import stream_rows, write_csv, write_parquet
+from migrations import DEFAULT_BRANCH, applied_versions, migrate
+
+DELIVERY_TYPE = "خصم توصيلة"
+CHARGE_TYPE = "شحن رصيد"
+
+BATCH_REJECT_UNKNOWN = "المندوب غير موجود"
+BATCH_REJECT_INACTIVE = "الحساب معطل"
+BATCH_REJECT_FUNDS = "الرصيد غير كافٍ"
+BATCH_REJECT_AMOUNT = "المبلغ غير صالح"
+
+BACKFILL_JOB = "backfill_transaction_driver_ids"  # اسم المهمة في maintenance_jobs
+BATCH_KEY_TYPE = "batch"  # نوع مفتاح عدم التكرار المحجوز لدفعة (record_batch)
+# مفاتيح عدم التكرار الأقدم من هذا تُحذف (prune_idempotency_keys)؛ يجب أن تتجاوز أطول مدة يعيد فيها عميل إرسال طلبه
+IDEMPOTENCY_KEY_RETENTION_DAYS = 30
+
+# عبارات SQL المشتركة بين PostgreSQL و SQLite (تُبنى مرة واحدة)
+# العبارات الأكثر تكراراً تُنفذ كعبارات محضّرة عبر Storage.execute(..., prepare_as=...)
+# ROUND(..., 2) لا يغير شيئاً في NUMERIC، ويمنع تراكم خطأ التقريب في أرصدة SQLite (REAL)
+DRIVER_INFO_SQL = text("SELECT name, balance, is_active, branch FROM drivers WHERE driver_id = :id")
+BALANCE_UPDATE_SQL = text("""
+    UPDATE drivers SET balance = ROUND(balance + :amount, 2)
+    WHERE driver_id = :id
+    RETURNING name, balance, branch
+""")
+CHECKED_BALANCE_UPDATE_SQL = text("""
+    UPDATE drivers SET balance = ROUND(balance + :amount, 2)
+    WHERE driver_id = :id AND is_active AND balance + :amount >= 0
+    RETURNING name, balance, branch
+""")
+DELIVERY_AMOUNT_SQL = text("""
+    SELECT b.deduction_amount FROM drivers d
+    JOIN branches b ON b.code = d.branch
+    WHERE d.driver_id = :id
+""")
+INSERT_TRANSACTION_SQL = text("""
+    INSERT INTO transactions (driver_id, driver_name, amount, type, timestamp, branch)
+    VALUES (:id, :driver_name, :amount, :type, :timestamp, :branch)
+""")
+CLAIM_IDEMPOTENCY_KEY_SQL = text("""
+    INSERT INTO idempotency_keys (key, driver_id, amount, type, request, created_at)
+    VALUES (:key, :id, :amount, :type, :request, :created_at)
+    ON CONFLICT (key) DO NOTHING
+""")
+RELEASE_IDEMPOTENCY_KEY_SQL = text("DELETE FROM idempotency_keys WHERE key = :key")
+PRUNE_IDEMPOTENCY_KEYS_SQL = text("""
+    DELETE FROM idempotency_keys WHERE key IN (
+        SELECT key FROM idempotency_keys WHERE created_at < :cutoff LIMIT :batch_size
+    )
+""")
+UPSERT_DRIVER_STATS_SQL = text("""
+    INSERT INTO driver_stats (driver_id, deliveries, charged, deducted)
+    VALUES (:id, :deliveries, :charged, :deducted)
+    ON CONFLICT (driver_id) DO UPDATE SET
+        deliveries = driver_stats.deliveries + EXCLUDED.deliveries,
+        charged = driver_stats.charged + EXCLUDED.charged,
+        deducted = driver_stats.deducted + EXCLUDED.deducted
+""")
+# فرع الصف اليومي هو فرع أول حركة للمندوب في ذلك اليوم
+UPSERT_DAILY_STATS_SQL = text("""
+    INSERT INTO daily_driver_stats (day, driver_id, deliveries, charged, deducted, branch)
+    VALUES (:day, :id, :deliveries, :charged, :deducted, :branch)
+    ON CONFLICT (day, driver_id) DO UPDATE SET
+        deliveries = daily_driver_stats.deliveries + EXCLUDED.deliveries,
+        charged = daily_driver_stats.charged + EXCLUDED.charged,
+        deducted = daily_driver_stats.deducted + EXCLUDED.deducted
+""")
+SAVE_IDEMPOTENT_RESULT_SQL = text("UPDATE idempotency_keys SET new_balance=:bal WHERE key=:key")
+GET_IDEMPOTENT_RESULT_SQL = text("SELECT new_balance, driver_id, amount, type, request FROM idempotency_keys WHERE key=:key")
+
+# المطابقة التزايدية: لكل مندوب الرصيد عند نقطة التحقق + الحركات بعدها فقط (بالفهرس driver_id, id)
+RECONCILE_SQL = text("""
+    SELECT d.driver_id, d.balance, c.last_transaction_id, c.balance,
+           (SELECT COALESCE(SUM(t.amount), 0) FROM transactions t
+            WHERE t.driver_id = d.driver_id AND t.id > COALESCE(c.last_transaction_id, 0)),
+           (SELECT COUNT(*) FROM transactions t
+            WHERE t.driver_id = d.driver_id AND t.id > COALESCE(c.last_transaction_id, 0)),
+           (SELECT MAX(t.id) FROM transactions t
+            WHERE t.driver_id = d.driver_id AND t.id > COALESCE(c.last_transaction_id, 0)),
+           m.driver_id IS NOT NULL
+    FROM drivers d
+    LEFT JOIN balance_checkpoints c ON c.driver_id = d.driver_id
+    LEFT JOIN balance_mismatches m ON m.driver_id = d.driver_id
+""")
+UPSERT_CHECKPOINT_SQL = text("""
+    INSERT INTO balance_checkpoints (driver_id, last_transaction_id, balance, checked_at)
+    VALUES (:id, :last_id, :balance, :checked_at)
+    ON CONFLICT (driver_id) DO UPDATE SET
+        last_transaction_id = EXCLUDED.last_transaction_id,
+        balance = EXCLUDED.balance,
+        checked_at = EXCLUDED.checked_at
+    WHERE balance_checkpoints.last_transaction_id <= EXCLUDED.last_transaction_id
+""")
+UPSERT_MISMATCH_SQL = text("""
+    INSERT INTO balance_mismatches
+        (driver_id, checkpoint_transaction_id, last_transaction_id, expected, actual, first_detected_at, detected_at)
+    VALUES (:id, :checkpoint_id, :last_id, :expected, :actual, :detected_at, :detected_at)
+    ON CONFLICT (driver_id) DO UPDATE SET
+        checkpoint_transaction_id = EXCLUDED.checkpoint_transaction_id,
+        last_transaction_id = EXCLUDED.last_transaction_id,
+        expected = EXCLUDED.expected,
+        actual = EXCLUDED.actual,
+        detected_at = EXCLUDED.detected_at
+""")
+
+# الصيغة القديمة لربط الحركة بالمندوب: "الاسم (ID:xx)"
+LEGACY_DRIVER_REF = re.compile(r"\((?:ID:)?([^()]+)\)\s*$")
+
+# أعمدة تصدير السجل: (العنوان، العمود، النوع)
+EXPORT_COLUMNS = [
+    ("المندوب", "driver_name", "text"),
+    ("العملية", "type", "text"),
+    ("المبلغ", "amount", "money"),
+    ("التوقيت", "timestamp", "timestamp"),
+]
+
+# حقول المندوب في الاستيراد الجماعي (upsert_drivers)
+DRIVER_IMPORT_FIELDS = ["driver_id", "name", "bike_plate", "whatsapp", "notes", "is_active", "branch"]
+
+# أعمدة الترتيب المسموحة في قائمة المندوبين (لا يدخل نص المستخدم في SQL مباشرة)
+DRIVER_SORT_COLUMNS = {
+    "driver_id": "d.driver_id",
+    "name": "d.name",
+    "balance": "d.balance",
+    "deliveries": "COALESCE(s.deliveries, 0)",
+}
+
+WEEK_START_DAY = 0  # بداية الأسبوع في تقارير الفترات (0 = الاثنين حسب datetime.weekday)
+
+
+class IdempotencyKeyConflict(Exception):
+    """مفتاح عدم التكرار مستخدم مسبقاً لعملية مختلفة (مندوب أو مبلغ أو نوع آخر)."""
+
+
+def valid_posting_amount(amount, trans_type):
+    """مبلغ عملية محدد صراحة: رقم منتهٍ، موجب للشحن وسالب للتوصيلة."""
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return False
+    if not math.isfinite(amount):
+        return False
+    return amount < 0 if trans_type == DELIVERY_TYPE else amount > 0
+
+
+def now_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_legacy_driver_id(driver_name):
+    """يستخرج ترقيم المندوب من الصيغة القديمة 'الاسم (ID:xx)' أو 'الاسم (xx)'."""
+    match = LEGACY_DRIVER_REF.search(driver_name or "")
+    return match.group(1).strip() if match else None
+
+
+def stats_delta(driver_id, amount, trans_type):
+    """يحول عملية واحدة إلى الزيادات المقابلة في جدول driver_stats."""
+    is_delivery = trans_type == DELIVERY_TYPE
+    return {
+        "id": driver_id,
+        "deliveries": 1 if is_delivery else 0,
+        "charged": amount if trans_type == CHARGE_TYPE else 0,
+        "deducted": -amount if is_delivery else 0,
+    }
+
+
+def as_float(value):
+    """المبالغ تُحسب في قاعدة البيانات بدقة عشرية وتُعاد للمستدعي float (None يبقى None)."""
+    return None if value is None else float(value)
+
+
+def history_filters(driver_id=None, trans_type=None, date_from=None, date_to=None, branch=None):
+    """يحوّل الفلاتر إلى شروط SQL ومعاملات مسماة."""
+    clauses, params = [], {}
+    if branch:
+        clauses.append("branch = :branch")
+        params["branch"] = branch
+    if driver_id:
+        clauses.append("driver_id = :id")
+        params["id"] = driver_id
+    if trans_type:
+        clauses.append("type = :type")
+        params["type"] = trans_type
+    # التوقيت TIMESTAMP في PostgreSQL ونص بصيغة "YYYY-MM-DD HH:MM:SS" في SQLite؛ المقارنة بالتاريخ تصلح في الحالتين
+    if date_from:
+        clauses.append("timestamp >= :date_from")
+        params["date_from"] = date_from.strftime("%Y-%m-%d")
+    if date_to:
+        clauses.append("timestamp < :date_to")
+        params["date_to"] = (date_to + timedelta(days=1)).strftime("%Y-%m-%d")
+    return clauses, params
+
+
+class DeliveryRepository:
+    """كل القراءة والكتابة على جداول المندوبين والحركات فوق Storage واحد."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    # --- المخطط ---
+    def init_schema(self):
+        """يطبق ترحيلات المخطط الناقصة (migrations.py)، ويربط الحركات القديمة بالمندوبين،
+        ويبني جدول الملخص لقاعدة بيانات قديمة.
+
+        يكفي استدعاؤه مرة واحدة عند بدء العملية. يعيد أرقام الترحيلات التي طُبقت الآن.
+        """
+        applied = migrate(self.storage)
+        # الحركات المسجلة قبل عمود driver_id لا تدخل في الملخص والتقارير والمطابقة حتى تُربط.
+        # الربط على دفعات ويُسجل عند انتهائه؛ إذا توقفت العملية في منتصفه يكمل من حيث توقف في التشغيل التالي.
+        linked = 0
+        if not self.job_finished(BACKFILL_JOB):
+            linked = self.backfill_transaction_driver_ids()
+            self.finish_job(BACKFILL_JOB)
+        with self.storage.session as s:
+            needs_summary = s.execute(text("""
+                SELECT (EXISTS (SELECT 1 FROM drivers) AND NOT EXISTS (SELECT 1 FROM driver_stats))
+                    OR (EXISTS (SELECT 1 FROM transactions WHERE driver_id IS NOT NULL)
+                        AND NOT EXISTS (SELECT 1 FROM daily_driver_stats))
+            """)).scalar()
+        # قاعدة بيانات قديمة بدون ملخص (أو حركات رُبطت الآن): نبنيه مرة واحدة من السجل
+        if needs_summary or linked:
+            self.rebuild_summary()
+        return applied
+
+    def applied_migrations(self):
+        return applied_versions(self.storage)
+
+    def job_finished(self, name):
+        with self.storage.session as s:
+            return s.execute(text("SELECT 1 FROM maintenance_jobs WHERE name = :name"), {"name": name}).fetchone() is not None
+
+    def finish_job(self, name):
+        with self.storage.session as s:
+            s.execute(text("""
+                INSERT INTO maintenance_jobs (name, finished_at) VALUES (:name, :at)
+                ON CONFLICT (name) DO UPDATE SET finished_at = EXCLUDED.finished_at
+            """), {"name": name, "at": now_timestamp()})
+            s.commit()
+
+    def backfill_transaction_driver_ids(self, batch_size=1000):
+        """يعبئ driver_id للحركات القديمة على دفعات ويعيد عدد الحركات التي تم ربطها.
+
+        كل دفعة في transaction قصيرة مستقلة، لذلك يمكن تشغيله والتطبيق يعمل.
+        """
+        select_batch = text("""
+            SELECT id, driver_name FROM transactions
+            WHERE driver_id IS NULL AND id > :last_id
+            ORDER BY id
+            LIMIT :batch_size
+        """)
+        known_drivers = text("SELECT driver_id FROM drivers WHERE driver_id IN :ids").bindparams(bindparam("ids", expanding=True))
+        link_row = text("UPDATE transactions SET driver_id=:driver_id WHERE id=:id")
+
+        last_id, linked = 0, 0
+        while True:
+            with self.storage.write_session as s:
+                rows = s.execute(select_batch, {"last_id": last_id, "batch_size": batch_size}).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                parsed = [(row_id, parse_legacy_driver_id(name)) for row_id, name in rows]
+                ids = {driver_id for _, driver_id in parsed if driver_id}
+                if ids:
+                    # نتجاهل الترقيمات التي لم تعد موجودة في جدول المندوبين (شرط المفتاح الأجنبي)
+                    existing = {r[0] for r in s.execute(known_drivers, {"ids": list(ids)})}
+                    params = [{"id": row_id, "driver_id": driver_id} for row_id, driver_id in parsed if driver_id in existing]
+                    if params:
+                        s.execute(link_row, params)
+                        linked += len(params)
+                s.commit()
+        return linked
+
+    # --- الفروع ---
+    def list_branches(self):
+        """الفروع مرتبة بالرمز: [{code, name, deduction_amount}]."""
+        with self.storage.session as s:
+            rows = s.execute(text("SELECT code, name, deduction_amount FROM branches ORDER BY code")).fetchall()
+        return [{"code": row[0], "name": row[1], "deduction_amount": as_float(row[2])} for row in rows]
+
+    def save_branch(self, code, name, deduction_amount):
+        """يضيف فرعاً أو يعدّل اسم فرع موجود ومبلغ خصم التوصيلة فيه (يسري على التوصيلات التالية فقط)."""
+        with self.storage.session as s:
+            s.execute(text("""
+                INSERT INTO branches (code, name, deduction_amount) VALUES (:code, :name, :amount)
+                ON CONFLICT (code) DO UPDATE SET name = EXCLUDED.name, deduction_amount = EXCLUDED.deduction_amount
+            """), {"code": code, "name": name, "amount": self.storage.money(deduction_amount)})
+            s.commit()
+
+    # --- المندوبون ---
+    def add_driver(self, driver_id, name, bike_plate, whatsapp, notes, is_active, branch=DEFAULT_BRANCH):
+        """يضيف مندوباً برصيد صفر. يرفع sqlalchemy.exc.IntegrityError إذا كان الترقيم موجوداً."""
+        with self.storage.session as s:
+            s.execute(text("""
+                INSERT INTO drivers (driver_id, name, bike_plate, whatsapp, notes, is_active, balance, branch)
+                VALUES (:id, :name, :plate, :wa, :notes, :active, 0.0, :branch)
+            """), {
+                "id": driver_id,
+                "name": name,
+                "plate": bike_plate,
+                "wa": whatsapp,
+                "notes": notes,
+                "active": is_active,
+                "branch": branch
+            })
+            s.execute(text("INSERT INTO driver_stats (driver_id) VALUES (:id)"), {"id": driver_id})
+            s.commit()
+        self.storage.note_write(driver_id)
+
+    def update_driver_details(self, driver_id, name, bike_plate, whatsapp, notes, is_active, branch=None):
+        """branch: نقل المندوب إلى فرع آخر (None يبقيه في فرعه). حركاته السابقة تبقى في فرعها."""
+        with self.storage.session as s:
+            s.execute(text("""
+                UPDATE drivers SET name=:name, bike_plate=:plate, whatsapp=:wa, notes=:notes, is_active=:active,
+                                   branch=COALESCE(:branch, branch)
+                WHERE driver_id=:id
+            """), {
+                "name": name,
+                "plate": bike_plate,
+                "wa": whatsapp,
+                "notes": notes,
+                "active": is_active,
+                "branch": branch,
+                "id": driver_id
+            })
+            s.commit()
+        self.storage.note_write(driver_id)
+
+    def load_search_rows(self, branch=None):
+        """صفوف فهرس البحث (driver_id, name, whatsapp) لفرع واحد، أو لكل الفروع."""
+        with self.storage.session as s:
+            if branch:
+                return s.execute(text("SELECT driver_id, name, whatsapp FROM drivers WHERE branch = :branch"),
+                                 {"branch": branch}).fetchall()
+            return s.execute(text("SELECT driver_id, name, whatsapp FROM drivers")).fetchall()
+
+    def load_driver_info(self, driver_id):
+        with self.storage.session as s:
+            row = self.storage.execute(s, DRIVER_INFO_SQL, {"id": driver_id}, prepare_as="driver_info").fetchone()
+        if row:
+            return {"name": row[0], "balance": as_float(row[1]), "is_active": bool(row[2]), "branch": row[3]}
+        return None
+
+    def get_driver_details(self, driver_id):
+        """بيانات المندوب القابلة للتعديل، أو None."""
+        with self.storage.session as s:
+            row = s.execute(text(
+                "SELECT name, bike_plate, whatsapp, notes, is_active, branch FROM drivers WHERE driver_id=:id"
+            ), {"id": driver_id}).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "bike_plate": row[1], "whatsapp": row[2], "notes": row[3], "is_active": bool(row[4]),
+                "branch": row[5]}
+
+    def upsert_drivers(self, batches, default_branch=None):
+        """يضيف المندوبين الجدد ويحدّث الموجودين (بالترقيم) من دفعات [{driver_id, name, ...}] في transaction واحدة.
+
+        الدفعات تُحمّل في جدول مؤقت (Storage.copy_rows) ثم تُنقل بعبارة UPDATE واحدة للموجودين وعبارة INSERT واحدة للجدد.
+        الحقل الغائب (None) لا يغير قيمة المندوب الموجود، والرصيد لا يتغير؛ المندوب الجديد دون فرع
+        يُضاف إلى default_branch (أو الفرع الرئيسي). يعيد (المضافون، المحدّثون).
+        """
+        updates = ", ".join(f"{field} = COALESCE(i.{field}, drivers.{field})" for field in DRIVER_IMPORT_FIELDS[1:])
+        with self.storage.write_session as s:
+            s.execute(text("""
+                CREATE TEMP TABLE driver_import (
+                    driver_id TEXT PRIMARY KEY, name TEXT, bike_plate TEXT, whatsapp TEXT, notes TEXT, is_active BOOLEAN,
+                    branch TEXT
+                )
+            """))
+            for batch in batches:
+                self.storage.copy_rows(s, "driver_import", DRIVER_IMPORT_FIELDS,
+                                       [[row.get(field) for field in DRIVER_IMPORT_FIELDS] for row in batch])
+            updated = s.execute(text(f"""
+                UPDATE drivers SET {updates}
+                FROM driver_import i
+                WHERE drivers.driver_id = i.driver_id
+            """)).rowcount
+            # WHERE true: مطلوب في SQLite لتمييز ON CONFLICT بعد INSERT ... SELECT
+            inserted = s.execute(text("""
+                INSERT INTO drivers (driver_id, name, bike_plate, whatsapp, notes, is_active, balance, branch)
+                SELECT driver_id, name, COALESCE(bike_plate, ''), COALESCE(whatsapp, ''), COALESCE(notes, ''),
+                       COALESCE(is_active, TRUE), 0, COALESCE(branch, :default_branch)
+                FROM driver_import WHERE true
+                ON CONFLICT (driver_id) DO NOTHING
+            """), {"default_branch": default_branch or DEFAULT_BRANCH}).rowcount
+            s.execute(text("""
+                INSERT INTO driver_stats (driver_id)
+                SELECT driver_id FROM driver_import WHERE true
+                ON CONFLICT (driver_id) DO NOTHING
+            """))
+            s.execute(text("DROP TABLE driver_import"))
+            s.commit()
+        return inserted, updated
+
+    def get_drivers_page(self, sort_by="driver_id", descending=False, status=None, low_balance_below=None,
+                         page=1, page_size=50, branch=None):
+        """صفحة من قائمة المندوبين مع عدد التوصيلات (من driver_stats) في استعلام واحد.
+
+        sort_by: مفتاح من DRIVER_SORT_COLUMNS. status: None أو "active" أو "inactive" أو "low_balance"
+        (الرصيد أقل من low_balance_below، أو من مبلغ خصم فرع المندوب إذا كان None).
+        branch: مندوبو فرع واحد (None لكل الفروع).
+        يعيد dict فيه rows (DataFrame) و total (عدد المطابقين).
+        """
+        clauses, params = [], {}
+        if branch:
+            clauses.append("d.branch = :branch")
+            params["branch"] = branch
+        if status == "active":
+            clauses.append("d.is_active = :active")
+            params["active"] = True
+        elif status == "inactive":
+            clauses.append("d.is_active = :active")
+            params["active"] = False
+        elif status == "low_balance" and low_balance_below is None:
+            clauses.append("d.balance < (SELECT b.deduction_amount FROM branches b WHERE b.code = d.branch)")
+        elif status == "low_balance":
+            clauses.append("d.balance < :low_balance")
+            params["low_balance"] = low_balance_below
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        direction = "DESC" if descending else "ASC"
+        params.update({"limit": page_size, "offset": (page - 1) * page_size})
+        # COUNT(*) OVER () يُحسب قبل LIMIT، فيعيد عدد كل الصفوف المطابقة مع الصفحة نفسها
+        df = self.storage.read_query(f"""
+            SELECT d.driver_id AS "الترقيم", d.name AS "الاسم", d.bike_plate AS "رقم اللوحة", d.whatsapp AS "واتساب",
+                   d.balance AS "الرصيد", COALESCE(s.deliveries, 0) AS "عدد التوصيلات",
+                   CASE WHEN d.is_active THEN 'مفعل' ELSE 'معطل' END AS "الحالة", d.branch AS "الفرع", d.notes AS "ملاحظات",
+                   COUNT(*) OVER () AS total
+            FROM drivers d
+            LEFT JOIN driver_stats s ON s.driver_id = d.driver_id
+            {where}
+            ORDER BY {DRIVER_SORT_COLUMNS[sort_by]} {direction}, d.driver_id {direction}
+            LIMIT :limit OFFSET :offset
+        """, params)
+        total = int(df["total"].iloc[0]) if not df.empty else 0
+        return {"rows": df.drop(columns="total"), "total": total}
+
+    # --- الرصيد ---
+    def update_balance(self, driver_id, amount, trans_type, require_funds=False, idempotency_key=None):
+        """يضيف amount إلى رصيد المندوب ويسجل المعاملة ذرياً.
+
+        amount=None: خصم توصيلة بمبلغ فرع المندوب (branches.deduction_amount) المقروء في نفس الـ transaction.
+
+        - require_funds (للتوصيلات): يرفض العملية داخل عبارة UPDATE نفسها إذا كان الحساب معطلاً أو أصبح الرصيد سالباً.
+        - idempotency_key: مفتاح يرسله العميل؛ تكرار الإرسال بنفس المفتاح لا يُنفذ العملية مرة ثانية.
+          المفتاح نفسه لمندوب أو مبلغ أو نوع آخر يرفع IdempotencyKeyConflict.
+
+        يعيد الرصيد الجديد، أو None إذا لم يوجد المندوب أو كان الرصيد غير كافٍ (أو الحساب معطلاً مع require_funds).
+        """
+        with self.storage.write_session as s:
+            new_balance = self._post(s, driver_id, amount, trans_type, require_funds, idempotency_key, now_timestamp())
+            s.commit()
+        self.storage.note_write(driver_id)
+        return new_balance
+
+    def apply_postings(self, postings):
+        """ينفذ قائمة عمليات [{driver_id, amount, type, require_funds, idempotency_key}] بالترتيب في transaction واحدة.
+
+        كل عملية لها نفس شروط update_balance (الرصيد يُتحقق منه بعد العمليات التي قبلها)،
+        والعملية المرفوضة لا تلغي غيرها. يعيد قائمة النتائج بنفس الترتيب (الرصيد الجديد أو None).
+        """
+        timestamp = now_timestamp()
+        with self.storage.write_session as s:
+            results = [
+                self._post(s, p["driver_id"], p["amount"], p["type"], p.get("require_funds", False),
+                           p.get("idempotency_key"), timestamp)
+                for p in postings
+            ]
+            s.commit()
+        self.storage.note_write(*{p["driver_id"] for p in postings})
+        return results
+
+    def _post(self, s, driver_id, amount, trans_type, require_funds, idempotency_key, timestamp):
+        """خطوات عملية رصيد واحدة داخل transaction مفتوحة (دون commit)."""
+        # 1. حجز مفتاح عدم التكرار (إن وجد): إذا كان محجوزاً لنفس العملية فقد سُجلت مسبقاً
+        if idempotency_key:
+            requested = self.storage.money(amount) if amount is not None else None
+            claimed = s.execute(CLAIM_IDEMPOTENCY_KEY_SQL, {
+                "key": idempotency_key,
+                "id": driver_id,
+                "amount": requested,
+                "type": trans_type,
+                "request": None,
+                "created_at": timestamp
+            })
+            if claimed.rowcount == 0:
+                previous = s.execute(GET_IDEMPOTENT_RESULT_SQL, {"key": idempotency_key}).fetchone()
+                if previous is None:
+                    return None
+                new_balance, key_driver, key_amount, key_type, _ = previous
+                # مفتاح محجوز قبل تسجيل الطلب معه (type فارغ): يُقارن المندوب فقط
+                if key_driver != str(driver_id) or (key_type is not None and (
+                        key_type != trans_type or
+                        (self.storage.money(key_amount) if key_amount is not None else None) != requested)):
+                    raise IdempotencyKeyConflict(idempotency_key)
+                return as_float(new_balance)
+
+        # 2. تحديث الرصيد مع التحقق من كفايته في نفس العبارة
+        if amount is None:
+            deduction = self.storage.execute(s, DELIVERY_AMOUNT_SQL, {"id": driver_id}, prepare_as="delivery_amount").scalar()
+            amount = -deduction if deduction is not None else None
+        row = None
+        if amount is not None:
+            amount = self.storage.money(amount)
+            if require_funds:
+                update_sql, prepared_name = CHECKED_BALANCE_UPDATE_SQL, "checked_balance_update"
+            else:
+                update_sql, prepared_name = BALANCE_UPDATE_SQL, "balance_update"
+            row = self.storage.execute(s, update_sql, {"amount": amount, "id": driver_id}, prepare_as=prepared_name).fetchone()
+        if row is None:
+            # المندوب غير موجود أو الرصيد غير كافٍ: لا نسجل شيئاً ونحرر المفتاح
+            if idempotency_key:
+                s.execute(RELEASE_IDEMPOTENCY_KEY_SQL, {"key": idempotency_key})
+            return None
+        name, new_balance, branch = row
+
+        # 3. تسجيل المعاملة في فرع المندوب
+        self.storage.execute(s, INSERT_TRANSACTION_SQL, {
+            "id": driver_id,
+            "driver_name": f"{name} (ID:{driver_id})",
+            "amount": amount,
+            "type": trans_type,
+            "timestamp": timestamp,
+            "branch": branch
+        }, prepare_as="insert_transaction")
+        self.storage.notify_change(s)
+
+        # 4. تحديث جدولي الملخص (الإجمالي واليومي) في نفس الـ transaction
+        delta = stats_delta(driver_id, amount, trans_type)
+        s.execute(UPSERT_DRIVER_STATS_SQL, delta)
+        s.execute(UPSERT_DAILY_STATS_SQL, {**delta, "day": timestamp[:10], "branch": branch})
+
+        # 5. حفظ النتيجة مع المفتاح لإعادتها عند تكرار الإرسال
+        if idempotency_key:
+            s.execute(SAVE_IDEMPOTENT_RESULT_SQL, {"bal": new_balance, "key": idempotency_key})
+        return as_float(new_balance)
+
+    def record_batch(self, postings, idempotency_key=None):
+        """يسجل قائمة عمليات [{row, driver_id, amount, type}] دفعة واحدة.
+
+        التوصيلات تُرفض إذا كان الحساب معطلاً أو لم يعد الرصيد يكفي (بالترتيب داخل الدفعة)،
+        والشحن يُقبل للمندوب الموجود إذا كان مبلغه موجباً (valid_posting_amount). توصيلة بـ amount=None تُخصم بمبلغ فرع المندوب. يعيد dict فيه accepted و rejected و balances،
+        أو None إذا كانت الدفعة مسجلة مسبقاً بنفس مفتاح عدم التكرار (ويرفع IdempotencyKeyConflict إذا حُجز المفتاح لعمليات أخرى).
+        """
+        timestamp = now_timestamp()
+        driver_ids = sorted({str(p["driver_id"]) for p in postings})
+        lock_drivers = text(f"""
+            SELECT driver_id, name, balance, is_active, branch FROM drivers
+            WHERE driver_id IN :ids
+            ORDER BY driver_id{self.storage.for_update}
+        """).bindparams(bindparam("ids", expanding=True))
+        accepted, rejected, balances = [], [], {}
+
+        with self.storage.write_session as s:
+            if idempotency_key:
+                request = self._batch_digest(postings)
+                claimed = s.execute(CLAIM_IDEMPOTENCY_KEY_SQL, {"key": idempotency_key, "id": None, "amount": None,
+                                                               "type": BATCH_KEY_TYPE, "request": request, "created_at": timestamp})
+                if claimed.rowcount == 0:
+                    previous = s.execute(GET_IDEMPOTENT_RESULT_SQL, {"key": idempotency_key}).fetchone()
+                    s.rollback()
+                    if previous is not None and previous[3] is not None and (previous[3], previous[4]) != (BATCH_KEY_TYPE, request):
+                        raise IdempotencyKeyConflict(idempotency_key)
+                    return None
+
+            # الترتيب الثابت للأقفال (ORDER BY driver_id) يمنع التعارض مع الدفعات المتزامنة
+            drivers = {row[0]: row for row in s.execute(lock_drivers, {"ids": driver_ids})} if driver_ids else {}
+            deductions = dict(s.execute(text("SELECT code, deduction_amount FROM branches")).fetchall())
+            running = {driver_id: row[2] for driver_id, row in drivers.items()}
+            for posting in postings:
+                driver_id = str(posting["driver_id"])
+                driver = drivers.get(driver_id)
+                amount = posting["amount"]
+                if (amount is not None or posting["type"] != DELIVERY_TYPE) and not valid_posting_amount(amount, posting["type"]):
+                    rejected.append({**posting, "reason": BATCH_REJECT_AMOUNT})
+                    continue
+                if amount is None and driver is not None and driver[4] in deductions:
+                    amount = -deductions[driver[4]]
+                amount = self.storage.money(amount) if amount is not None else None
+                if driver is None or amount is None:
+                    rejected.append({**posting, "reason": BATCH_REJECT_UNKNOWN})
+                elif posting["type"] == DELIVERY_TYPE and not driver[3]:
+                    rejected.append({**posting, "reason": BATCH_REJECT_INACTIVE})
+                elif posting["type"] == DELIVERY_TYPE and running[driver_id] + amount < 0:
+                    rejected.append({**posting, "reason": BATCH_REJECT_FUNDS})
+                else:
+                    running[driver_id] = self.storage.money(running[driver_id] + amount)
+                    accepted.append({**posting, "driver_id": driver_id, "amount": amount})
+
+            if accepted:
+                totals, stats = {}, {}
+                for posting in accepted:
+                    driver_id = posting["driver_id"]
+                    totals[driver_id] = totals.get(driver_id, 0) + posting["amount"]
+                    delta = stats_delta(driver_id, posting["amount"], posting["type"])
+                    if driver_id in stats:
+                        for field in ("deliveries", "charged", "deducted"):
+                            stats[driver_id][field] += delta[field]
+                    else:
+                        stats[driver_id] = delta
+                s.execute(
+                    text("UPDATE drivers SET balance = ROUND(balance + :amount, 2) WHERE driver_id = :id"),
+                    [{"id": driver_id, "amount": amount} for driver_id, amount in totals.items()]
+                )
+                s.execute(INSERT_TRANSACTION_SQL, [{
+                    "id": p["driver_id"],
+                    "driver_name": f"{drivers[p['driver_id']][1]} (ID:{p['driver_id']})",
+                    "amount": p["amount"],
+                    "type": p["type"],
+                    "timestamp": timestamp,
+                    "branch": drivers[p["driver_id"]][4]
+                } for p in accepted])
+                self.storage.notify_change(s)
+                s.execute(UPSERT_DRIVER_STATS_SQL, list(stats.values()))
+                s.execute(UPSERT_DAILY_STATS_SQL, [{**delta, "day": timestamp[:10], "branch": drivers[delta["id"]][4]}
+                                                   for delta in stats.values()])
+                balances = {driver_id: as_float(running[driver_id]) for driver_id in totals}
+            s.commit()
+        self.storage.note_write(*balances)
+        return {"accepted": accepted, "rejected": rejected, "balances": balances}
+
+    def _batch_digest(self, postings):
+        """بصمة عمليات الدفعة (المندوب والمبلغ والنوع بالترتيب) لمقارنتها عند إعادة استخدام المفتاح."""
+        items = [[str(p["driver_id"]),
+                  str(self.storage.money(p["amount"])) if valid_posting_amount(p["amount"], p["type"]) else repr(p["amount"]),
+                  p["type"]] for p in postings]
+        return hashlib.sha1(json.dumps(items, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    # --- الملخص ---
+    def rebuild_summary(self):
+        """يعيد حساب driver_stats و daily_driver_stats من جدول transactions.
+
+        يعيد تقريراً بالفروقات (drift) التي تم تصحيحها في driver_stats.
+        """
+        recompute_sql = text(f"""
+            SELECT d.driver_id,
+                   COALESCE(t.deliveries, 0),
+                   COALESCE(t.charged, 0.0),
+                   COALESCE(t.deducted, 0.0)
+            FROM drivers d
+            LEFT JOIN (
+                SELECT driver_id,
+                       SUM(CASE WHEN type='{DELIVERY_TYPE}' THEN 1 ELSE 0 END) AS deliveries,
+                       SUM(CASE WHEN type='{CHARGE_TYPE}' THEN amount ELSE 0 END) AS charged,
+                       SUM(CASE WHEN type='{DELIVERY_TYPE}' THEN -amount ELSE 0 END) AS deducted
+                FROM transactions
+                WHERE driver_id IS NOT NULL
+                GROUP BY driver_id
+            ) t ON t.driver_id = d.driver_id
+        """)
+        fields = ("deliveries", "charged", "deducted")
+        drift = []
+        with self.storage.write_session as s:
+            # قفل الجدول يمنع العمليات المتزامنة من تعديل العدادات أثناء إعادة الحساب
+            self.storage.lock_table(s, "driver_stats")
+            self.storage.lock_table(s, "daily_driver_stats")
+            stored = {row[0]: row[1:] for row in s.execute(text("SELECT driver_id, deliveries, charged, deducted FROM driver_stats"))}
+            fresh = s.execute(recompute_sql).fetchall()
+            for row in fresh:
+                old = stored.get(row[0])
+                for i, field in enumerate(fields):
+                    old_value = old[i] if old else None
+                    if old_value is None or abs(old_value - row[i + 1]) > 1e-6:
+                        drift.append({"driver_id": row[0], "field": field, "stored": old_value, "actual": row[i + 1]})
+            unlinked = s.execute(text("SELECT COUNT(*) FROM transactions WHERE driver_id IS NULL")).scalar()
+            s.execute(text("DELETE FROM driver_stats"))
+            if fresh:
+                s.execute(
+                    text("INSERT INTO driver_stats (driver_id, deliveries, charged, deducted) VALUES (:id, :deliveries, :charged, :deducted)"),
+                    [{"id": r[0], "deliveries": r[1], "charged": r[2], "deducted": r[3]} for r in fresh]
+                )
+            s.execute(text("DELETE FROM daily_driver_stats"))
+            s.execute(text(f"""
+                INSERT INTO daily_driver_stats (day, driver_id, deliveries, charged, deducted, branch)
+                SELECT g.day, g.driver_id, g.deliveries, g.charged, g.deducted, f.branch
+                FROM (
+                    SELECT {self.storage.day_of("timestamp")} AS day, driver_id,
+                           SUM(CASE WHEN type='{DELIVERY_TYPE}' THEN 1 ELSE 0 END) AS deliveries,
+                           SUM(CASE WHEN type='{CHARGE_TYPE}' THEN amount ELSE 0 END) AS charged,
+                           SUM(CASE WHEN type='{DELIVERY_TYPE}' THEN -amount ELSE 0 END) AS deducted,
+                           MIN(id) AS first_id
+                    FROM transactions
+                    WHERE driver_id IS NOT NULL AND timestamp IS NOT NULL
+                    GROUP BY {self.storage.day_of("timestamp")}, driver_id
+                ) g
+                -- فرع الصف اليومي من أول حركة في اليوم (كما في UPSERT_DAILY_STATS_SQL)
+                JOIN transactions f ON f.id = g.first_id
+            """))
+            s.commit()
+        return {"drivers": len(fresh), "drift": drift, "unlinked_transactions": unlinked}
+
+    # --- مطابقة الأرصدة ---
+    def reconcile_balances(self):
+        """مطابقة تزايدية لأرصدة المندوبين مع السجل.
+
+        لكل مندوب: الرصيد عند آخر نقطة تحقق + مجموع الحركات بعدها يجب أن يساوي drivers.balance.
+        تُقرأ الحركات الأحدث من نقطة التحقق فقط، ثم تتقدم النقطة للمندوبين المتطابقين.
+        غير المتطابق يُسجل في balance_mismatches ولا تتقدم نقطته حتى يُصحح رصيده أو يُعتمد (accept_balance).
+        يعيد dict فيه drivers و transactions (عدد الحركات المفحوصة) و mismatches و resolved.
+        """
+        checked_at = now_timestamp()
+        checkpoints, mismatches, resolved = [], [], []
+        scanned = 0
+        with self.storage.write_session as s:
+            # عبارة واحدة: الأرصدة والحركات من نفس اللقطة، وتحديث الرصيد وإضافة الحركة في نفس الـ transaction
+            rows = s.execute(RECONCILE_SQL).fetchall()
+            for driver_id, balance, checkpoint_id, checkpoint_balance, delta, count, last_id, flagged in rows:
+                scanned += count
+                checkpoint_id = checkpoint_id or 0
+                last_id = last_id or checkpoint_id
+                expected = self.storage.money((checkpoint_balance or 0) + delta)
+                actual = self.storage.money(balance or 0)
+                if actual != expected:
+                    mismatches.append({"id": driver_id, "checkpoint_id": checkpoint_id, "last_id": last_id,
+                                       "expected": expected, "actual": actual, "detected_at": checked_at})
+                    continue
+                if count or checkpoint_balance is None:
+                    checkpoints.append({"id": driver_id, "last_id": last_id, "balance": actual, "checked_at": checked_at})
+                if flagged:
+                    resolved.append(driver_id)
+            if checkpoints:
+                s.execute(UPSERT_CHECKPOINT_SQL, checkpoints)
+            if mismatches:
+                s.execute(UPSERT_MISMATCH_SQL, mismatches)
+            if resolved:
+                s.execute(text("DELETE FROM balance_mismatches WHERE driver_id IN :ids").bindparams(
+                    bindparam("ids", expanding=True)), {"ids": resolved})
+            s.commit()
+        return {
+            "drivers": len(rows),
+            "transactions": int(scanned),
+            "mismatches": [{**m, "expected": as_float(m["expected"]), "actual": as_float(m["actual"])} for m in mismatches],
+            "resolved": resolved,
+        }
+
+    def prune_idempotency_keys(self, older_than_days=IDEMPOTENCY_KEY_RETENTION_DAYS, batch_size=5000):
+        """يحذف مفاتيح عدم التكرار الأقدم من older_than_days يوماً على دفعات ويعيد عددها.
+
+        إعادة إرسال طلب بعد حذف مفتاحه تُسجل كعملية جديدة. يعمل مع المطابقة الليلية (reconcile.py).
+        """
+        cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime("%Y-%m-%d %H:%M:%S")
+        pruned = 0
+        while True:
+            with self.storage.write_session as s:
+                deleted = s.execute(PRUNE_IDEMPOTENCY_KEYS_SQL, {"cutoff": cutoff, "batch_size": batch_size}).rowcount
+                s.commit()
+            pruned += deleted
+            if deleted < batch_size:
+                return pruned
+
+    def get_balance_mismatches(self):
+        """الفروقات المفتوحة التي سجلتها reconcile_balances."""
+        return self.storage.query("""
+            SELECT m.driver_id AS "الترقيم", d.name AS "الاسم", m.expected AS "الرصيد حسب السجل",
+                   m.actual AS "الرصيد المسجل", m.actual - m.expected AS "الفرق",
+                   m.checkpoint_transaction_id AS "آخر حركة مطابقة", m.last_transaction_id AS "آخر حركة",
+                   m.first_detected_at AS "أول اكتشاف", m.detected_at AS "آخر فحص"
+            FROM balance_mismatches m
+            LEFT JOIN drivers d ON d.driver_id = m.driver_id
+            ORDER BY m.first_detected_at, m.driver_id
+        """)
+
+    def accept_balance(self, driver_id):
+        """يعتمد الرصيد الحالي للمندوب كنقطة تحقق جديدة ويغلق فرقه المفتوح. يعيد الرصيد، أو None."""
+        with self.storage.write_session as s:
+            # قفل صف المندوب: لا تُضاف له حركة بين قراءة الرصيد وآخر حركة
+            row = s.execute(text(f"SELECT balance FROM drivers WHERE driver_id = :id{self.storage.for_update}"),
+                            {"id": driver_id}).fetchone()
+            if row is None:
+                return None
+            last_id = s.execute(text("SELECT COALESCE(MAX(id), 0) FROM transactions WHERE driver_id = :id"),
+                                {"id": driver_id}).scalar()
+            s.execute(UPSERT_CHECKPOINT_SQL, {"id": driver_id, "last_id": last_id, "balance": row[0],
+                                              "checked_at": now_timestamp()})
+            s.execute(text("DELETE FROM balance_mismatches WHERE driver_id = :id"), {"id": driver_id})
+            s.commit()
+        return as_float(row[0])
+
+    def get_totals(self, branch=None):
+        # استعلام واحد على جدول الملخص (بحجم عدد المندوبين) بدلاً من أربعة استعلامات على السجل؛
+        # مع branch: مندوبو الفرع الحاليون فقط (الفهرس branch, driver_id)
+        where = "WHERE d.branch = :branch" if branch else ""
+        df = self.storage.read_query(f"""
+            SELECT COALESCE(SUM(d.balance), 0.0), COALESCE(SUM(s.charged), 0.0),
+                   COALESCE(SUM(s.deducted), 0.0), COALESCE(SUM(s.deliveries), 0)
+            FROM drivers d
+            LEFT JOIN driver_stats s ON s.driver_id = d.driver_id
+            {where}
+        """, {"branch": branch} if branch else None)
+        total_balance, total_charged, total_deducted, total_deliveries = df.iloc[0].tolist()
+        return total_balance, total_charged, total_deducted, int(total_deliveries)
+
+    # --- تقارير الفترات (من الملخص اليومي، دون مسح السجل) ---
+    def get_period_totals(self, date_from, date_to, branch=None):
+        """(عدد التوصيلات، المشحون، المخصوم، عدد المندوبين النشطين) بين تاريخين شاملين، لفرع واحد أو للكل."""
+        params = {"date_from": date_from.isoformat(), "date_to": date_to.isoformat()}
+        branch_clause = ""
+        if branch:
+            branch_clause = "AND branch = :branch"
+            params["branch"] = branch
+        df = self.storage.read_query(f"""
+            SELECT COALESCE(SUM(deliveries), 0), COALESCE(SUM(charged), 0.0),
+                   COALESCE(SUM(deducted), 0.0), COUNT(DISTINCT driver_id)
+            FROM daily_driver_stats
+            WHERE day >= :date_from AND day <= :date_to {branch_clause}
+        """, params)
+        deliveries, charged, deducted, drivers = df.iloc[0].tolist()
+        return int(deliveries), float(charged), float(deducted), int(drivers)
+
+    def get_period_report(self, date_from, date_to, group_by="driver", branch=None):
+        """تفصيل الفترة حسب المندوب (driver) أو اليوم (day) أو الأسبوع (week)، لفرع واحد أو للكل."""
+        params = {"date_from": date_from.isoformat(), "date_to": date_to.isoformat()}
+        branch_clause = ""
+        if branch:
+            branch_clause = "AND r.branch = :branch"
+            params["branch"] = branch
+        if group_by == "driver":
+            return self.storage.read_query(f"""
+                SELECT r.driver_id AS "الترقيم", d.name AS "الاسم",
+                       SUM(r.deliveries) AS "عدد التوصيلات", SUM(r.charged) AS "المشحون", SUM(r.deducted) AS "المخصوم"
+                FROM daily_driver_stats r
+                LEFT JOIN drivers d ON d.driver_id = r.driver_id
+                WHERE r.day >= :date_from AND r.day <= :date_to {branch_clause}
+                GROUP BY r.driver_id, d.name
+                ORDER BY SUM(r.deliveries) DESC, r.driver_id
+            """, params)
+
+        df = self.storage.read_query(f"""
+            SELECT r.day, SUM(r.deliveries) AS deliveries, SUM(r.charged) AS charged, SUM(r.deducted) AS deducted,
+                   COUNT(*) AS drivers
+            FROM daily_driver_stats r
+            WHERE r.day >= :date_from AND r.day <= :date_to {branch_clause}
+            GROUP BY r.day
+            ORDER BY day
+        """, params)
+        # SQLite يعيد اليوم نصاً و PostgreSQL يعيده date
+        df["day"] = [date.fromisoformat(str(day)[:10]) for day in df["day"]]
+        if group_by == "week":
+            df["day"] = [day - timedelta(days=(day.weekday() - WEEK_START_DAY) % 7) for day in df["day"]]
+            # عدد المندوبين النشطين في الأسبوع لا يُجمع من الأيام (نفس المندوب يتكرر)
+            df = df.groupby("day", as_index=False)[["deliveries", "charged", "deducted"]].sum()
+        label = "بداية الأسبوع" if group_by == "week" else "اليوم"
+        return df.rename(columns={
+            "day": label, "deliveries": "عدد التوصيلات", "charged": "المشحون",
+            "deducted": "المخصوم", "drivers": "مندوبون نشطون",
+        })
+
+    # --- السجل ---
+    def get_history(self, driver_id=None, branch=None):
+        if driver_id:
+            # بحث مباشر بالفهرس (driver_id, id DESC) مع معاملات مسماة
+            query = "SELECT type as \"العملية\", amount as \"المبلغ\", timestamp as \"التوقيت\" FROM transactions WHERE driver_id = :id ORDER BY id DESC"
+            return self.storage.read_query(query, {"id": driver_id}, driver_id=driver_id)
+        if branch:
+            query = "SELECT driver_name as \"المندوب\", type as \"العملية\", amount as \"المبلغ\", timestamp as \"التوقيت\" FROM transactions WHERE branch = :branch ORDER BY id DESC"
+            return self.storage.read_query(query, {"branch": branch})
+        query = "SELECT driver_name as \"المندوب\", type as \"العملية\", amount as \"المبلغ\", timestamp as \"التوقيت\" FROM transactions ORDER BY id DESC"
+        return self.storage.read_query(query)
+
+    def get_history_page(self, driver_id=None, before_id=None, after_id=None, page_size=50, trans_type=None, date_from=None, date_to=None,
+                         branch=None):
+        """صفحة واحدة من السجل (الأحدث أولاً) بطريقة keyset على id.
+
+        before_id: الصفحة الأقدم من هذا المعرف. after_id: الصفحة الأحدث من هذا المعرف.
+        branch: حركات فرع واحد (بالفهرس branch, id).
+        يعيد dict فيه rows (DataFrame) و first_id و last_id و has_newer و has_older.
+        """
+        clauses, params = history_filters(driver_id, trans_type, date_from, date_to, branch)
+        columns = 'id, type as "العملية", amount as "المبلغ", timestamp as "التوقيت"'
+        if not driver_id:
+            columns = 'id, driver_name as "المندوب", type as "العملية", amount as "المبلغ", timestamp as "التوقيت"'
+        if after_id is not None:
+            clauses.append("id > :cursor")
+            params["cursor"] = after_id
+            order = "ASC"
+        else:
+            if before_id is not None:
+                clauses.append("id < :cursor")
+                params["cursor"] = before_id
+            order = "DESC"
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        # نجلب صفاً إضافياً لمعرفة وجود صفحة تالية دون COUNT
+        params["limit"] = page_size + 1
+        df = self.storage.read_query(f"SELECT {columns} FROM transactions {where} ORDER BY id {order} LIMIT :limit", params,
+                                     driver_id=driver_id)
+
+        has_more = len(df) > page_size
+        df = df.iloc[:page_size]
+        if after_id is not None:
+            df = df.iloc[::-1].reset_index(drop=True)
+        return {
+            "rows": df,
+            "first_id": int(df["id"].iloc[0]) if not df.empty else None,
+            "last_id": int(df["id"].iloc[-1]) if not df.empty else None,
+            "has_newer": has_more if after_id is not None else before_id is not None,
+            "has_older": has_more if after_id is None else True,
+        }
+
+    def count_history(self, driver_id=None, trans_type=None, date_from=None, date_to=None, estimate_above=None, branch=None):
+        """عدد الحركات المطابقة للفلاتر. يعيد (العدد، هل هو تقديري).
+
+        بدون أي فلتر، إذا تجاوز التقدير estimate_above يُعاد التقدير بدلاً من مسح الجدول.
+        """
+        clauses, params = history_filters(driver_id, trans_type, date_from, date_to, branch)
+        if not clauses and estimate_above is not None:
+            estimate = self.storage.estimate_rows("transactions")
+            if estimate is not None and estimate > estimate_above:
+                return estimate, True
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        df = self.storage.read_query(f"SELECT COUNT(*) FROM transactions {where}", params, driver_id=driver_id)
+        return int(df.iloc[0, 0]), False
+
+    def export_history(self, fmt="csv", driver_id=None, trans_type=None, date_from=None, date_to=None, branch=None):
+        """يصدّر الحركات المطابقة للفلاتر (الأحدث أولاً) على دفعات ويعيد ملفاً مؤقتاً مفتوحاً من بدايته."""
+        clauses, params = history_filters(driver_id, trans_type, date_from, date_to, branch)
+        columns = [c for c in EXPORT_COLUMNS if not (driver_id and c[1] == "driver_name")]
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT {', '.join(c[1] for c in columns)} FROM transactions {where} ORDER BY id DESC"
+        chunks = stream_rows(self.storage.read_engine(driver_id), sql, params)
+        if fmt == "parquet":
+            return write_parquet(chunks, [(c[0], c[2]) for c in columns])
+        return write_csv(chunks, [c[0] for c in columns])
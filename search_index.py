@@ -0,0 +1,249 @@
+"""فهرس بحث داخل الذاكرة للمندوبين.
+
+يفهرس الترقيم ورقم الواتساب والاسم (بعد تطبيع الحروف العربية) ويعيد قائمة نتائج مرتبة:
+التطابق التام للترقيم أولاً، ثم البدايات، ثم الاحتواء، ثم التشابه التقريبي للاسم (trigrams).
+"""
+import bisect
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+# التشكيل والتطويل لا يؤثران على المطابقة
+ARABIC_MARKS = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u0640]")
+ARABIC_LETTERS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ء": "", "ة": "ه",
+})
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+NON_DIGITS = re.compile(r"\D")
+SPACES = re.compile(r"\s+")
+
+# درجات الترتيب (الأعلى أولاً)
+SCORE_EXACT_ID = 100
+SCORE_EXACT_WHATSAPP = 90
+SCORE_PREFIX_ID = 80
+SCORE_PREFIX_WHATSAPP = 70
+SCORE_PREFIX_NAME = 60
+SCORE_CONTAINS_ID = 50
+SCORE_CONTAINS_NAME = 40
+SCORE_FUZZY_NAME = 20
+
+FUZZY_MIN_SIMILARITY = 0.5
+PREFIX_SCAN_LIMIT = 500
+
+
+def normalize_arabic(value):
+    """يوحد أشكال الألف والهمزة والياء والتاء المربوطة ويحذف التشكيل والمسافات الزائدة."""
+    value = ARABIC_MARKS.sub("", str(value or ""))
+    value = value.translate(ARABIC_LETTERS).translate(ARABIC_DIGITS).lower()
+    return SPACES.sub(" ", value).strip()
+
+
+def normalize_phone(value):
+    """يحتفظ بالأرقام فقط من رقم الهاتف."""
+    return NON_DIGITS.sub("", str(value or "").translate(ARABIC_DIGITS))
+
+
+def trigrams(value, padded=True):
+    """مجموعة المقاطع الثلاثية؛ الحواف (padded) تعطي وزناً لبداية ونهاية النص عند التشابه التقريبي."""
+    if padded:
+        value = f" {value} "
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class _IndexData:
+    """هياكل الفهرس نفسها؛ تُبنى كاملة ثم تُستبدل دفعة واحدة عند إعادة التحميل."""
+
+    def __init__(self):
+        self.drivers = {}              # driver_id -> (name, whatsapp, normalized_id, normalized_name, phone)
+        self.exact_ids = {}            # normalized_id -> driver_id
+        self.exact_phones = defaultdict(set)
+        self.prefixes = []             # قائمة مرتبة من (key, field, driver_id)
+        self.grams = defaultdict(set)  # trigram -> {driver_id}
+
+    @staticmethod
+    def _keys(driver_id, norm_id, norm_name, phone):
+        keys = [(norm_id, "id", driver_id)]
+        if phone:
+            keys.append((phone, "whatsapp", driver_id))
+        if norm_name:
+            keys.append((norm_name, "name", driver_id))
+            # بداية أي كلمة في الاسم (مثل اسم العائلة)
+            keys.extend((word, "name", driver_id) for word in norm_name.split(" ")[1:] if word)
+        return keys
+
+    @staticmethod
+    def _grams(norm_id, norm_name, phone):
+        return trigrams(norm_name) | trigrams(norm_id) | (trigrams(phone) if phone else set())
+
+    def add(self, driver_id, name, whatsapp, keep_sorted=True):
+        driver_id = str(driver_id)
+        norm_id = normalize_arabic(driver_id)
+        norm_name = normalize_arabic(name)
+        phone = normalize_phone(whatsapp)
+        self.drivers[driver_id] = (name, whatsapp, norm_id, norm_name, phone)
+        self.exact_ids[norm_id] = driver_id
+        if phone:
+            self.exact_phones[phone].add(driver_id)
+        for key in self._keys(driver_id, norm_id, norm_name, phone):
+            if keep_sorted:
+                bisect.insort(self.prefixes, key)
+            else:
+                self.prefixes.append(key)
+        for gram in self._grams(norm_id, norm_name, phone):
+            self.grams[gram].add(driver_id)
+
+    def remove(self, driver_id):
+        driver_id = str(driver_id)
+        old = self.drivers.pop(driver_id, None)
+        if old is None:
+            return
+        _, _, norm_id, norm_name, phone = old
+        if self.exact_ids.get(norm_id) == driver_id:
+            del self.exact_ids[norm_id]
+        if phone:
+            self.exact_phones[phone].discard(driver_id)
+        for key in self._keys(driver_id, norm_id, norm_name, phone):
+            pos = bisect.bisect_left(self.prefixes, key)
+            if pos < len(self.prefixes) and self.prefixes[pos] == key:
+                del self.prefixes[pos]
+        for gram in self._grams(norm_id, norm_name, phone):
+            self.grams[gram].discard(driver_id)
+
+
+class DriverSearchIndex:
+    """فهرس مشترك بين الجلسات؛ يُحمّل عند أول بحث ويُحدّث عند كل كتابة على المندوبين.
+
+    loader: دالة تعيد صفوف (driver_id, name, whatsapp) من قاعدة البيانات.
+    max_age: عمر الفهرس بالثواني قبل إعادة تحميله في الخلفية (لالتقاط تعديلات العمليات الأخرى).
+    """
+
+    def __init__(self, loader, max_age=300):
+        self._loader = loader
+        self._max_age = max_age
+        self._lock = threading.RLock()
+        self._data = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._pending = []  # تعديلات وصلت أثناء إعادة التحميل: (driver_id, (name, whatsapp) أو None للحذف)
+
+    # --- التحميل والتحديث ---
+    def refresh(self):
+        """يعيد بناء الفهرس بالكامل من قاعدة البيانات دون إيقاف البحث على النسخة الحالية."""
+        with self._lock:
+            self._refreshing = True
+            self._pending = []
+        try:
+            data = _IndexData()
+            for driver_id, name, whatsapp in self._loader():
+                data.add(driver_id, name, whatsapp, keep_sorted=False)
+            data.prefixes.sort()
+            with self._lock:
+                for driver_id, fields in self._pending:
+                    data.remove(driver_id)
+                    if fields is not None:
+                        data.add(driver_id, *fields)
+                self._data = data
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._pending = []
+
+    def invalidate(self):
+        """يطلب إعادة التحميل عند أول بحث قادم."""
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def upsert(self, driver_id, name, whatsapp):
+        """يحدّث مندوباً واحداً في الفهرس بعد الإضافة أو التعديل."""
+        with self._lock:
+            if self._refreshing:
+                self._pending.append((str(driver_id), (name, whatsapp)))
+            if self._data is not None:
+                self._data.remove(driver_id)
+                self._data.add(driver_id, name, whatsapp)
+
+    def remove(self, driver_id):
+        """يحذف مندوباً من الفهرس (مثلاً بعد نقله إلى فرع له فهرس آخر)."""
+        with self._lock:
+            if self._refreshing:
+                self._pending.append((str(driver_id), None))
+            if self._data is not None:
+                self._data.remove(driver_id)
+
+    def _current(self):
+        with self._lock:
+            data = self._data
+            expired = time.monotonic() - self._loaded_at > self._max_age
+            start_background = data is not None and expired and not self._refreshing
+            if start_background:
+                self._refreshing = True
+        if data is None:
+            self.refresh()
+            return self._data
+        if start_background:
+            # النسخة الحالية تبقى متاحة للبحث حتى تكتمل النسخة الجديدة
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return data
+
+    # --- البحث ---
+    def search(self, term, limit=10):
+        """يعيد حتى limit نتيجة مرتبة: [{driver_id, name, whatsapp, score}]."""
+        data = self._current()
+        query = normalize_arabic(term)
+        if not query:
+            return []
+        phone = normalize_phone(term)
+        scores = {}
+
+        def hit(driver_id, score):
+            if score > scores.get(driver_id, 0):
+                scores[driver_id] = score
+
+        with self._lock:
+            # 1. التطابق التام
+            if query in data.exact_ids:
+                hit(data.exact_ids[query], SCORE_EXACT_ID)
+            for driver_id in data.exact_phones.get(phone, ()) if phone else ():
+                hit(driver_id, SCORE_EXACT_WHATSAPP)
+
+            # 2. البدايات (بحث ثنائي في القائمة المرتبة)
+            prefix_scores = {"id": SCORE_PREFIX_ID, "whatsapp": SCORE_PREFIX_WHATSAPP, "name": SCORE_PREFIX_NAME}
+            for prefix in {query, phone} - {""}:
+                pos = bisect.bisect_left(data.prefixes, (prefix,))
+                for key, field, driver_id in data.prefixes[pos:pos + PREFIX_SCAN_LIMIT]:
+                    if not key.startswith(prefix):
+                        break
+                    if field != "whatsapp" or prefix == phone:
+                        hit(driver_id, prefix_scores[field])
+
+            # 3. الاحتواء (تقاطع المقاطع الداخلية) للنصوص من 3 أحرف فأكثر
+            if len(query) >= 3 and len(scores) < limit:
+                inner = [data.grams.get(g, set()) for g in trigrams(query, padded=False)]
+                candidates = set.intersection(*inner) if all(inner) else set()
+                for driver_id in candidates:
+                    _, _, norm_id, norm_name, driver_phone = data.drivers[driver_id]
+                    if query in norm_id or (phone and phone in driver_phone):
+                        hit(driver_id, SCORE_CONTAINS_ID)
+                    elif query in norm_name:
+                        hit(driver_id, SCORE_CONTAINS_NAME)
+
+                # 4. التشابه التقريبي (أخطاء إملائية بسيطة) عند قلة النتائج
+                if len(scores) < limit:
+                    grams = trigrams(query)
+                    counts = Counter()
+                    for gram in grams:
+                        counts.update(data.grams.get(gram, ()))
+                    needed = len(grams) * FUZZY_MIN_SIMILARITY
+                    for driver_id, shared in counts.items():
+                        if shared >= needed and driver_id not in scores:
+                            hit(driver_id, SCORE_FUZZY_NAME + 10 * shared / len(grams))
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], data.drivers[item[0]][3], item[0]))
+            return [
+                {"driver_id": driver_id, "name": data.drivers[driver_id][0],
+                 "whatsapp": data.drivers[driver_id][1], "score": score}
+                for driver_id, score in ranked[:limit]
+            ]
@@ -0,0 +1,407 @@
+"""طبقة التخزين: محرك SQLAlchemy واحد مع الفروقات بين PostgreSQL و SQLite.
+
+PostgreSQL للتشغيل المركزي، و SQLite (ملف محلي بنمط WAL) للفروع الصغيرة والتجارب
+وقياس الأداء دون خادم قاعدة بيانات. كل SQL خاص بنوع القاعدة موجود هنا فقط.
+"""
+import csv
+import io
+import re
+import threading
+import time
+from decimal import ROUND_HALF_UP, Decimal
+
+import pandas as pd
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+# مجمع الاتصالات (pool) للمحرك؛ القيم الافتراضية قابلة للتغيير من الإعدادات (انظر engine_options)
+POOL_SIZE = 10                      # اتصالات دائمة
+POOL_MAX_OVERFLOW = 20              # اتصالات إضافية مؤقتة عند الضغط
+POOL_TIMEOUT = 30                   # ثوانٍ لانتظار اتصال حر قبل الخطأ
+POOL_RECYCLE = 1800                 # ثوانٍ قبل استبدال الاتصال (تجنب قطع الخادم للاتصالات الخاملة)
+POOL_PRE_PING = True                # فحص الاتصال قبل استخدامه
+
+# إعدادات SQLite
+SQLITE_BUSY_TIMEOUT_MS = 5000       # انتظار قفل الكتابة بدلاً من الفشل الفوري
+SQLITE_CACHE_SIZE_KB = 16 * 1024    # ذاكرة صفحات لكل اتصال
+SQLITE_CACHED_STATEMENTS = 256      # عدد العبارات المحضّرة (prepared) المحفوظة لكل اتصال
+MONEY_SCALE = 2                     # منازل المبالغ والأرصدة العشرية
+MONEY_SQL_TYPE = "NUMERIC(14, 2)"   # نوع المبالغ في PostgreSQL (دقيق، بدون خطأ تقريب)
+MIGRATION_LOCK_KEY = 7254100          # مفتاح pg_advisory_xact_lock الخاص بالترحيلات
+CHANGE_CHANNEL = "ledger_changes"   # قناة NOTIFY بعد كل commit فيه حركات جديدة (انظر change_feed.py)
+
+# نسخة القراءة (replica) للتقارير والسجل (انظر ReplicaRouter)
+REPLICA_MAX_LAG = 5.0               # ثوانٍ: نسخة متأخرة أكثر من ذلك لا يُقرأ منها
+REPLICA_LAG_CHECK_INTERVAL = 2.0    # ثوانٍ بين فحصين لتأخر النسخة
+REPLICA_RETRY_AFTER = 30.0          # ثوانٍ قبل إعادة المحاولة بعد فشل الاتصال بالنسخة
+# التأخر في PostgreSQL: 0 إذا لم تكن القاعدة نسخة (standby) أو طبقت كل ما استلمته
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # القراءة لا تنتظر الكتابة والعكس
+    "PRAGMA synchronous=NORMAL",    # آمن مع WAL، ويتجنب fsync عند كل commit
+    "PRAGMA foreign_keys=ON",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+PARAM_PATTERN = re.compile(r"(?<!:):(\w+)")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool يقيس زمن الحصول على اتصال (يرتفع عند امتلاء المجمع) وعدد مرات انتهاء المهلة."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+        return conn
+
+
+def engine_options(pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+                   pool_recycle=POOL_RECYCLE, pool_pre_ping=POOL_PRE_PING):
+    """معاملات create_engine الخاصة بمجمع الاتصالات (تُمرر أيضاً إلى st.connection)."""
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+    }
+
+
+def sqlite_engine(url, **options):
+    """محرك SQLite مضبوط لعدة جلسات Streamlit على نفس الملف."""
+    engine = create_engine(url, connect_args={
+        "check_same_thread": False,
+        "cached_statements": SQLITE_CACHED_STATEMENTS,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+    }, **(options or engine_options()))
+
+    @event.listens_for(engine, "connect")
+    def _configure(dbapi_conn, _record):
+        # نتولى BEGIN بأنفسنا (انظر _begin) بدلاً من السلوك التلقائي لمكتبة sqlite3
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        # جلسات الكتابة تحجز قفل الكتابة من البداية، فلا تتغير البيانات بين القراءة والتحديث
+        mode = conn.get_execution_options().get("sqlite_begin", "DEFERRED")
+        conn.exec_driver_sql(f"BEGIN {mode}")
+
+    return engine
+
+
+class ReplicaRouter:
+    """يختار قاعدة القراءة لاستعلامات التقارير والسجل: النسخة (replica) أو القاعدة الأساسية.
+
+    - النسخة غير المتاحة (خطأ اتصال) تُترك retry_after ثانية وتُقرأ الاستعلامات من الأساسية.
+    - النسخة المتأخرة أكثر من max_lag (يُفحص كل check_interval ثانية) لا تُستخدم.
+    - بعد كتابة لمندوب (note_write) تبقى قراءاته على الأساسية max_lag + check_interval ثانية،
+      وهي أطول مدة قد لا تظهر فيها كتابته في نسخة مقبولة، فيرى المندوب والمشغل أثر عمليتهما فوراً.
+    """
+
+    def __init__(self, replica, max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_LAG_CHECK_INTERVAL,
+                 retry_after=REPLICA_RETRY_AFTER):
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.sticky_seconds = max_lag + check_interval
+        self._lock = threading.Lock()
+        self._writes = {}           # driver_id -> وقت آخر كتابة (monotonic)
+        self._checked_at = None
+        self._down_until = 0.0
+        self.lag = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+        self.last_error = None
+
+    def note_write(self, driver_ids):
+        now = time.monotonic()
+        with self._lock:
+            for driver_id in driver_ids:
+                self._writes[str(driver_id)] = now
+            # حذف ما انتهت مدته حتى لا يكبر القاموس بلا حد
+            if len(self._writes) > 10000:
+                self._writes = {k: t for k, t in self._writes.items() if now - t < self.sticky_seconds}
+
+    def choose(self, driver_id=None):
+        """النسخة (Storage) إذا كانت صالحة لهذه القراءة، أو None للقاعدة الأساسية."""
+        now = time.monotonic()
+        with self._lock:
+            written = self._writes.get(str(driver_id)) if driver_id else None
+            if (written is not None and now - written < self.sticky_seconds) or now < self._down_until:
+                self.primary_reads += 1
+                return None
+            check = self._checked_at is None or now - self._checked_at >= self.check_interval
+            if check:
+                # فحص واحد في كل مرة: باقي الخيوط تستخدم آخر قيمة
+                self._checked_at = now
+        if check:
+            try:
+                lag = self.replica.replica_lag()
+            except DBAPIError as e:
+                self.mark_down(e)
+                return None
+            with self._lock:
+                self.lag = lag
+        with self._lock:
+            if self.lag is None or self.lag > self.max_lag:
+                self.primary_reads += 1
+                return None
+            self.replica_reads += 1
+        return self.replica
+
+    def mark_down(self, error):
+        with self._lock:
+            self._down_until = time.monotonic() + self.retry_after
+            self._checked_at = None
+            self.fallbacks += 1
+            self.primary_reads += 1
+            self.last_error = repr(error)[:200]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": time.monotonic() >= self._down_until,
+                "lag_seconds": self.lag,
+                "max_lag_seconds": self.max_lag,
+                "replica_reads": self.replica_reads,
+                "primary_reads": self.primary_reads,
+                "fallbacks": self.fallbacks,
+                "last_error": self.last_error,
+            }
+
+
+class Storage:
+    """يغلف محرك SQLAlchemy ويوفر نفس واجهة اتصال Streamlit (session و query).
+
+    prepared_statements: تحضير العبارات المتكررة على الخادم في PostgreSQL (انظر execute).
+    يجب تعطيله خلف PgBouncer بنمط transaction لأن العبارة المحضّرة مرتبطة باتصال الخادم.
+    """
+
+    def __init__(self, engine, prepared_statements=True):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self._write_engine = engine.execution_options(sqlite_begin="IMMEDIATE") if self.is_sqlite else engine
+        # SQLite يعيد استخدام العبارات عبر cached_statements لكل اتصال
+        self.prepared_statements = prepared_statements and not self.is_sqlite
+        self._prepared = {}
+        self.router = None
+
+    @property
+    def is_sqlite(self):
+        return self.dialect == "sqlite"
+
+    @property
+    def session(self):
+        """جلسة جديدة (تُستخدم مع with)."""
+        return Session(self.engine)
+
+    @property
+    def write_session(self):
+        """جلسة للعمليات التي تقرأ ثم تكتب؛ في SQLite تبدأ بـ BEGIN IMMEDIATE."""
+        return Session(self._write_engine)
+
+    def query(self, sql, params=None):
+        """ينفذ استعلام قراءة ويعيد DataFrame ثم يعيد الاتصال فوراً."""
+        with self.engine.connect() as conn:
+            return pd.read_sql(text(sql), conn, params=params or {})
+
+    # --- نسخة القراءة ---
+    def attach_replica(self, replica, **options):
+        """يوجه read_query إلى replica (Storage آخر). options: معاملات ReplicaRouter."""
+        self.router = ReplicaRouter(replica, **options)
+        return self.router
+
+    def read_query(self, sql, params=None, driver_id=None):
+        """مثل query لاستعلامات التقارير والسجل: من النسخة إن وُجدت وكانت صالحة، وإلا من الأساسية.
+
+        driver_id: المندوب الذي تخصه القراءة (قراءاته بعد كتابته تبقى على الأساسية).
+        """
+        replica = self.router.choose(driver_id) if self.router else None
+        if replica is not None:
+            try:
+                return replica.query(sql, params)
+            except (DBAPIError, pd.errors.DatabaseError) as e:
+                # pandas يغلف أخطاء التنفيذ (انقطاع الاتصال أثناء الاستعلام) في DatabaseError
+                self.router.mark_down(e)
+        return self.query(sql, params)
+
+    def read_engine(self, driver_id=None):
+        """المحرك الذي تُقرأ منه القراءات الطويلة (مثل التصدير) بنفس قواعد read_query."""
+        replica = self.router.choose(driver_id) if self.router else None
+        return replica.engine if replica is not None else self.engine
+
+    def note_write(self, *driver_ids):
+        """يُستدعى بعد commit كتابة تخص هؤلاء المندوبين."""
+        if self.router:
+            self.router.note_write(driver_ids)
+
+    def notify_change(self, s):
+        """ينبه مستمعي LISTEN (ChangeFeed) عند commit الجلسة s. في SQLite لا شيء: المستمع يفحص السجل دورياً."""
+        if not self.is_sqlite:
+            # الإشعارات المتطابقة داخل نفس الـ transaction تُرسل مرة واحدة
+            s.execute(text(f"NOTIFY {CHANGE_CHANNEL}"))
+
+    def replica_lag(self):
+        """تأخر هذه القاعدة عن الأساسية بالثواني (0 لملف SQLite أو قاعدة ليست standby)."""
+        if self.is_sqlite:
+            return 0.0
+        with self.engine.connect() as conn:
+            return float(conn.execute(text(REPLICA_LAG_SQL)).scalar() or 0.0)
+
+    def execute(self, s, statement, params, prepare_as=None):
+        """ينفذ عبارة text داخل الجلسة s.
+
+        مع prepare_as (في PostgreSQL): تُحضَّر العبارة بـ PREPARE مرة واحدة لكل اتصال
+        ثم تُنفذ بـ EXECUTE، فلا يعيد الخادم تحليلها وتخطيطها في كل استدعاء.
+        """
+        if not prepare_as or not self.prepared_statements:
+            return s.execute(statement, params)
+        prepare_sql, execute_sql = self._prepared.get(prepare_as) or self._compile_prepared(prepare_as, statement)
+        conn = s.connection()
+        # conn.info يبقى مع اتصال قاعدة البيانات نفسه طوال عمره داخل المجمع
+        prepared = conn.info.setdefault("prepared_statements", set())
+        if prepare_as not in prepared:
+            conn.exec_driver_sql(prepare_sql)
+            prepared.add(prepare_as)
+        return conn.execute(execute_sql, params)
+
+    def _compile_prepared(self, name, statement):
+        names = list(dict.fromkeys(PARAM_PATTERN.findall(statement.text)))
+        positional = PARAM_PATTERN.sub(lambda m: f"${names.index(m.group(1)) + 1}", statement.text)
+        compiled = (
+            f"PREPARE {name} AS {positional}",
+            text(f"EXECUTE {name}({', '.join(':' + n for n in names)})"),
+        )
+        self._prepared[name] = compiled
+        return compiled
+
+    def pool_stats(self):
+        """حالة مجمع الاتصالات: المستخدمة والخاملة والإضافية وزمن الانتظار، أو None لنوع مجمع آخر."""
+        pool = self.engine.pool
+        if not isinstance(pool, TimedQueuePool):
+            return None
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "checkouts": pool.checkouts,
+            "wait_mean_ms": pool.wait_total / pool.checkouts * 1000 if pool.checkouts else 0.0,
+            "wait_max_ms": pool.wait_max * 1000,
+            "timeouts": pool.timeouts,
+        }
+
+    # --- الفروقات بين أنواع قواعد البيانات ---
+    @property
+    def autoincrement_pk(self):
+        return "INTEGER PRIMARY KEY AUTOINCREMENT" if self.is_sqlite else "SERIAL PRIMARY KEY"
+
+    @property
+    def for_update(self):
+        """قفل الصفوف المقروءة؛ في SQLite يكفي قفل الكتابة الذي تحجزه write_session."""
+        return "" if self.is_sqlite else " FOR UPDATE"
+
+    @property
+    def money_type(self):
+        """نوع أعمدة المبالغ: NUMERIC في PostgreSQL؛ SQLite لا يملك نوعاً عشرياً دقيقاً فتبقى REAL."""
+        return "REAL" if self.is_sqlite else MONEY_SQL_TYPE
+
+    def money(self, value):
+        """المبلغ مقرّباً لمنزلتين بالنوع المناسب للربط: Decimal في PostgreSQL و float في SQLite."""
+        if self.is_sqlite:
+            return round(float(value), MONEY_SCALE)
+        return Decimal(str(value)).quantize(Decimal(1).scaleb(-MONEY_SCALE), rounding=ROUND_HALF_UP)
+
+    def day_of(self, column):
+        """تعبير SQL لتاريخ اليوم من عمود التوقيت (في SQLite التوقيت نص بصيغة ISO)."""
+        return f"substr({column}, 1, 10)" if self.is_sqlite else f"CAST({column} AS DATE)"
+
+    def copy_rows(self, s, table, columns, rows):
+        """تحميل جماعي لصفوف (قوائم بترتيب columns) داخل الجلسة s: COPY في PostgreSQL و executemany في SQLite."""
+        if not rows:
+            return
+        if self.is_sqlite:
+            placeholders = ", ".join(f":c{i}" for i in range(len(columns)))
+            s.execute(text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"),
+                      [{f"c{i}": value for i, value in enumerate(row)} for row in rows])
+            return
+        buffer = io.StringIO()
+        # \N للقيمة NULL حتى يبقى النص الفارغ نصاً فارغاً
+        csv.writer(buffer).writerows([r"\N" if value is None else value for value in row] for row in rows)
+        buffer.seek(0)
+        # نفس اتصال الجلسة، فيدخل COPY في الـ transaction نفسها
+        with s.connection().connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+    def has_column(self, s, table, column):
+        if self.is_sqlite:
+            sql = "SELECT 1 FROM pragma_table_info(:table) WHERE name = :column"
+        else:
+            sql = "SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column"
+        return s.execute(text(sql), {"table": table, "column": column}).fetchone() is not None
+
+    def migration_lock(self, s):
+        """يمنع تنفيذ الترحيلات من أكثر من عملية في نفس الوقت حتى نهاية الـ transaction."""
+        if not self.is_sqlite:
+            s.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+    def lock_table(self, s, table):
+        """يمنع الكتابة المتزامنة على الجدول حتى نهاية الـ transaction."""
+        if not self.is_sqlite:
+            s.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+
+    def estimate_rows(self, table):
+        """تقدير سريع لعدد الصفوف دون مسح الجدول، أو None إذا لم يتوفر."""
+        if self.is_sqlite:
+            return None
+        df = self.query("SELECT reltuples FROM pg_class WHERE relname = :table", {"table": table})
+        return int(df.iloc[0, 0]) if not df.empty else None
+
+
+def create_storage(url, prepared_statements=True, **pool):
+    """ينشئ طبقة التخزين من رابط SQLAlchemy (sqlite:///path.db أو postgresql://...).
+
+    pool: معاملات engine_options (pool_size، max_overflow، pool_timeout، pool_recycle، pool_pre_ping).
+    """
+    options = engine_options(**pool)
+    if url.startswith("sqlite"):
+        return Storage(sqlite_engine(url, **options))
+    return Storage(create_engine(url, **options), prepared_statements)
@@ -0,0 +1,190 @@
+"""اختبارات قواعد دفتر الأرصدة في repository.py على قاعدة SQLite مؤقتة.
+
+    python -m pytest -q
+"""
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+
+from migrations import MIGRATIONS
+from repository import (BACKFILL_JOB, BATCH_REJECT_AMOUNT, BATCH_REJECT_FUNDS, BATCH_REJECT_INACTIVE, BATCH_REJECT_UNKNOWN, CHARGE_TYPE,
+                        DELIVERY_TYPE, DeliveryRepository, IdempotencyKeyConflict)
+from storage import create_storage
+
+# مخطط الإصدار الأول من التطبيق (قبل migrations.py)، كما في delivery_app.db القديم
+LEGACY_SCHEMA = """
+    CREATE TABLE drivers (id INTEGER PRIMARY KEY AUTOINCREMENT, driver_id TEXT UNIQUE, name TEXT, bike_plate TEXT,
+                          whatsapp TEXT, notes TEXT, is_active BOOLEAN, balance REAL);
+    CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, driver_name TEXT, amount REAL, type TEXT,
+                               timestamp TEXT);
+"""
+
+
+def open_repository(path):
+    repo = DeliveryRepository(create_storage(f"sqlite:///{path}"))
+    repo.init_schema()
+    return repo
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = open_repository(tmp_path / "ledger.db")
+    repo.add_driver("D1", "مندوب أول", "P1", "", "", True)
+    repo.add_driver("D2", "مندوب ثانٍ", "P2", "", "", False)
+    yield repo
+    repo.storage.engine.dispose()
+
+
+def scalar(repo, sql, **params):
+    with repo.storage.session as s:
+        return s.execute(text(sql), params).scalar()
+
+
+def transaction_count(repo, driver_id):
+    return scalar(repo, "SELECT COUNT(*) FROM transactions WHERE driver_id = :id", id=driver_id)
+
+
+def balance(repo, driver_id):
+    return repo.load_driver_info(driver_id)["balance"]
+
+
+def test_idempotent_replay_posts_once(repo):
+    assert repo.update_balance("D1", 100, CHARGE_TYPE, idempotency_key="charge-1") == 100
+    # إعادة الإرسال بنفس المفتاح تعيد نفس النتيجة دون عملية ثانية
+    assert repo.update_balance("D1", 100, CHARGE_TYPE, idempotency_key="charge-1") == 100
+    assert repo.apply_postings([{"driver_id": "D1", "amount": 100, "type": CHARGE_TYPE, "idempotency_key": "charge-1"}]) == [100]
+    assert balance(repo, "D1") == 100
+    assert transaction_count(repo, "D1") == 1
+
+
+def test_key_reused_for_another_posting_is_rejected(repo):
+    repo.update_balance("D2", 10, CHARGE_TYPE)
+    assert repo.update_balance("D1", 100, CHARGE_TYPE, idempotency_key="charge-1") == 100
+    for driver_id, amount, trans_type in (("D2", 100, CHARGE_TYPE), ("D1", 50, CHARGE_TYPE), ("D1", 100, DELIVERY_TYPE)):
+        with pytest.raises(IdempotencyKeyConflict):
+            repo.update_balance(driver_id, amount, trans_type, idempotency_key="charge-1")
+    with pytest.raises(IdempotencyKeyConflict):
+        repo.record_batch([{"row": 1, "driver_id": "D1", "amount": 100, "type": CHARGE_TYPE}], idempotency_key="charge-1")
+    assert (balance(repo, "D1"), balance(repo, "D2")) == (100, 10)
+    assert transaction_count(repo, "D1") == 1
+
+    postings = [{"row": 1, "driver_id": "D1", "amount": None, "type": DELIVERY_TYPE}]
+    assert repo.record_batch(postings, idempotency_key="batch-1")["balances"] == {"D1": 85}
+    assert repo.record_batch(postings, idempotency_key="batch-1") is None
+    with pytest.raises(IdempotencyKeyConflict):
+        repo.record_batch(postings * 2, idempotency_key="batch-1")
+    with pytest.raises(IdempotencyKeyConflict):
+        repo.update_balance("D1", None, DELIVERY_TYPE, require_funds=True, idempotency_key="batch-1")
+    assert balance(repo, "D1") == 85
+
+
+def test_rejected_posting_releases_key(repo):
+    assert repo.update_balance("D1", -15, DELIVERY_TYPE, require_funds=True, idempotency_key="delivery-1") is None
+    assert scalar(repo, "SELECT COUNT(*) FROM idempotency_keys WHERE key = 'delivery-1'") == 0
+    assert transaction_count(repo, "D1") == 0
+
+    # بعد الشحن يُقبل نفس الطلب بنفس المفتاح لأن المحاولة المرفوضة لم تحجزه
+    repo.update_balance("D1", 20, CHARGE_TYPE)
+    assert repo.update_balance("D1", -15, DELIVERY_TYPE, require_funds=True, idempotency_key="delivery-1") == 5
+    assert repo.update_balance("D1", -15, DELIVERY_TYPE, require_funds=True, idempotency_key="delivery-1") == 5
+    assert transaction_count(repo, "D1") == 2
+
+
+def test_delivery_never_overdraws(repo):
+    repo.update_balance("D1", 20, CHARGE_TYPE)
+    assert repo.update_balance("D1", None, DELIVERY_TYPE, require_funds=True) == 5
+    assert repo.update_balance("D1", None, DELIVERY_TYPE, require_funds=True) is None
+    assert repo.update_balance("D1", -5, DELIVERY_TYPE, require_funds=True) == 0
+    assert balance(repo, "D1") == 0
+    assert transaction_count(repo, "D1") == 3
+    assert scalar(repo, "SELECT deliveries FROM driver_stats WHERE driver_id = 'D1'") == 2
+
+
+def test_delivery_rejected_for_inactive_driver(repo):
+    assert repo.update_balance("D2", 50, CHARGE_TYPE) == 50
+    assert repo.update_balance("D2", -15, DELIVERY_TYPE, require_funds=True) is None
+    assert balance(repo, "D2") == 50
+
+
+def test_batch_rejected_postings_write_nothing(repo):
+    repo.update_balance("D1", 20, CHARGE_TYPE)
+    repo.update_balance("D2", 50, CHARGE_TYPE)
+    postings = [
+        {"row": 1, "driver_id": "D1", "amount": -15, "type": DELIVERY_TYPE},
+        {"row": 2, "driver_id": "D1", "amount": -15, "type": DELIVERY_TYPE},
+        {"row": 3, "driver_id": "D2", "amount": -15, "type": DELIVERY_TYPE},
+        {"row": 4, "driver_id": "NOPE", "amount": 10, "type": CHARGE_TYPE},
+    ]
+    result = repo.record_batch(postings, idempotency_key="batch-1")
+    assert [p["row"] for p in result["accepted"]] == [1]
+    assert [(p["row"], p["reason"]) for p in result["rejected"]] == [
+        (2, BATCH_REJECT_FUNDS), (3, BATCH_REJECT_INACTIVE), (4, BATCH_REJECT_UNKNOWN)]
+    assert result["balances"] == {"D1": 5}
+    assert balance(repo, "D1") == 5
+    assert balance(repo, "D2") == 50
+    assert transaction_count(repo, "D1") == 2
+    assert transaction_count(repo, "D2") == 1
+    assert repo.record_batch(postings, idempotency_key="batch-1") is None
+
+    # دفعة كل عملياتها مرفوضة لا تغير شيئاً
+    result = repo.record_batch([
+        {"row": 1, "driver_id": "D1", "amount": -15, "type": DELIVERY_TYPE},
+        {"row": 2, "driver_id": "D2", "amount": -15, "type": DELIVERY_TYPE},
+    ])
+    assert result["accepted"] == [] and result["balances"] == {}
+    assert (balance(repo, "D1"), balance(repo, "D2")) == (5, 50)
+    assert scalar(repo, "SELECT COUNT(*) FROM transactions") == 3
+
+
+def test_batch_rejects_invalid_charge_amounts(repo):
+    result = repo.record_batch([
+        {"row": 1, "driver_id": "D1", "amount": -500, "type": CHARGE_TYPE},
+        {"row": 2, "driver_id": "D1", "amount": 0, "type": CHARGE_TYPE},
+        {"row": 3, "driver_id": "D1", "amount": float("nan"), "type": CHARGE_TYPE},
+        {"row": 4, "driver_id": "D1", "amount": float("inf"), "type": CHARGE_TYPE},
+        {"row": 5, "driver_id": "D1", "amount": 15, "type": DELIVERY_TYPE},
+        {"row": 6, "driver_id": "D1", "amount": 12.5, "type": CHARGE_TYPE},
+    ])
+    assert [p["row"] for p in result["accepted"]] == [6]
+    assert [(p["row"], p["reason"]) for p in result["rejected"]] == [(row, BATCH_REJECT_AMOUNT) for row in range(1, 6)]
+    assert balance(repo, "D1") == 12.5
+    assert scalar(repo, "SELECT charged FROM driver_stats WHERE driver_id = 'D1'") == 12.5
+
+
+def test_migrations_rerun_on_populated_legacy_db(tmp_path):
+    path = tmp_path / "legacy.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(LEGACY_SCHEMA)
+        conn.executemany("INSERT INTO drivers (driver_id, name, bike_plate, whatsapp, notes, is_active, balance) "
+                         "VALUES (?, ?, '', '', '', 1, ?)", [("J1", "أحمد", 20.0), ("J2", "محمد", 0.0)])
+        conn.executemany("INSERT INTO transactions (driver_name, amount, type, timestamp) VALUES (?, ?, ?, ?)", [
+            ("أحمد (ID:J1)", 50.0, CHARGE_TYPE, "2025-11-29 13:54:43"),
+            ("أحمد (J1)", -15.0, DELIVERY_TYPE, "2025-11-29 13:54:49"),
+            ("أحمد (ID:J1)", -15.0, DELIVERY_TYPE, "2025-11-29 13:55:10"),
+            ("محذوف (ID:J9)", 10.0, CHARGE_TYPE, "2025-11-29 14:00:00"),
+        ])
+    conn.close()
+
+    repo = open_repository(path)
+    try:
+        assert [row[0] for row in repo.applied_migrations()] == [m[0] for m in MIGRATIONS]
+        assert repo.job_finished(BACKFILL_JOB)
+        assert transaction_count(repo, "J1") == 3
+        assert scalar(repo, "SELECT COUNT(*) FROM transactions WHERE driver_id IS NULL") == 1
+        assert balance(repo, "J1") == 20
+        assert scalar(repo, "SELECT deliveries FROM driver_stats WHERE driver_id = 'J1'") == 2
+        assert repo.reconcile_balances()["mismatches"] == []
+    finally:
+        repo.storage.engine.dispose()
+
+    # تشغيل ثانٍ (إعادة تشغيل التطبيق) لا يطبق شيئاً ولا يغير البيانات
+    repo = DeliveryRepository(create_storage(f"sqlite:///{path}"))
+    try:
+        assert repo.init_schema() == []
+        assert scalar(repo, "SELECT COUNT(*) FROM transactions") == 4
+        assert (balance(repo, "J1"), balance(repo, "J2")) == (20, 0)
+        assert scalar(repo, "SELECT deliveries FROM driver_stats WHERE driver_id = 'J1'") == 2
+        assert repo.update_balance("J1", -15, DELIVERY_TYPE, require_funds=True) == 5
+    finally:
+        repo.storage.engine.dispose()
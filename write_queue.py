@@ -0,0 +1,124 @@
+"""طابور كتابة لعمليات الرصيد بنمط group commit.
+
+بدلاً من transaction و commit لكل عملية، تضع الجلسات عملياتها في طابور داخل العملية (process)،
+وخيط واحد في الخلفية يجمع ما وصل منها ويطبقه دفعة واحدة عبر DeliveryRepository.apply_postings.
+كل جلسة تنتظر Future الخاص بعمليتها، فلا يظهر التأكيد إلا بعد commit الدفعة التي تحتويها.
+
+- خيط واحد يطبق العمليات بترتيب وصولها، لذلك يبقى ترتيب عمليات كل مندوب كما هو.
+- شرط كفاية الرصيد يُتحقق منه لكل عملية داخل الدفعة بعد العمليات التي قبلها.
+- إذا فشلت الدفعة كلها (خطأ قاعدة بيانات) تُعاد عملياتها واحدة واحدة حتى لا تفشل عملية بسبب غيرها.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+MAX_BATCH = 64      # أقصى عدد عمليات في commit واحد
+MAX_WAIT = 0.002    # ثوانٍ لانتظار عمليات إضافية بعد أول عملية في الدفعة
+
+_STOP = object()
+
+
+class WriteQueue:
+    """repo: DeliveryRepository. observe: دالة اختيارية observe(name, seconds) لتسجيل زمن كل دفعة."""
+
+    def __init__(self, repo, max_batch=MAX_BATCH, max_wait=MAX_WAIT, observe=None):
+        self.repo = repo
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.observe = observe
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.postings = 0
+        self.fallbacks = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, driver_id, amount, trans_type, require_funds=False, idempotency_key=None):
+        """يضع العملية في الطابور ويعيد Future نتيجته نفس نتيجة update_balance."""
+        future = Future()
+        self._queue.put(({
+            "driver_id": driver_id,
+            "amount": amount,
+            "type": trans_type,
+            "require_funds": require_funds,
+            "idempotency_key": idempotency_key,
+        }, future))
+        return future
+
+    def post(self, driver_id, amount, trans_type, require_funds=False, idempotency_key=None, timeout=None):
+        """يضع العملية في الطابور وينتظر commit الدفعة (TimeoutError بعد timeout ثانية)."""
+        return self.submit(driver_id, amount, trans_type, require_funds, idempotency_key).result(timeout)
+
+    def close(self, timeout=None):
+        """يطبق ما بقي في الطابور ثم يوقف الخيط."""
+        self._queue.put(_STOP)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "batches": self.batches,
+            "postings": self.postings,
+            "avg_batch": self.postings / self.batches if self.batches else 0.0,
+            "fallbacks": self.fallbacks,
+        }
+
+    # --- الخيط ---
+    def _run(self):
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._apply(batch)
+            if stop:
+                return
+
+    def _collect(self):
+        """ينتظر أول عملية ثم يأخذ ما يصل خلال max_wait (حتى max_batch)."""
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _apply(self, batch):
+        started = time.perf_counter()
+        try:
+            results = self.repo.apply_postings([posting for posting, _ in batch])
+        except Exception:
+            self.fallbacks += 1
+            for posting, future in batch:
+                self._apply_one(posting, future)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        self.batches += 1
+        self.postings += len(batch)
+        if self.observe:
+            self.observe("write_queue_batch", time.perf_counter() - started)
+
+    def _apply_one(self, posting, future):
+        try:
+            future.set_result(self.repo.update_balance(
+                posting["driver_id"], posting["amount"], posting["type"],
+                posting["require_funds"], posting["idempotency_key"],
+            ))
+        except Exception as e:
+            future.set_exception(e)